@@ -39,8 +39,14 @@ from .utils.taxonomy_matcher import find_related_genomes_multiple
 from .utils.assembly_saver import KBaseAssemblyManager
 
 
-from .utils2.KBaseObjectUtils import download_fasta_files
-from .utils2.mash_skani_multiple import mash_skani_pipeline
+from .utils2.KBaseObjectUtils import (download_fasta_files, get_current_cdm_best_hits,
+                                      get_gtdb_lineages)
+from .utils2.mash_skani_multiple import SearchOptions, mash_skani_pipeline
+from .utils2.ani_cache import PairAniCache
+from .utils2.hash_cache import CdmHashCache
+from .utils2.result_memo import QueryResultMemo
+from .utils2.sketch_cache import QuerySketchCache
+from .utils2.hash_index import default_hash_index_path
 
 
 
@@ -102,6 +108,28 @@ This sample module contains one small method that filters contigs.
         self.shared_folder = config['scratch']
         self.ws_url = config['workspace-url']
         self.ws = Workspace(self.ws_url)
+        self.hash_cache_path = config.get('cdm-hash-cache',
+                                          os.path.join(self.shared_folder, "cdm_hash_cache.sqlite"))
+        self.ani_cache_path = config.get('ani-cache',
+                                         os.path.join(self.shared_folder, "ani_cache.sqlite"))
+        self.result_memo_path = config.get('query-result-memo',
+                                           os.path.join(self.shared_folder, "query_results.sqlite"))
+        self.mash_engine = config.get('mash-engine', 'mash')
+        self.mash_shards = config.get('mash-shards') or None
+        self.mash_segments = config.get('mash-segments') or None
+        self.lineage_sketches = config.get('lineage-sketches') or None
+        self.species_index = config.get('species-index') or None
+        self.skani_sketches = config.get('skani-sketches') or None
+        self.lsh_index = config.get('lsh-index') or None
+        self.lsh_min_band_hits = int(config.get('lsh-min-band-hits') or 1)
+        self.lsh_max_candidates = int(config.get('lsh-max-candidates') or 0) or None
+        self.query_workers = int(config.get('query-workers') or 1)
+        self.tool_limits = {"mash": int(config.get('max-mash-searches') or 0),
+                            "skani": int(config.get('max-skani-processes') or 0)}
+        self.minhash_cache_dir = config.get('minhash-cache-dir',
+                                            os.path.join(self.shared_folder, "minhash"))
+        self.query_sketch_cache_dir = config.get('query-sketch-cache',
+                                                 os.path.join(self.shared_folder, "query_sketches"))
         logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
                             level=logging.INFO)
         #END_CONSTRUCTOR
@@ -175,7 +203,10 @@ This sample module contains one small method that filters contigs.
         logging.info (genomeset_taxonomy_data)
         logging.info (related_genomes_only_dict)
         output = dict()
-        allpaths, related_path_dict = process_genomes(genomeset_taxonomy_data, related_genomes_only_dict, output_directory, self.callback_url)
+        ani_cache = PairAniCache(self.ani_cache_path)
+        allpaths, related_path_dict = process_genomes(genomeset_taxonomy_data,
+                                                      related_genomes_only_dict, output_directory,
+                                                      self.callback_url, ani_cache=ani_cache)
         taxonomy_dict = get_taxonomy_all_refs (genomeset_taxonomy_data, related_genomes_only_dict)
         output_csv_path = os.path.join(output_directory, "output.csv")
         output_html = os.path.join(output_directory, "index.html")
@@ -232,17 +263,59 @@ This sample module contains one small method that filters contigs.
         max_mash_dist = params['max_mash_dist']
         min_ani = params['min_ani']
         workspace_name = params['workspace_name']
+        full_search = int(params.get('full_search', 0)) == 1
+        batch_mash = int(params.get('batch_mash', 1)) == 1
+        batch_skani = int(params.get('batch_skani', 1)) == 1
+        lineage_prefilter = int(params.get('lineage_prefilter', 0)) == 1
+        two_tier = int(params.get('two_tier', 0)) == 1
+        lsh_prefilter = int(params.get('lsh_prefilter', 0)) == 1
+        # 0 or empty keeps verifying all candidates without deepening
+        max_hits = int(params.get('max_hits') or 0) or None
+        deepen_max_dist = float(params.get('deepen_max_dist') or 0) or None
+        force_refresh = int(params.get('force_refresh', 0)) == 1
 
 
 
-        logging.info ("=======Downloading fasta files============")
-        ref_fasta_path_dict = download_fasta_files(self.callback_url, ref_list)
-        logging.info (ref_fasta_path_dict)
-
-
         mash_db = "/data/datafiles/datafiles/sketches/combined_gtdb_sketch_410303_genome.msh"
+        if self.mash_segments and self.mash_engine == "mash" and os.path.exists(self.mash_segments):
+            # Base database plus incrementally added delta segments
+            mash_db = self.mash_segments
+        elif self.mash_shards and self.mash_engine == "mash" and os.path.exists(self.mash_shards):
+            mash_db = self.mash_shards
         taxonomy_file = "/data/datafiles/datafiles/genome_taxonomy_data/cdm_genomes_paths_taxonomy.tsv"
         genome_sample_file = "/data/datafiles/datafiles/sample_info/genome_sample.csv"
+        search_options = SearchOptions(
+            full_search=full_search, hash_index_file=default_hash_index_path(taxonomy_file),
+            batch_mash=batch_mash, mash_engine=self.mash_engine,
+            minhash_cache_dir=self.minhash_cache_dir,
+            lineage_index=self.lineage_sketches if lineage_prefilter else None,
+            species_index=self.species_index if two_tier else None,
+            lsh_index=self.lsh_index if lsh_prefilter else None,
+            lsh_min_band_hits=self.lsh_min_band_hits, lsh_max_candidates=self.lsh_max_candidates,
+            batch_skani=batch_skani, skani_sketch_db=self.skani_sketches,
+            query_workers=self.query_workers, max_hits=max_hits,
+            deepen_max_distance=deepen_max_dist, tool_limits=self.tool_limits,
+            force_refresh=force_refresh,
+        ).guided(mash_db)
+
+
+        current_hits = dict()
+        if not force_refresh:
+            # Genomes whose metadata already holds a hit for this database and these
+            # parameters are not downloaded
+            db_version = search_options.db_version(mash_db, taxonomy_file)
+            params_fingerprint = search_options.fingerprint(max_count, max_mash_dist, min_ani)
+            current_hits = get_current_cdm_best_hits(self.ws_url, ref_list, workspace_name,
+                                                     db_version, params_fingerprint, ctx['token'])
+            logging.info(f"Skipping {len(current_hits)} of {len(ref_list)} genomes "
+                         f"with a current cdm_best_hit")
+        search_refs = [ref for ref in ref_list if ref not in current_hits]
+
+        logging.info ("=======Downloading fasta files============")
+        ref_fasta_path_dict = dict()
+        if search_refs:
+            ref_fasta_path_dict = download_fasta_files(self.callback_url, search_refs)
+        logging.info (ref_fasta_path_dict)
 
 
         output_directory = os.path.join(self.shared_folder, "skani_mash_sample")
@@ -254,9 +327,27 @@ This sample module contains one small method that filters contigs.
 
 
 
+        hash_cache = CdmHashCache(self.hash_cache_path)
+        sketch_cache = QuerySketchCache(self.query_sketch_cache_dir)
+        ani_cache = PairAniCache(self.ani_cache_path)
+        result_memo = QueryResultMemo(self.result_memo_path)
+
+        query_lineages = None
+        if search_options.lineage_index:
+            query_lineages = dict()
+            if ref_fasta_path_dict:
+                query_lineages = get_gtdb_lineages(self.ws_url, list(ref_fasta_path_dict),
+                                                   ctx['token'])
+            logging.info(f"Found GTDB lineages for {len(query_lineages)} of "
+                         f"{len(ref_fasta_path_dict)} genomes")
+
         logging.info ("=======Running mash and skani pipeline============")
         mash_skani_pipeline(ref_fasta_path_dict, mash_db, taxonomy_file, self.ws_url, 
-                             workspace_name, provenance, max_count, max_mash_dist, min_ani,skani_mash_csv)
+                             workspace_name, provenance, max_count, max_mash_dist, min_ani,
+                             skani_mash_csv,
+                             options=search_options, query_lineages=query_lineages,
+                             hash_cache=hash_cache, sketch_cache=sketch_cache, ani_cache=ani_cache,
+                             result_memo=result_memo, current_hits=current_hits, ref_list=ref_list)
 
 
         logging.info ("=======Getting sample information============")
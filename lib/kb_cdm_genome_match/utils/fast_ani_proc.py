@@ -4,18 +4,25 @@ import os
 import subprocess
 import multiprocessing
 
+from ..utils2.fasta_index import fasta_contig_set_hash
+
 # This module provides a way to run the fastANI binary, pass
 # in data, and read the output
 
+FAST_ANI_CACHE_PARAMS = "--visualize"
+
 
-def run_fast_ani_pairwise(scratch, paths):
+def run_fast_ani_pairwise(scratch, paths, ani_cache=None):
     """
     Given a list of assembly paths, run fastANI on every pair
     Runs in parallel on each cpu
     :param scratch: string path where to put all output
     :param paths: list of paths to each assembly file (fasta format)
+    :param ani_cache: optional PairAniCache; pairs run before are read from it
     :returns: array of output result paths
     """
+    if ani_cache is not None:
+        ani_cache = ani_cache.for_tool('fastANI', get_fast_ani_version(), FAST_ANI_CACHE_PARAMS)
     # We have to cap cpus at 2 so we dont overuse our container node's resources
     # If we only have 1 cpu available, it will just run serial but threaded
     pool = multiprocessing.Pool(processes=2)
@@ -24,20 +31,51 @@ def run_fast_ani_pairwise(scratch, paths):
         for p2 in paths:
             if p1 == p2:
                 continue
-            jobs.append(pool.apply_async(_run_proc, (scratch, p1, p2)))
-    out_paths = [j.get() for j in jobs]
-    return out_paths
+            jobs.append(pool.apply_async(_run_cached_proc, (scratch, p1, p2, ani_cache)))
+    results = [j.get() for j in jobs]
+    if ani_cache is not None:
+        hits = sum(cached for _, cached in results)
+        print(('fastANI ANI cache:', hits, 'hits,', len(results) - hits, 'misses'))
+    return [out_path for out_path, _ in results]
+
+
+def get_fast_ani_version():
+    """fastANI prints its version to stderr"""
+    proc = subprocess.run(['fastANI', '--version'], stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, universal_newlines=True)
+    return proc.stdout.strip()
+
+
+def _run_cached_proc(scratch, path1, path2, ani_cache):
+    """
+    Runs _run_proc and reports whether the result came from the ANI cache,
+    which worker processes cannot count in the parent's cache object.
+    """
+    hits = ani_cache.cache.hits if ani_cache is not None else 0
+    out_path = _run_proc(scratch, path1, path2, ani_cache)
+    return out_path, ani_cache is not None and ani_cache.cache.hits > hits
 
 
-def _run_proc(scratch, path1, path2):
+def _run_proc(scratch, path1, path2, ani_cache=None):
     """
     :param scratch: file path of the scratch directory
     :param path1: path for the query genome file
     :param path2: path for the reference genome file
+    :param ani_cache: optional PairAniCache bound to fastANI (see run_fast_ani_pairwise);
+        a cached pair is written from the cache instead of running fastANI
     :returns: output file path
     """
     out_name = os.path.basename(path1) + '-' + os.path.basename(path2) + '.out'
     out_path = os.path.join(scratch, out_name)
+    if ani_cache is not None:
+        # Both genomes are identified by content, as input genomes are downloaded to new paths
+        query_hash = fasta_contig_set_hash(path1)
+        reference_hash = fasta_contig_set_hash(path2)
+        cached = ani_cache.get(query_hash, reference_hash)
+        if cached is not None:
+            _write_cached_output(path1, path2, out_path, cached)
+            _visualize(path1, path2, out_path)
+            return out_path
     args = ['fastANI', '-q', path1, '-r', path2, '--visualize', '-o', out_path, '--threads', '2']
     try:
         _run_subprocess(args, 'fastANI')
@@ -46,10 +84,48 @@ def _run_proc(scratch, path1, path2):
         raise err
     except Exception:
         print(('Unexpected error:', sys.exc_info()[0], 'with args:', args))
+    else:
+        if ani_cache is not None:
+            _cache_output(ani_cache, query_hash, reference_hash, out_path)
     _visualize(path1, path2, out_path)
     return out_path
 
 
+def _cache_output(ani_cache, query_hash, reference_hash, out_path):
+    """
+    Caches the ANI, the fraction of query fragments mapped and the mapped
+    fragment count of a fastANI output file, keeping the fragment count and the
+    --visualize mapping as details so the output and its plot can be rebuilt.
+    An empty output (ANI below fastANI's reporting cutoff) is cached as well.
+    """
+    if not os.path.exists(out_path):
+        return
+    with open(out_path) as fh:
+        fields = fh.read().split()
+    visual = None
+    if os.path.exists(out_path + '.visual'):
+        with open(out_path + '.visual') as fh:
+            visual = fh.read()
+    if len(fields) < 5:
+        ani_cache.put(query_hash, reference_hash, details={'visual': visual})
+        return
+    matched, total = fields[3], fields[4]
+    ani_cache.put(query_hash, reference_hash, float(fields[2]), int(matched) / int(total), matched,
+                  {'fragments': total, 'visual': visual})
+
+
+def _write_cached_output(path1, path2, out_path, cached):
+    """Writes the fastANI output files of a cached pair for the current genome paths"""
+    details = cached['details'] or {}
+    with open(out_path, 'w') as fh:
+        if cached['ani'] is not None:
+            fh.write('\t'.join([path1, path2, str(cached['ani']), cached['shared_kmers'],
+                                details['fragments']]) + '\n')
+    if details.get('visual') is not None:
+        with open(out_path + '.visual', 'w') as fh:
+            fh.write(details['visual'])
+
+
 def _visualize(path1, path2, out_path):
     """
     Given the output path for a fastANI result, build the PDF visualization file using Rscript
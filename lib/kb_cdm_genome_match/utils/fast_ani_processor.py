@@ -17,7 +17,8 @@ logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
 
 
 
-def process_genomes(genomeset_taxonomy_data, related_genomes_only_dict, output_base_dir, callback_url):
+def process_genomes(genomeset_taxonomy_data, related_genomes_only_dict, output_base_dir,
+                    callback_url, ani_cache=None):
     related_path_dict = dict()
     allpaths = list()
     for genome_data in genomeset_taxonomy_data:
@@ -55,7 +56,7 @@ def process_genomes(genomeset_taxonomy_data, related_genomes_only_dict, output_b
             #paths = download_fasta([genome_ref, related_ref], callback_url)
             print (paths)
             
-            output_paths = run_fast_ani_pairwise(pair_output_dir, paths)
+            output_paths = run_fast_ani_pairwise(pair_output_dir, paths, ani_cache)
             logging.info("ouput_paths " + pformat(output_paths) )
 
 
@@ -3,6 +3,7 @@
 from installed_clients.AssemblyUtilClient import AssemblyUtil
 from installed_clients.WorkspaceClient import Workspace
 
+import ast
 import logging
 logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
                             level=logging.INFO)
@@ -30,7 +31,9 @@ def download_fasta_files(callback_url, ref_list):
 
 
     
-def append_metadata_to_object(object_ref, ws_url, workspace_name, ref_cdm_hits_metadata, provenance):
+def append_metadata_to_object(object_ref, ws_url, workspace_name, ref_cdm_hits_metadata,
+                              provenance, db_version=None, params_fingerprint=None, query=None,
+                              query_hash=None):
     # Initialize Workspace client
     ws = Workspace(ws_url)
 
@@ -66,6 +69,17 @@ def append_metadata_to_object(object_ref, ws_url, workspace_name, ref_cdm_hits_m
 
 
     current_metadata.update({"cdm_best_hit":str(new_metadata)})
+    # Record what the hit was computed against, so later runs can tell whether it is current
+    if db_version is not None:
+        current_metadata["cdm_db_version"] = db_version
+    if params_fingerprint is not None:
+        current_metadata["cdm_params"] = params_fingerprint
+    # The query file name and contig_set_hash let later runs rebuild all result rows from the
+    # result memo
+    if query is not None:
+        current_metadata["cdm_query"] = query
+    if query_hash is not None:
+        current_metadata["cdm_query_hash"] = query_hash
 
     # Prepare the object specification for saving
     save_object_params = {
@@ -86,3 +100,78 @@ def append_metadata_to_object(object_ref, ws_url, workspace_name, ref_cdm_hits_m
     except Exception as e:
         print(f"Error appending metadata to object '{object_ref}': {e}")
         return 0
+
+
+def get_gtdb_lineages(ws_url, object_refs, token=None):
+    """
+    Reads the GTDB lineage stored in std_lineages of each genome object, fetching
+    only that field rather than the whole genome.
+
+    Returns:
+        dict: A mapping of object ref to its GTDB lineage string, for objects that have one.
+    """
+    ws = Workspace(ws_url, token=token)
+    result = ws.get_objects2({
+        'objects': [{'ref': ref, 'included': ['/std_lineages']} for ref in object_refs],
+        'ignoreErrors': 1
+    })
+    lineages = dict()
+    for ref, obj in zip(object_refs, result['data']):
+        if not obj:
+            continue
+        lineage = obj['data'].get('std_lineages', {}).get('gtdb', {}).get('lineage')
+        if lineage:
+            lineages[ref] = lineage
+    return lineages
+
+
+def get_current_cdm_best_hits(ws_url, object_refs, workspace_name, db_version, params_fingerprint,
+                              token=None):
+    """
+    Finds the objects whose metadata already holds a cdm_best_hit computed
+    against db_version with params_fingerprint, reading only object info
+    (no data) in two get_object_info3 calls.
+
+    append_metadata_to_object saves the annotated copy into workspace_name
+    under the object's name, so the metadata is read from the latest version
+    of that copy, and only trusted when it holds the same data (checksum) as
+    the requested object. Sets are never matched, as their genomes are
+    searched individually.
+
+    Returns:
+        dict: A mapping of object ref to (query file name, or the object name
+        for results stored without one; query contig_set_hash or None; best
+        hit dict, empty when the genome had no hit) for the objects that can
+        be skipped.
+    """
+    ws = Workspace(ws_url, token=token)
+    infos = ws.get_object_info3({
+        'objects': [{'ref': ref} for ref in object_refs],
+        'ignoreErrors': 1
+    })['infos']
+    candidates = [(ref, info) for ref, info in zip(object_refs, infos)
+                  if info and not info[2].split("-")[0].endswith("Set")]
+    if not candidates:
+        return dict()
+    copy_infos = ws.get_object_info3({
+        'objects': [{'ref': f"{workspace_name}/{info[1]}"} for _, info in candidates],
+        'includeMetadata': 1,
+        'ignoreErrors': 1
+    })['infos']
+    current_hits = dict()
+    for (ref, info), copy_info in zip(candidates, copy_infos):
+        if not copy_info:
+            continue
+        metadata = copy_info[10] or {}
+        if copy_info[8] != info[8] or "cdm_best_hit" not in metadata or \
+                metadata.get("cdm_db_version") != db_version or \
+                metadata.get("cdm_params") != params_fingerprint:
+            continue
+        try:
+            best_hit = ast.literal_eval(metadata["cdm_best_hit"])
+        except (ValueError, SyntaxError):
+            logging.info(f"⚠️ Warning: Unreadable cdm_best_hit in the metadata of {ref}")
+            continue
+        current_hits[ref] = (metadata.get("cdm_query") or info[1], metadata.get("cdm_query_hash"),
+                             best_hit)
+    return current_hits
@@ -0,0 +1,110 @@
+import json
+import sqlite3
+import zlib
+import logging
+
+from .hash_cache import DEFAULT_EVICT_INTERVAL, SqliteLruCache
+
+logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
+                            level=logging.INFO)
+
+DEFAULT_MAX_ENTRIES = 2000000
+
+
+class PairAniCache(SqliteLruCache):
+    """
+    On-disk SQLite cache of pairwise ANI results, so a query/reference pair
+    seen in an earlier run is not compared again with `skani dist` or fastANI.
+
+    Entries are keyed by the query's contig_set_hash, a reference id, the tool,
+    the tool version and a parameter string, and hold the ANI, the aligned
+    fraction and the shared k-mers (or matched fragments for fastANI). Pairs the
+    tool reported no result for are cached with ani None. An optional details
+    value (compressed JSON) keeps tool output needed to rebuild reports.
+
+    Hits and misses are counted per instance for the job log (counts made in
+    worker processes are not merged back); use for_tool to bind the tool key.
+    """
+    table = "pair_ani"
+    schema = """query_hash TEXT NOT NULL,
+                reference TEXT NOT NULL,
+                tool TEXT NOT NULL,
+                tool_version TEXT NOT NULL,
+                params TEXT NOT NULL,
+                ani REAL,
+                aligned_fraction REAL,
+                shared_kmers TEXT,
+                details BLOB,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (query_hash, reference, tool, tool_version, params)"""
+    key_columns = ("query_hash", "reference", "tool", "tool_version", "params")
+
+    def __init__(self, db_path, max_entries=DEFAULT_MAX_ENTRIES, timeout=60.0,
+                 evict_interval=DEFAULT_EVICT_INTERVAL):
+        super().__init__(db_path, max_entries, timeout, evict_interval)
+        self.hits = 0
+        self.misses = 0
+
+    def for_tool(self, tool, tool_version, params=""):
+        return ToolAniCache(self, tool, tool_version, params)
+
+    def count(self, hits=0, misses=0):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def get(self, query_hash, reference, tool, tool_version, params=""):
+        """
+        Returns the cached result as a dict with ani, aligned_fraction,
+        shared_kmers and details, or None when the pair was not cached.
+        Lookups are counted as hits or misses.
+        """
+        row = self._select(["ani", "aligned_fraction", "shared_kmers", "details"],
+                           (query_hash, reference, tool, tool_version, params))
+        if row is None:
+            self.count(misses=1)
+            return None
+        self.count(hits=1)
+        ani, aligned_fraction, shared_kmers, details = row
+        return {"ani": ani, "aligned_fraction": aligned_fraction, "shared_kmers": shared_kmers,
+                "details": json.loads(zlib.decompress(details)) if details is not None else None}
+
+    def put(self, query_hash, reference, tool, tool_version, params="", ani=None,
+            aligned_fraction=None, shared_kmers=None, details=None):
+        if details is not None:
+            details = zlib.compress(json.dumps(details).encode())
+        self._insert({"query_hash": query_hash, "reference": reference, "tool": tool,
+                      "tool_version": tool_version, "params": params, "ani": ani,
+                      "aligned_fraction": aligned_fraction, "shared_kmers": shared_kmers,
+                      "details": details})
+
+    def log_stats(self, label="ANI cache"):
+        logging.info(f"🔹 {label}: {self.hits} hits, {self.misses} misses")
+
+
+class ToolAniCache:
+    """
+    A PairAniCache bound to one tool, tool version and parameter string.
+    Cache errors are logged and treated as misses, so they never fail a run.
+    """
+
+    def __init__(self, cache, tool, tool_version, params=""):
+        self.cache = cache
+        self.tool = tool
+        self.tool_version = tool_version
+        self.params = params
+
+    def get(self, query_hash, reference):
+        try:
+            return self.cache.get(query_hash, reference, self.tool, self.tool_version, self.params)
+        except sqlite3.Error as e:
+            logging.info(f"⚠️ Warning: ANI cache lookup failed for {reference}: {e}")
+            return None
+
+    def put(self, query_hash, reference, ani=None, aligned_fraction=None, shared_kmers=None,
+            details=None):
+        try:
+            self.cache.put(query_hash, reference, self.tool, self.tool_version, self.params, ani,
+                           aligned_fraction, shared_kmers, details)
+        except sqlite3.Error as e:
+            logging.info(f"⚠️ Warning: Could not cache {self.tool} result for {reference}: {e}")
@@ -1,11 +1,39 @@
 from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import codecs
 import hashlib
+import io
+import os
+import threading
+import zlib
+
+from .tool_limits import pool_context
 
 DEFAULT_SPLIT = " "
+STREAM_CHUNK_SIZE = 1 << 20
+
+# ASCII characters str.strip() treats as whitespace, apart from "\n"
+_ASCII_WS_NO_NEWLINE = " \t\r\x0b\x0c\x1c\x1d\x1e\x1f"
+
+# Below this many bases a single core is faster than starting a pool
+PARALLEL_MIN_TOTAL_LENGTH = 16 << 20
+# hashlib releases the GIL on large buffers, so long contigs hash well on
+# threads; many short contigs are dominated by per-contig Python overhead
+# and need processes instead
+THREAD_MIN_MEAN_LENGTH = 100000
+
+# One thread and one process pool of os.cpu_count() workers shared by all callers that do not
+# ask for a worker count, so queries hashed on several threads do not each start a full pool
+_shared_pools = {}
+_shared_pools_lock = threading.Lock()
 
 def _hash_string(s):
     return hashlib.sha256(s.encode("utf-8")).hexdigest()
 
+def _combine_hashes(h_list):
+    return _hash_string("_".join(sorted(h_list)))
+
 class HashSeq(str):
     def __new__(cls, v):
         instance = super().__new__(cls, v.upper())
@@ -27,8 +55,7 @@ class HashSeqList(list):
     @property
     def hash_value(self):
         h_list = [x.hash_value for x in self]
-        hash_seq = "_".join(sorted(h_list))
-        return _hash_string(hash_seq)
+        return _combine_hashes(h_list)
 
 def extract_features(faa_str, split=DEFAULT_SPLIT, h_func=None):
     features = []
@@ -80,10 +107,331 @@ class Feature:
         if value not in self.ontology_terms[ontology_term]:
             self.ontology_terms[ontology_term].append(value)
 
-def contig_set_hash(features):
+def choose_hash_strategy(lengths, workers=None):
+    """
+    Picks "serial", "thread" or "process" hashing from the contig lengths.
+    """
+    workers = workers or os.cpu_count() or 1
+    total_length = sum(lengths)
+    if workers < 2 or len(lengths) < 2 or total_length < PARALLEL_MIN_TOTAL_LENGTH:
+        return "serial"
+    if total_length / len(lengths) >= THREAD_MIN_MEAN_LENGTH:
+        return "thread"
+    return "process"
+
+def _shared_pool(strategy):
+    with _shared_pools_lock:
+        pool = _shared_pools.get(strategy)
+        if pool is None:
+            workers = os.cpu_count() or 1
+            if strategy == "thread":
+                pool = ThreadPoolExecutor(max_workers=workers)
+            else:
+                pool = ProcessPoolExecutor(max_workers=workers, mp_context=pool_context())
+            _shared_pools[strategy] = pool
+        return pool
+
+def _reset_shared_pool(strategy, pool):
+    with _shared_pools_lock:
+        if _shared_pools.get(strategy) is pool:
+            del _shared_pools[strategy]
+    pool.shutdown(wait=False)
+
+def parallel_map(func, items, strategy, workers=None):
+    """
+    Maps func over items with the given strategy, preserving order. For the
+    "process" strategy func and items must be picklable. Without workers,
+    the pools shared by all threads are used (see _shared_pool).
+    """
+    if strategy == "serial":
+        return [func(x) for x in items]
+    if strategy not in ("thread", "process"):
+        raise ValueError(f"Unknown hashing strategy {strategy}")
+    chunksize = 1
+    if strategy == "process":
+        chunksize = max(1, len(items) // ((workers or os.cpu_count() or 1) * 4))
+    if workers:
+        if strategy == "thread":
+            executor = ThreadPoolExecutor(max_workers=workers)
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers, mp_context=pool_context())
+        with executor:
+            return list(executor.map(func, items, chunksize=chunksize))
+    pool = _shared_pool(strategy)
+    try:
+        return list(pool.map(func, items, chunksize=chunksize))
+    except BrokenProcessPool:
+        # A worker died; start a new pool for the next caller
+        _reset_shared_pool(strategy, pool)
+        raise
+
+def _hash_seq(seq):
+    return HashSeq(seq).hash_value
+
+def contig_set_hash(features, parallel=False, workers=None):
+    """
+    Returns the CDM contig-set hash. With parallel=True the per-contig
+    SHA-256s are spread over a thread or process pool chosen by
+    choose_hash_strategy; the digest is identical either way.
+    """
+    if parallel:
+        seqs = [contig.seq for contig in features]
+        strategy = choose_hash_strategy([len(seq) for seq in seqs], workers)
+        return _combine_hashes(parallel_map(_hash_seq, seqs, strategy, workers))
     hl = HashSeqList()
     for contig in features:
         seq = HashSeq(contig.seq)
         hl.append(seq)
     return hl.hash_value
 
+
+
+def _open_fasta_text(f):
+    """
+    Opens a (possibly gzipped) FASTA file as text with the same newline
+    handling as read_fasta2: universal newlines for plain files, '\\n' only
+    for gzipped files.
+    """
+    if f.endswith(".gz"):
+        import gzip
+        return io.TextIOWrapper(gzip.open(f, "rb"), encoding="utf-8", newline="\n")
+    return open(f, "r")
+
+class StreamingContigHasher:
+    """
+    Incremental FASTA parser computing per-contig SHA-256 digests without
+    holding any contig in memory. Mirrors extract_features + HashSeq exactly:
+    sequence lines are stripped, upper-cased and concatenated, lines before
+    the first header belong to the first contig, and a trailing header that
+    is not newline-terminated is dropped, unless it is the first header and
+    lines came before it.
+    """
+
+    def __init__(self):
+        self.hashes = []
+        self._hasher = hashlib.sha256()
+        self._has_record = False
+        self._at_line_start = True
+        self._in_header = False
+        self._line_started = False
+        self._pending_ws = ""
+        self._leading_text = False
+
+    def update(self, chunk):
+        if not self._has_record and chunk and not (self._at_line_start and chunk[0] == ">"):
+            self._leading_text = True
+        pos = 0
+        n = len(chunk)
+        while pos < n:
+            if self._at_line_start and chunk[pos] == ">":
+                self._at_line_start = False
+                self._start_record()
+            if self._in_header:
+                nl = chunk.find("\n", pos)
+                if nl == -1:
+                    return
+                self._end_line()
+                pos = nl + 1
+                continue
+            # Everything up to the next header line is sequence
+            h = chunk.find("\n>", pos)
+            end = n if h == -1 else h + 1
+            self._feed_sequence(chunk[pos:end])
+            pos = end
+
+    def _feed_sequence(self, region):
+        seq = region.replace("\n", "")
+        if (not self._pending_ws and seq.isascii()
+                and not any(c in seq for c in _ASCII_WS_NO_NEWLINE)):
+            # Fast path: no whitespace to strip, so lines simply concatenate
+            if seq:
+                self._update_seq(seq.upper())
+            self._at_line_start = region[-1] == "\n"
+            self._line_started = not self._at_line_start
+            return
+        pos = 0
+        n = len(region)
+        while pos < n:
+            nl = region.find("\n", pos)
+            end = n if nl == -1 else nl
+            if end > pos:
+                self._feed_fragment(region[pos:end])
+            if nl == -1:
+                break
+            self._end_line()
+            pos = nl + 1
+
+    def _feed_fragment(self, fragment):
+        if self._at_line_start:
+            self._at_line_start = False
+            if fragment[0] == ">":
+                self._start_record()
+                return
+        if self._in_header:
+            return
+        if not self._line_started:
+            fragment = fragment.lstrip()
+            if not fragment:
+                return
+            self._line_started = True
+        stripped = fragment.rstrip()
+        if stripped:
+            self._update_seq((self._pending_ws + stripped).upper())
+            self._pending_ws = fragment[len(stripped):]
+        else:
+            self._pending_ws += fragment
+
+    def _update_seq(self, seq):
+        self._hasher.update(seq.encode("utf-8"))
+
+    def _close_record(self):
+        self.hashes.append(self._hasher.hexdigest())
+        self._hasher = hashlib.sha256()
+
+    def _start_record(self):
+        if self._has_record:
+            self._close_record()
+        self._has_record = True
+        self._in_header = True
+
+    def _end_line(self):
+        self._at_line_start = True
+        self._in_header = False
+        self._line_started = False
+        self._pending_ws = ""
+
+    def finish(self):
+        """
+        Closes the last contig and returns the list of per-contig hex digests.
+        """
+        if not self._has_record:
+            raise ValueError("No FASTA header found")
+        if not self._in_header or (self._leading_text and not self.hashes):
+            self._close_record()
+        self._has_record = False
+        return self.hashes
+
+def iter_fasta_chunks(f, chunk_size=STREAM_CHUNK_SIZE):
+    with _open_fasta_text(f) as fh:
+        while True:
+            chunk = fh.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+def stream_contig_hashes(f, chunk_size=STREAM_CHUNK_SIZE):
+    hasher = StreamingContigHasher()
+    for chunk in iter_fasta_chunks(f, chunk_size):
+        hasher.update(chunk)
+    return hasher.finish()
+
+def stream_contig_set_hash(f, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Computes the same digest as contig_set_hash(read_fasta2(f)) while reading
+    the file in chunks of chunk_size characters.
+    """
+    return _combine_hashes(stream_contig_hashes(f, chunk_size))
+
+def n50(lengths):
+    lengths = sorted(lengths, reverse=True)
+    half = sum(lengths) / 2
+    running = 0
+    for length in lengths:
+        running += length
+        if running >= half:
+            return length
+    return 0
+
+class StreamingGenomeDigest(StreamingContigHasher):
+    """
+    StreamingContigHasher that also tallies per-contig length and G+C
+    counts from the same upper-cased sequence it hashes.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.lengths = []
+        self.gc_counts = []
+        self._length = 0
+        self._gc = 0
+
+    def _update_seq(self, seq):
+        super()._update_seq(seq)
+        self._length += len(seq)
+        self._gc += seq.count("G") + seq.count("C")
+
+    def _close_record(self):
+        super()._close_record()
+        self.lengths.append(self._length)
+        self.gc_counts.append(self._gc)
+        self._length = 0
+        self._gc = 0
+
+def _gunzip_chunks(raw_chunks, max_length=STREAM_CHUNK_SIZE):
+    """
+    Decompresses a stream of gzip bytes (multi-member files included)
+    without letting any output chunk exceed max_length.
+    """
+    d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    in_member = False
+    for raw in raw_chunks:
+        while raw or in_member:
+            in_member = True
+            out = d.decompress(raw, max_length)
+            if out:
+                yield out
+            if d.eof:
+                raw = d.unused_data
+                d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                in_member = False
+                continue
+            raw = d.unconsumed_tail
+            # A capped output may leave more data inside zlib; otherwise wait for input
+            if not raw and len(out) < max_length:
+                break
+    if in_member:
+        raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+
+def genome_digest(f, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Reads a (possibly gzipped) FASTA file once and returns:
+
+    - contig_set_hash: same digest as contig_set_hash(read_fasta2(f))
+    - contig_hashes / contig_lengths: per-contig SHA-256 and length, in file order
+    - file_md5: MD5 of the file bytes as stored on disk
+    - gc_content, total_length, n50, contig_count
+    """
+    gzipped = f.endswith(".gz")
+    md5 = hashlib.md5()
+    digest = StreamingGenomeDigest()
+
+    def raw_chunks(fh):
+        while True:
+            raw = fh.read(chunk_size)
+            if not raw:
+                break
+            md5.update(raw)
+            yield raw
+
+    # Same text decoding as _open_fasta_text: utf-8, universal newlines for plain files only
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    if not gzipped:
+        decoder = io.IncrementalNewlineDecoder(decoder, translate=True)
+    with open(f, "rb") as fh:
+        byte_chunks = _gunzip_chunks(raw_chunks(fh)) if gzipped else raw_chunks(fh)
+        for data in byte_chunks:
+            digest.update(decoder.decode(data))
+        digest.update(decoder.decode(b"", final=True))
+    contig_hashes = digest.finish()
+
+    total_length = sum(digest.lengths)
+    return {
+        "contig_set_hash": _combine_hashes(contig_hashes),
+        "contig_hashes": contig_hashes,
+        "contig_lengths": digest.lengths,
+        "file_md5": md5.hexdigest(),
+        "gc_content": sum(digest.gc_counts) / total_length if total_length else 0.0,
+        "total_length": total_length,
+        "n50": n50(digest.lengths),
+        "contig_count": len(contig_hashes)
+    }
@@ -0,0 +1,366 @@
+"""
+mmap-backed FASTA reader with a cached contig offset index.
+
+The index is built once per file and saved next to it as `<fasta>.cdmfai`,
+a `.fai`-style TSV with one row per contig:
+
+    name  length  header_offset  offset  end  flags
+
+`offset`/`end` delimit the raw sequence bytes (line breaks included) and
+`length` is the number of bases. The first line records the file size and
+mtime so a stale index is rebuilt automatically. Records expose their
+sequence as memoryview slices of the mapping, so hashing, size statistics
+and contig subsetting never copy sequence data into Python strings.
+Only uncompressed files can be mapped; gzipped files go through the
+streaming hasher in calculate_hash. So do files with a lone "\r" line break,
+which read_fasta2 reads as a newline but the index does not split on, and
+files with non-ASCII bytes or \x1c-\x1f, which str.strip()/str.upper() treat
+differently from their bytes counterparts.
+"""
+import hashlib
+import mmap
+import os
+import threading
+
+from .calculate_hash import (DEFAULT_SPLIT, _combine_hashes, choose_hash_strategy,
+                             n50, parallel_map, stream_contig_set_hash)
+
+INDEX_SUFFIX = ".cdmfai"
+INDEX_MAGIC = "#cdmfai3"
+BLOCK_SIZE = 1 << 20
+
+FLAG_CLEAN = 1
+FLAG_TERMINATED = 2
+
+_WHITESPACE = b" \t\n\r\x0b\x0c"
+_LINE_BREAKS = b"\r\n"
+_UPPER = bytes.maketrans(b"abcdefghijklmnopqrstuvwxyz", b"ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+# Bytes the mmap path handles exactly like read_fasta2: ASCII except the \x1c-\x1f separators
+_PLAIN_BYTES = bytes(range(0x1c)) + bytes(range(0x20, 0x80))
+
+# Mappings opened by pool worker processes, reused across tasks. The worker pool is shared
+# across calls (see calculate_hash.parallel_map), so only the most recent files stay mapped
+_WORKER_MAPS = {}
+_WORKER_MAPS_MAX = 8
+
+
+def _iter_range_blocks(mm, offset, end, clean, block_size=BLOCK_SIZE):
+    """
+    Yields the upper-cased bases of mm[offset:end] in blocks of at most
+    block_size raw bytes, with the same per-line whitespace stripping as
+    extract_features.
+    """
+    pos = offset
+    while pos < end:
+        block_end = min(pos + block_size, end)
+        if clean:
+            yield mm[pos:block_end].translate(_UPPER, _LINE_BREAKS)
+            pos = block_end
+            continue
+        # Keep whole lines together so leading/trailing whitespace is stripped per line
+        if block_end < end:
+            nl = mm.rfind(b"\n", pos, block_end)
+            if nl == -1:
+                nl = mm.find(b"\n", block_end, end)
+            block_end = end if nl == -1 else nl + 1
+        yield b"".join(line.strip() for line in mm[pos:block_end].split(b"\n")).translate(_UPPER)
+        pos = block_end
+
+
+def _has_lone_cr(mm, block_size=BLOCK_SIZE):
+    """
+    Whether mm holds a "\r" that is not followed by "\n".
+    """
+    for pos in range(0, len(mm), block_size):
+        # One extra byte pairs a "\r" at the end of the block with its "\n"
+        block = mm[pos:pos + block_size + 1]
+        carriage_returns = block.count(b"\r")
+        if len(block) > block_size and block[-1:] == b"\r":
+            carriage_returns -= 1
+        if carriage_returns != block.count(b"\r\n"):
+            return True
+    return False
+
+
+def _has_special_bytes(mm, block_size=BLOCK_SIZE):
+    """
+    Whether mm holds a non-ASCII byte or one of \x1c-\x1f.
+    """
+    return any(mm[pos:pos + block_size].translate(None, _PLAIN_BYTES)
+               for pos in range(0, len(mm), block_size))
+
+
+def _hash_range(mm, offset, end, clean):
+    h = hashlib.sha256()
+    for block in _iter_range_blocks(mm, offset, end, clean):
+        h.update(block)
+    return h.hexdigest()
+
+
+def _hash_file_range(task):
+    path, file_key, offset, end, clean = task
+    # The file key tells a file written again under the same path from the mapped one
+    mm = _WORKER_MAPS.get((path, file_key))
+    if mm is None:
+        while len(_WORKER_MAPS) >= _WORKER_MAPS_MAX:
+            _WORKER_MAPS.pop(next(iter(_WORKER_MAPS))).close()
+        with open(path, "rb") as fh:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        _WORKER_MAPS[(path, file_key)] = mm
+    return _hash_range(mm, offset, end, clean)
+
+
+class FastaRecord:
+    """
+    Lazy view of one contig. `clean` records only contain line breaks as
+    whitespace, so their bases can be read in fixed-size blocks without
+    looking at line boundaries.
+    """
+    __slots__ = ("_fasta", "name", "length", "header_offset", "offset", "end", "flags")
+
+    def __init__(self, fasta, name, length, header_offset, offset, end, flags):
+        self._fasta = fasta
+        self.name = name
+        self.length = length
+        self.header_offset = header_offset
+        self.offset = offset
+        self.end = end
+        self.flags = flags
+
+    @property
+    def clean(self):
+        return bool(self.flags & FLAG_CLEAN)
+
+    @property
+    def terminated(self):
+        return bool(self.flags & FLAG_TERMINATED)
+
+    @property
+    def header(self):
+        header_end = self.offset - 1 if self.terminated else self.offset
+        return bytes(self._fasta.view[self.header_offset:header_end]).decode("utf-8").rstrip("\r")
+
+    @property
+    def description(self):
+        header_data = self.header[1:].split(DEFAULT_SPLIT, 1)
+        return header_data[1] if len(header_data) > 1 else None
+
+    @property
+    def raw(self):
+        """
+        Zero-copy memoryview of the sequence bytes, line breaks included.
+        """
+        return self._fasta.view[self.offset:self.end]
+
+    def iter_blocks(self, block_size=BLOCK_SIZE):
+        """
+        Yields the upper-cased bases in blocks of at most block_size raw bytes.
+        """
+        return _iter_range_blocks(self._fasta.mm, self.offset, self.end, self.clean, block_size)
+
+    @property
+    def hash_value(self):
+        return _hash_range(self._fasta.mm, self.offset, self.end, self.clean)
+
+
+class IndexedFasta:
+    """
+    Memory-mapped uncompressed FASTA file with a cached offset index.
+
+    :param path: Path to the FASTA file.
+    :param index_path: Where to cache the index (default: `<path>.cdmfai`).
+    :param cache_index: Whether to read and write the cached index.
+    """
+
+    def __init__(self, path, index_path=None, cache_index=True):
+        if path.endswith(".gz"):
+            raise ValueError(f"Cannot memory-map compressed FASTA file {path}")
+        self.path = path
+        self.index_path = index_path or path + INDEX_SUFFIX
+        self._fh = open(path, "rb")
+        st = os.fstat(self._fh.fileno())
+        self._file_key = (st.st_size, st.st_mtime_ns)
+        if st.st_size:
+            self.mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.mm = b""
+        self.view = memoryview(self.mm)
+        self.leading_text = False
+        self.lone_cr = False
+        self.special_bytes = False
+        self.records = None
+        if cache_index:
+            self.records = self._load_index()
+        if self.records is None:
+            self.records = self._build_index()
+            if cache_index:
+                self._save_index()
+        self._by_name = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        self.view.release()
+        if isinstance(self.mm, mmap.mmap):
+            self.mm.close()
+        self._fh.close()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __getitem__(self, name):
+        if self._by_name is None:
+            self._by_name = {record.name: record for record in self.records}
+        return self._by_name[name]
+
+    def _build_index(self):
+        mm = self.mm
+        size = len(mm)
+        records = []
+        if size == 0:
+            return records
+        self.lone_cr = _has_lone_cr(mm)
+        self.special_bytes = _has_special_bytes(mm)
+        if mm[:1] == b">":
+            hdr = 0
+        else:
+            self.leading_text = True
+            hdr = mm.find(b"\n>")
+            hdr = -1 if hdr == -1 else hdr + 1
+        while hdr != -1:
+            nl = mm.find(b"\n", hdr)
+            if nl == -1:
+                header = mm[hdr + 1:size]
+                offset = end = size
+                flags = FLAG_CLEAN
+                nxt = -1
+            else:
+                header = mm[hdr + 1:nl]
+                offset = nl + 1
+                nxt = mm.find(b"\n>", nl)
+                end = size if nxt == -1 else nxt + 1
+                flags = FLAG_CLEAN | FLAG_TERMINATED
+            length = 0
+            for pos in range(offset, end, BLOCK_SIZE):
+                block = mm[pos:min(pos + BLOCK_SIZE, end)]
+                bases = block.translate(None, _WHITESPACE)
+                length += len(bases)
+                if len(block) - len(bases) != block.count(b"\n") + block.count(b"\r"):
+                    flags &= ~FLAG_CLEAN
+            name = header.decode("utf-8").rstrip("\r").split(DEFAULT_SPLIT, 1)[0]
+            records.append(FastaRecord(self, name, length, hdr, offset, end, flags))
+            hdr = -1 if nxt == -1 else nxt + 1
+        return records
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "r") as fh:
+                magic = fh.readline().rstrip("\n").split("\t")
+                if magic != [INDEX_MAGIC, str(self._file_key[0]), str(self._file_key[1])]:
+                    return None
+                self.leading_text = fh.readline().rstrip("\n") == "leading_text=1"
+                self.lone_cr = fh.readline().rstrip("\n") == "lone_cr=1"
+                self.special_bytes = fh.readline().rstrip("\n") == "special_bytes=1"
+                records = []
+                for line in fh:
+                    name, *fields = line.rstrip("\n").rsplit("\t", 5)
+                    records.append(FastaRecord(self, name, *map(int, fields)))
+                return records
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def _save_index(self):
+        tmp_path = f"{self.index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w") as fh:
+                fh.write(f"{INDEX_MAGIC}\t{self._file_key[0]}\t{self._file_key[1]}\n")
+                fh.write(f"leading_text={int(self.leading_text)}\n")
+                fh.write(f"lone_cr={int(self.lone_cr)}\n")
+                fh.write(f"special_bytes={int(self.special_bytes)}\n")
+                for r in self.records:
+                    fh.write(f"{r.name}\t{r.length}\t{r.header_offset}\t{r.offset}\t{r.end}\t"
+                             f"{r.flags}\n")
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            # Read-only locations (e.g. reference data) simply go without a cached index
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def hashed_records(self):
+        """
+        Records that take part in contig_set_hash: a trailing header without
+        a newline is dropped, as in extract_features.
+        """
+        if self.records and not self.records[-1].terminated:
+            return self.records[:-1]
+        return self.records
+
+    def contig_set_hash(self, parallel=False, workers=None):
+        """
+        Returns the CDM contig-set hash. With parallel=True contigs are hashed
+        on a thread pool (few long contigs) or a process pool (many short
+        contigs), as chosen by choose_hash_strategy.
+        """
+        if self.leading_text or self.lone_cr or self.special_bytes:
+            # Text before the first header is folded into the first contig by
+            # extract_features, read_fasta2 opens plain files with universal
+            # newlines and strips/upper-cases decoded text; leave these quirks
+            # to the streaming hasher
+            return stream_contig_set_hash(self.path)
+        if not self.records:
+            raise ValueError("No FASTA header found")
+        records = self.hashed_records()
+        strategy = "serial"
+        if parallel:
+            strategy = choose_hash_strategy([r.length for r in records], workers)
+        if strategy == "process":
+            tasks = [(self.path, self._file_key, r.offset, r.end, r.clean) for r in records]
+            h_list = parallel_map(_hash_file_range, tasks, strategy, workers)
+        else:
+            h_list = parallel_map(lambda r: r.hash_value, records, strategy, workers)
+        return _combine_hashes(h_list)
+
+    def contig_lengths(self):
+        return {r.name: r.length for r in self.records}
+
+    def size_stats(self):
+        """
+        Returns contig count, total length and N50 straight from the index.
+        """
+        lengths = [r.length for r in self.records]
+        return {"contig_count": len(lengths), "total_length": sum(lengths), "n50": n50(lengths)}
+
+    def write_subset(self, names, out_path):
+        """
+        Writes the named contigs, in the given order, to a new FASTA file by
+        copying their bytes directly out of the mapping.
+        """
+        with open(out_path, "wb") as out:
+            for name in names:
+                r = self[name]
+                out.write(self.view[r.header_offset:r.offset])
+                if not r.terminated:
+                    out.write(b"\n")
+                out.write(r.raw)
+                if r.end > r.offset and self.mm[r.end - 1:r.end] != b"\n":
+                    out.write(b"\n")
+        return out_path
+
+
+def fasta_contig_set_hash(path, parallel=False, workers=None):
+    """
+    contig_set_hash for a FASTA file on disk: memory-mapped for plain files
+    (optionally hashing contigs in parallel), streamed for gzipped ones.
+    """
+    if path.endswith(".gz"):
+        return stream_contig_set_hash(path)
+    with IndexedFasta(path) as fasta:
+        return fasta.contig_set_hash(parallel, workers)
@@ -0,0 +1,161 @@
+import os
+import sqlite3
+import threading
+from contextlib import closing
+import time
+import logging
+
+from .fasta_index import fasta_contig_set_hash
+
+logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
+                            level=logging.INFO)
+
+DEFAULT_MAX_ENTRIES = 500000
+DEFAULT_EVICT_INTERVAL = 1000
+
+
+class SqliteLruCache:
+    """
+    Base of the on-disk SQLite caches: one table of `schema` columns (ending
+    with last_access) with the least recently used rows evicted once
+    `max_entries` is exceeded. Subclasses set `table`, `schema` and the
+    `key_columns` rows are looked up by.
+
+    Every operation opens its own short-lived connection, which makes the
+    cache safe to share between worker processes and threads. The database
+    runs in WAL mode and writers take an immediate lock, so concurrent
+    readers never block and concurrent writers wait up to `timeout` seconds.
+    The table size is checked on the first put of an instance and then every
+    `evict_interval` puts, so it can briefly run over by that many entries.
+    """
+    table = None
+    schema = None
+    key_columns = ()
+
+    def __init__(self, db_path, max_entries, timeout=60.0, evict_interval=DEFAULT_EVICT_INTERVAL):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.evict_interval = evict_interval
+        self._puts = 0
+        self._lock = threading.Lock()
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(db_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} ({self.schema})")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_last_access "
+                         f"ON {self.table} (last_access)")
+
+    def __getstate__(self):
+        # Sent to worker processes without the lock
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None)
+        return closing(conn)
+
+    def _select(self, columns, key):
+        """
+        Returns the columns of the row with the key_columns values key, or
+        None, and marks the row as recently used.
+        """
+        where = " AND ".join(f"{column} = ?" for column in self.key_columns)
+        with self._connect() as conn:
+            row = conn.execute(f"SELECT {', '.join(columns)} FROM {self.table} WHERE {where}",
+                               key).fetchone()
+            if row is not None:
+                conn.execute(f"UPDATE {self.table} SET last_access = ? WHERE {where}",
+                             (time.time(),) + tuple(key))
+        return row
+
+    def _insert(self, values):
+        """
+        Inserts or replaces a row given as a column -> value dict.
+        """
+        columns = list(values) + ["last_access"]
+        with self._lock:
+            evict = self._puts % self.evict_interval == 0
+            self._puts += 1
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(f"INSERT OR REPLACE INTO {self.table} ({', '.join(columns)}) "
+                             f"VALUES ({', '.join('?' * len(columns))})",
+                             tuple(values.values()) + (time.time(),))
+                if evict:
+                    self._evict(conn)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _evict(self, conn):
+        (count,) = conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()
+        if count <= self.max_entries:
+            return
+        conn.execute(f"DELETE FROM {self.table} WHERE rowid IN "
+                     f"(SELECT rowid FROM {self.table} ORDER BY last_access ASC LIMIT ?)",
+                     (count - self.max_entries,))
+
+
+class CdmHashCache(SqliteLruCache):
+    """
+    On-disk SQLite cache mapping a reference genome path (plus its size and
+    mtime) to its cdm_hash, so popular references are hashed only once.
+    """
+    table = "cdm_hash"
+    schema = """path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                cdm_hash TEXT NOT NULL,
+                last_access REAL NOT NULL"""
+    key_columns = ("path", "size", "mtime_ns")
+
+    def __init__(self, db_path, max_entries=DEFAULT_MAX_ENTRIES, timeout=60.0,
+                 evict_interval=DEFAULT_EVICT_INTERVAL):
+        super().__init__(db_path, max_entries, timeout, evict_interval)
+
+    @staticmethod
+    def _file_key(path):
+        st = os.stat(path)
+        return os.path.abspath(path), st.st_size, st.st_mtime_ns
+
+    def get(self, path):
+        """
+        Returns the cached cdm_hash for path, or None when it is missing or
+        the file changed since it was cached.
+        """
+        row = self._select(["cdm_hash"], self._file_key(path))
+        return row[0] if row is not None else None
+
+    def put(self, path, cdm_hash):
+        key_path, size, mtime_ns = self._file_key(path)
+        self._insert({"path": key_path, "size": size, "mtime_ns": mtime_ns, "cdm_hash": cdm_hash})
+
+    def get_or_compute(self, path, hash_func=fasta_contig_set_hash):
+        """
+        Returns the cdm_hash for path, computing and caching it on a miss.
+        Cache errors are logged and never fail the caller.
+        """
+        try:
+            cdm_hash = self.get(path)
+        except sqlite3.Error as e:
+            logging.info(f"⚠️ Warning: cdm_hash cache lookup failed for {path}: {e}")
+            return hash_func(path)
+        if cdm_hash is not None:
+            return cdm_hash
+
+        cdm_hash = hash_func(path)
+        try:
+            self.put(path, cdm_hash)
+        except sqlite3.Error as e:
+            logging.info(f"⚠️ Warning: Could not cache cdm_hash for {path}: {e}")
+        return cdm_hash
+
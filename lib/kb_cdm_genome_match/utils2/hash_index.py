@@ -0,0 +1,167 @@
+"""
+Precomputed cdm_hash index for the CDM reference genomes.
+
+The index is a sidecar TSV next to the taxonomy table with one
+`filepath<TAB>cdm_hash` row per genome. It is built offline with
+
+    python -m kb_cdm_genome_match.utils2.hash_index \\
+        --taxonomy /data/.../cdm_genomes_paths_taxonomy.tsv --processes 32
+
+While building, finished rows are appended to `<index>.partial`, so a
+crashed run picks up where it stopped when started again.
+"""
+import argparse
+import csv
+import os
+import re
+import time
+import logging
+import multiprocessing
+
+import pandas as pd
+
+from .calculate_hash import stream_contig_set_hash
+
+logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
+                            level=logging.INFO)
+
+HASH_INDEX_SUFFIX = ".cdm_hash.tsv"
+HASH_INDEX_COLUMNS = ["filepath", "cdm_hash"]
+
+_HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def default_hash_index_path(taxonomy_file):
+    """
+    Returns the sidecar hash index path for a taxonomy TSV.
+    """
+    base, _ = os.path.splitext(taxonomy_file)
+    return base + HASH_INDEX_SUFFIX
+
+
+def _read_index_rows(index_file):
+    """
+    Yields valid (filepath, cdm_hash) rows, skipping the header and any
+    truncated line left behind by an interrupted write.
+    """
+    with open(index_file, "r", newline="") as fh:
+        for fields in csv.reader(fh, delimiter="\t"):
+            if len(fields) == 2 and _HASH_RE.match(fields[1]):
+                yield fields[0], fields[1]
+
+
+def load_hash_index(index_file):
+    """
+    Reads a hash index and returns a dictionary mapping filepaths to cdm_hash.
+    """
+    return dict(_read_index_rows(index_file))
+
+
+def invert_hash_index(hash_index):
+    """
+    Turns a filepath -> cdm_hash index into a cdm_hash -> [filepaths] lookup
+    used to find CDM genomes identical to a query.
+    """
+    genomes_by_hash = {}
+    for filepath, cdm_hash in hash_index.items():
+        genomes_by_hash.setdefault(cdm_hash, []).append(filepath)
+    return genomes_by_hash
+
+
+def _hash_genome(filepath):
+    try:
+        return filepath, stream_contig_set_hash(filepath), None
+    except Exception as e:
+        return filepath, None, str(e)
+
+
+def _resume_checkpoint(partial_file):
+    """
+    Loads the finished rows from a checkpoint and rewrites it without any
+    partial trailing line, so new rows can be appended safely.
+    """
+    done = {}
+    if os.path.exists(partial_file):
+        done = load_hash_index(partial_file)
+    tmp_file = partial_file + ".tmp"
+    with open(tmp_file, "w", newline="") as fh:
+        writer = csv.writer(fh, delimiter="\t", lineterminator="\n")
+        writer.writerow(HASH_INDEX_COLUMNS)
+        writer.writerows(done.items())
+    os.replace(tmp_file, partial_file)
+    return done
+
+
+def build_hash_index(taxonomy_file, index_file=None, processes=None, flush_every=1000):
+    """
+    Computes contig_set_hash for every genome listed in the taxonomy TSV using
+    a process pool and writes the sidecar hash index.
+
+    :param taxonomy_file: Path to cdm_genomes_paths_taxonomy.tsv.
+    :param index_file: Output index path (default: sidecar next to taxonomy_file).
+    :param processes: Number of worker processes (default: all cpus).
+    :param flush_every: Number of rows between checkpoint flushes.
+    :return: Tuple of (index path, number of genomes that failed to hash).
+    """
+    if index_file is None:
+        index_file = default_hash_index_path(taxonomy_file)
+    partial_file = index_file + ".partial"
+
+    filepaths = pd.read_csv(taxonomy_file, sep="\t", usecols=["filepath"])["filepath"].tolist()
+    done = _resume_checkpoint(partial_file)
+    todo = [p for p in filepaths if p not in done]
+    logging.info(f"Hash index: {len(filepaths)} genomes, {len(done)} already done, "
+                 f"{len(todo)} to hash")
+
+    failed = 0
+    start = time.time()
+    with open(partial_file, "a", newline="") as fh, \
+            multiprocessing.Pool(processes=processes) as pool:
+        writer = csv.writer(fh, delimiter="\t", lineterminator="\n")
+        for n, (filepath, cdm_hash, error) in enumerate(
+                pool.imap_unordered(_hash_genome, todo, chunksize=16), 1):
+            if error is not None:
+                failed += 1
+                logging.info(f"⚠️ Warning: Could not hash {filepath}: {error}")
+            else:
+                writer.writerow([filepath, cdm_hash])
+                done[filepath] = cdm_hash
+            if n % flush_every == 0:
+                fh.flush()
+                os.fsync(fh.fileno())
+                logging.info(f"Hash index: {n}/{len(todo)} hashed in {time.time() - start:.0f}s")
+
+    if failed:
+        logging.info(f"Hash index: {failed} genomes failed, rerun to retry them. "
+                     f"Checkpoint kept at {partial_file}")
+        return index_file, failed
+
+    # Write the final index in taxonomy order and drop the checkpoint
+    tmp_file = index_file + ".tmp"
+    with open(tmp_file, "w", newline="") as fh:
+        writer = csv.writer(fh, delimiter="\t", lineterminator="\n")
+        writer.writerow(HASH_INDEX_COLUMNS)
+        writer.writerows((p, done[p]) for p in filepaths)
+    os.replace(tmp_file, index_file)
+    os.remove(partial_file)
+    logging.info(f"Hash index saved to {index_file}")
+    return index_file, 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Precompute cdm_hash for all CDM genomes "
+                                                 "listed in the taxonomy TSV.")
+    parser.add_argument("--taxonomy", required=True, help="Path to cdm_genomes_paths_taxonomy.tsv")
+    parser.add_argument("--output", default=None, help="Output hash index (default: sidecar TSV)")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="Worker processes (default: all cpus)")
+    parser.add_argument("--flush-every", type=int, default=1000,
+                        help="Rows between checkpoint flushes")
+    args = parser.parse_args(argv)
+
+    _, failed = build_hash_index(args.taxonomy, args.output, args.processes, args.flush_every)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
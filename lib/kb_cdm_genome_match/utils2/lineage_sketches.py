@@ -0,0 +1,127 @@
+"""
+Per-genus sub-sketch files for the lineage-guided Mash prefilter.
+
+Genomes in the taxonomy TSV are grouped by their domain..genus lineage and
+each genus is sketched into its own .msh file with the sketch parameters of
+the combined database. A `<name>.lineages.tsv` manifest lists them:
+
+    lineage  path  genomes
+
+where lineage is the `d__...;p__...;c__...;o__...;f__...;g__...` prefix.
+run_lineage_mash_search searches the genus files matching a query's GTDB
+lineage first and widens to the family and order by searching the union of
+the genus files below that rank, then falls back to the combined database.
+A `<name>.lineages.json` file records a fingerprint of the genus groups and
+sketch parameters, so a build resumes only over genus files made from the
+same taxonomy TSV. Built offline with
+
+    python -m kb_cdm_genome_match.utils2.lineage_sketches \\
+        --taxonomy /data/.../cdm_genomes_paths_taxonomy.tsv \\
+        --mash-db /data/.../combined_gtdb_sketch_410303_genome.msh \\
+        --output-dir /data/.../lineages --threads 32
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+
+import pandas as pd
+
+from .mash_skani_multiple import LINEAGE_INDEX_SUFFIX, LINEAGE_RANKS, get_sketch_params
+from .sketch_shards import safe_file_name, sketch_shard, write_manifest
+
+logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
+                            level=logging.INFO)
+
+LINEAGE_BUILD_SUFFIX = ".lineages.json"
+_GENUS_FILE = re.compile(r"^\d{6}_.+\.msh$")
+
+
+def group_genomes_by_lineage(taxonomy_file):
+    """
+    Returns a dictionary mapping each domain..genus lineage string to the
+    filepaths of its genomes, in taxonomy order.
+    """
+    taxonomy_df = pd.read_csv(taxonomy_file, sep="\t", usecols=["filepath"] + LINEAGE_RANKS)
+    taxonomy_df[LINEAGE_RANKS] = taxonomy_df[LINEAGE_RANKS].fillna("")
+    groups = {}
+    rank_columns = (taxonomy_df[rank] for rank in LINEAGE_RANKS)
+    for filepath, *levels in zip(taxonomy_df["filepath"], *rank_columns):
+        groups.setdefault(";".join(levels), []).append(filepath)
+    return groups
+
+
+def _remove_genus_files(output_dir):
+    for name in os.listdir(output_dir):
+        if _GENUS_FILE.match(name):
+            os.remove(os.path.join(output_dir, name))
+
+
+def build_lineage_sketches(taxonomy_file, mash_db, output_dir, threads=1, manifest_name=None):
+    """
+    Sketches every genus of the taxonomy TSV into its own .msh file and writes
+    the lineage manifest. Existing genus files are kept, so a build resumes,
+    unless they were made from different genus groups or sketch parameters.
+
+    :param taxonomy_file: Path to cdm_genomes_paths_taxonomy.tsv.
+    :param mash_db: Combined Mash database whose k-mer size and sketch size are reused.
+    :param output_dir: Directory for the genus .msh files and the manifest.
+    :param threads: Threads passed to `mash sketch`.
+    :return: Path of the lineage manifest.
+    """
+    params = get_sketch_params(mash_db)
+    groups = group_genomes_by_lineage(taxonomy_file)
+    os.makedirs(output_dir, exist_ok=True)
+    if manifest_name is None:
+        manifest_name = os.path.splitext(os.path.basename(mash_db))[0]
+    manifest_file = os.path.join(output_dir, manifest_name + LINEAGE_INDEX_SUFFIX)
+
+    # Genus files are numbered by group, so any change to the groups invalidates all of them
+    build_file = os.path.join(output_dir, manifest_name + LINEAGE_BUILD_SUFFIX)
+    build_key = [params["kmer_size"], params["sketch_size"], list(groups.items())]
+    fingerprint = hashlib.sha256(json.dumps(build_key).encode()).hexdigest()
+    try:
+        with open(build_file) as fh:
+            built = json.load(fh).get("fingerprint")
+    except (OSError, ValueError):
+        built = None
+    if built != fingerprint:
+        logging.info(f"Genus groups or sketch parameters changed, rebuilding the sub-sketches "
+                     f"in {output_dir}")
+        _remove_genus_files(output_dir)
+        with open(build_file, "w") as fh:
+            json.dump({"taxonomy": os.path.abspath(taxonomy_file), "fingerprint": fingerprint}, fh)
+
+    rows = []
+    for n, (lineage, filepaths) in enumerate(groups.items(), 1):
+        genus = lineage.rsplit(";", 1)[-1] or "unclassified"
+        # Genus names are not unique across the tree, so number the files
+        sketch_path = os.path.join(output_dir, f"{n:06d}_{safe_file_name(genus)}.msh")
+        logging.info(f"Lineage {n}/{len(groups)} {lineage} ({len(filepaths)} genomes)")
+        sketch_shard(filepaths, sketch_path, params["kmer_size"], params["sketch_size"], threads)
+        rows.append([lineage, os.path.basename(sketch_path), len(filepaths)])
+
+    write_manifest(manifest_file, ["lineage", "path", "genomes"], rows)
+    logging.info(f"Lineage manifest with {len(rows)} genera saved to {manifest_file}")
+    return manifest_file
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build per-genus Mash sub-sketch files for the "
+                                                 "lineage-guided search.")
+    parser.add_argument("--taxonomy", required=True, help="Path to cdm_genomes_paths_taxonomy.tsv")
+    parser.add_argument("--mash-db", required=True,
+                        help="Combined .msh database to take sketch parameters from")
+    parser.add_argument("--output-dir", required=True,
+                        help="Directory for the sub-sketches and manifest")
+    parser.add_argument("--threads", type=int, default=1, help="Threads for mash sketch")
+    args = parser.parse_args(argv)
+
+    build_lineage_sketches(args.taxonomy, args.mash_db, args.output_dir, args.threads)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
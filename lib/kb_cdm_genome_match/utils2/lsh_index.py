@@ -0,0 +1,222 @@
+"""
+Banded MinHash (LSH) index over the native copy of a Mash sketch database.
+
+A Mash sketch keeps the s smallest k-mer hashes of a genome. Splitting the
+hash space into bands * rows slots by `hash % slots`, the smallest sketch hash
+in each slot is the minimum of an independent hash function over all k-mers
+of the genome, so two genomes agree in a slot with probability equal to their
+Jaccard index. Each band combines `rows` slot minima into one key, and a
+reference becomes a candidate for a query when they share at least
+min_band_hits band keys. With Jaccard j the chance of sharing a band is
+1 - (1 - j^rows)^bands; Mash distance 0.05 at k=21 is j ~ 0.21, which the
+default 64 bands of 2 rows catch ~95% of the time. Candidates are scored
+with the exact Mash distance, so only recall is approximate.
+
+The index is kept inside the native sketch directory (see minhash_engine),
+`<db>.msh.minhash/lsh_b<bands>_r<rows>/`:
+
+    keys.npy   band keys, shape (bands, sketches), sorted within each band
+    ids.npy    sketch index of every key
+    meta.json  bands, rows, sketch count and the source file key
+
+Both arrays are memory-mapped, so a lookup reads a few pages per band
+instead of the whole database. Built offline with
+
+    python -m kb_cdm_genome_match.utils2.lsh_index \\
+        --db /data/.../combined_gtdb_sketch_410303_genome.msh --bands 64 --rows 2
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .minhash_engine import CHUNK_SKETCHES, MinHashSketchDB, msh_file_key
+
+logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
+                            level=logging.INFO)
+
+DEFAULT_BANDS = 64
+DEFAULT_ROWS = 2
+# Marks a slot without any sketch hash, and a band that contains one
+EMPTY = np.uint64(2 ** 64 - 1)
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+def lsh_index_dir(native_dir, bands=DEFAULT_BANDS, rows=DEFAULT_ROWS):
+    return os.path.join(native_dir, f"lsh_b{bands}_r{rows}")
+
+
+def slot_minima(hashes, offsets, slots):
+    """
+    Smallest hash of each sketch in every `hash % slots` slot, EMPTY where a
+    sketch has no hash in a slot.
+
+    :param hashes: Sorted-per-sketch uint64 hashes.
+    :param offsets: Start of each sketch in hashes (n + 1 entries, from 0).
+    :return: uint64 array of shape (n, slots).
+    """
+    n = len(offsets) - 1
+    sizes = np.diff(offsets)
+    seg = np.repeat(np.arange(n, dtype=np.int64), sizes)
+    keys = seg * slots + (hashes % np.uint64(slots)).astype(np.int64)
+    # Hashes are sorted within a sketch, so the first one of a slot is its minimum
+    unique_keys, first = np.unique(keys, return_index=True)
+    minima = np.full(n * slots, EMPTY, dtype=np.uint64)
+    minima[unique_keys] = hashes[first]
+    return minima.reshape(n, slots)
+
+
+def band_keys(minima, bands, rows):
+    """
+    Combines the slot minima of each band into one uint64 key per band.
+
+    :param minima: Array of shape (n, bands * rows) from slot_minima.
+    :return: uint64 array of shape (n, bands), EMPTY for bands with an empty slot.
+    """
+    banded = minima.reshape(len(minima), bands, rows)
+    keys = np.zeros((len(minima), bands), dtype=np.uint64)
+    for row in range(rows):
+        keys = (keys ^ banded[:, :, row]) * _MIX
+        keys ^= keys >> np.uint64(31)
+    keys[(banded == EMPTY).any(axis=2)] = EMPTY
+    return keys
+
+
+def build_lsh_index(sketch_db, bands=DEFAULT_BANDS, rows=DEFAULT_ROWS,
+                    chunk_sketches=CHUNK_SKETCHES):
+    """
+    Writes the LSH index of a MinHashSketchDB into its native directory,
+    replacing an existing index with the same bands and rows.
+
+    :param sketch_db: MinHashSketchDB of the reference sketches.
+    :return: Path of the index directory.
+    """
+    slots = bands * rows
+    if sketch_db.sketch_size < 4 * slots:
+        logging.info(f"⚠️ Warning: {slots} LSH slots leave fewer than 4 hashes per slot of a "
+                     f"{sketch_db.sketch_size}-hash sketch; bands will often be empty")
+    index_dir = lsh_index_dir(sketch_db.native_dir, bands, rows)
+    tmp_dir = tempfile.mkdtemp(dir=sketch_db.native_dir, prefix=os.path.basename(index_dir) + ".")
+    try:
+        count = len(sketch_db)
+        keys = np.lib.format.open_memmap(os.path.join(tmp_dir, "keys.npy"), mode="w+",
+                                         dtype=np.uint64, shape=(bands, count))
+        for lo in range(0, count, chunk_sketches):
+            hi = min(lo + chunk_sketches, count)
+            start = sketch_db.offsets[lo]
+            hashes = np.asarray(sketch_db.hashes[start:sketch_db.offsets[hi]])
+            minima = slot_minima(hashes, sketch_db.offsets[lo:hi + 1] - start, slots)
+            keys[:, lo:hi] = band_keys(minima, bands, rows).T
+
+        ids = np.lib.format.open_memmap(os.path.join(tmp_dir, "ids.npy"), mode="w+",
+                                        dtype=np.int64, shape=(bands, count))
+        for band in range(bands):
+            order = np.argsort(keys[band], kind="stable")
+            ids[band] = order
+            keys[band] = keys[band][order]
+        keys.flush()
+        ids.flush()
+        del keys, ids
+
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as fh:
+            json.dump({"bands": bands, "rows": rows, "sketches": count,
+                       "file_key": sketch_db.meta["file_key"]}, fh)
+        if os.path.exists(index_dir):
+            shutil.rmtree(index_dir)
+        os.replace(tmp_dir, index_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    logging.info(f"LSH index with {bands} bands of {rows} rows over {count} sketches "
+                 f"saved to {index_dir}")
+    return index_dir
+
+
+class LSHIndex:
+    """
+    Memory-mapped LSH index with exact Mash distance scoring of its candidates.
+
+    :param index_dir: Directory written by build_lsh_index.
+    :param min_band_hits: Band keys a reference must share with the query to be
+                          scored. Higher values score fewer candidates at lower recall.
+    :param max_candidates: Upper bound on scored candidates, keeping those that
+                           share the most bands (None for no bound).
+    :param msh_path: When given, the .msh file the index must have been built from.
+    """
+
+    def __init__(self, index_dir, min_band_hits=1, max_candidates=None, msh_path=None):
+        self.index_dir = index_dir
+        self.min_band_hits = min_band_hits
+        self.max_candidates = max_candidates
+        with open(os.path.join(index_dir, "meta.json")) as fh:
+            self.meta = json.load(fh)
+        self.bands = self.meta["bands"]
+        self.rows = self.meta["rows"]
+        self.sketch_db = MinHashSketchDB(os.path.dirname(os.path.abspath(index_dir)))
+        if self.meta["file_key"] != self.sketch_db.meta["file_key"] or \
+                self.meta["sketches"] != len(self.sketch_db):
+            raise ValueError(f"LSH index {index_dir} is older than its sketch database, rebuild it")
+        if msh_path is not None and self.meta["file_key"] != msh_file_key(msh_path):
+            raise ValueError(f"LSH index {index_dir} was not built from {msh_path}, rebuild it")
+        self.keys = np.load(os.path.join(index_dir, "keys.npy"), mmap_mode="r")
+        self.ids = np.load(os.path.join(index_dir, "ids.npy"), mmap_mode="r")
+
+    def candidates(self, query):
+        """
+        Indices of the reference sketches sharing at least min_band_hits band
+        keys with a query sketch, in database order.
+        """
+        minima = slot_minima(query, np.array([0, len(query)]), self.bands * self.rows)
+        found = []
+        for band, key in enumerate(band_keys(minima, self.bands, self.rows)[0]):
+            if key == EMPTY:
+                continue
+            band_keys_sorted = self.keys[band]
+            lo = np.searchsorted(band_keys_sorted, key, side="left")
+            hi = np.searchsorted(band_keys_sorted, key, side="right")
+            if hi > lo:
+                found.append(np.asarray(self.ids[band, lo:hi]))
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+
+        indices, counts = np.unique(np.concatenate(found), return_counts=True)
+        passing = counts >= self.min_band_hits
+        indices, counts = indices[passing], counts[passing]
+        if self.max_candidates is not None and len(indices) > self.max_candidates:
+            keep = np.argsort(-counts, kind="stable")[:self.max_candidates]
+            indices = indices[np.sort(keep)]
+        return indices
+
+    def search(self, query, top_n=10, max_mash_distance=0.05):
+        """
+        Returns the top (reference name, distance) pairs among the candidates of
+        a query sketch, ordered like a stable sort of `mash dist` output.
+        """
+        indices = self.candidates(query)
+        distances = self.sketch_db.subset_distances(query, indices)
+        passing = np.flatnonzero(distances <= max_mash_distance)
+        best = passing[np.argsort(distances[passing], kind="stable")[:max(top_n, 0)]]
+        logging.info(f"🔹 LSH scored {len(indices)} of {len(self.sketch_db)} sketches")
+        return [(self.sketch_db.names[indices[i]], float(distances[i])) for i in best]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the banded MinHash index used to select "
+                                                 "Mash search candidates.")
+    parser.add_argument("--db", required=True, help="Path to the .msh sketch file")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Directory for the native copy (default: next to the .msh file)")
+    parser.add_argument("--bands", type=int, default=DEFAULT_BANDS, help="Number of bands")
+    parser.add_argument("--rows", type=int, default=DEFAULT_ROWS, help="Slot minima per band")
+    args = parser.parse_args(argv)
+
+    build_lsh_index(MinHashSketchDB.from_msh(args.db, args.cache_dir), args.bands, args.rows)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,14 +1,36 @@
+import hashlib
+import heapq
+import json
 import subprocess
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple as _NamedTuple
 import pandas as pd
 import os
 import logging
 
-from  .calculate_hash import read_fasta2, contig_set_hash
+from .fasta_index import fasta_contig_set_hash
 from .KBaseObjectUtils import append_metadata_to_object
+from .hash_index import load_hash_index, invert_hash_index
+from .lsh_index import LSHIndex
+from .minhash_engine import NATIVE_SUFFIX, MinHashSketchDB, convert_msh, msh_file_key
+from .sketch_cache import paste_sketches
+from .tool_limits import pool_context, run_tool, set_tool_limits, tool_slot
 
 logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
                             level=logging.INFO)
 
+SHARD_MANIFEST_SUFFIX = ".shards.tsv"
+SEGMENT_MANIFEST_SUFFIX = ".segments.tsv"
+LINEAGE_INDEX_SUFFIX = ".lineages.tsv"
+LINEAGE_RANKS = ["domain", "phylum", "class", "order", "family", "genus"]
+LINEAGE_MAX_RANK = "order"
+# Candidates fetched by the single Mash search of a deepened query
+DEEPEN_MAX_CANDIDATES = 1000
+SPECIES_INDEX_SUFFIX = ".species.tsv"
+SPECIES_REPS_SUFFIX = ".species_reps.msh"
+SKANI_SKETCHES_SUFFIX = ".skani.tsv"
 
 def load_taxonomy_data(taxonomy_file):
     """
@@ -19,122 +41,1234 @@ def load_taxonomy_data(taxonomy_file):
     taxonomy_dict = {os.path.basename(filepath): (filepath, taxonomy) for filepath, taxonomy in zip(taxonomy_df['filepath'], taxonomy_df['taxonomy'])}
     return taxonomy_dict
 
-def run_mash_search(query_fasta, mash_db, top_n=10, max_mash_distance=0.05):
+def _parse_mash_line(line):
+    """
+    Returns (reference filename, query id, distance) for a `mash dist` output line.
+    """
+    fields = line.rstrip("\n").split("\t")
+    if len(fields) < 3:
+        return None
+    genome_path, query_id, distance, *_ = fields
+    return os.path.basename(genome_path), query_id, float(distance)
+
+class TopMatches:
+    """
+    Bounded max-heap keeping the top_n smallest Mash distances seen so far.
+    Ties keep the earlier hit, so the result equals a stable sort of all hits.
+    """
+
+    def __init__(self, top_n):
+        self.top_n = top_n
+        self._heap = []
+        self._count = 0
+
+    def add(self, genome_filename, distance):
+        self._count += 1
+        if self.top_n <= 0:
+            return
+        item = (-distance, -self._count, genome_filename)
+        if len(self._heap) < self.top_n:
+            heapq.heappush(self._heap, item)
+        elif distance < -self._heap[0][0]:
+            heapq.heapreplace(self._heap, item)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def matches(self):
+        return [(genome_filename, -neg_distance)
+                for neg_distance, _, genome_filename in sorted(self._heap, reverse=True)]
+
+def _stream_mash_dist(mash_db, query):
+    """
+    Runs `mash dist` and yields its output lines as they are produced, so the
+    410k-line output is never held in memory.
+    """
+    with tempfile.TemporaryFile(mode="w+") as err:
+        proc = subprocess.Popen(["mash", "dist", mash_db, query], stdout=subprocess.PIPE,
+                                stderr=err, universal_newlines=True)
+        try:
+            yield from proc.stdout
+        finally:
+            proc.stdout.close()
+            if proc.wait() != 0:
+                err.seek(0)
+                raise RuntimeError(f"Error running Mash: {err.read()}")
+
+def is_segment_manifest(mash_db):
+    return mash_db.endswith(SEGMENT_MANIFEST_SUFFIX)
+
+def is_shard_manifest(mash_db):
+    """
+    True for a shard manifest (sketch_shards) or a segment manifest
+    (sketch_segments), whose .msh files are all searched together.
+    """
+    return mash_db.endswith(SHARD_MANIFEST_SUFFIX) or is_segment_manifest(mash_db)
+
+def load_shard_manifest(manifest_file):
+    """
+    Returns the .msh paths listed in a shard or segment manifest, resolved
+    relative to the manifest.
+    """
+    shards = pd.read_csv(manifest_file, sep="\t")
+    base_dir = os.path.dirname(os.path.abspath(manifest_file))
+    return [os.path.join(base_dir, path) for path in shards["path"]]
+
+def load_segment_manifest(manifest_file):
+    """
+    Reads a segment manifest written by sketch_segments into a DataFrame with
+    one row per segment (base first) and its path, taxonomy and hash_index
+    columns resolved relative to the manifest.
+    """
+    segments = pd.read_csv(manifest_file, sep="\t", dtype=str, keep_default_na=False)
+    base_dir = os.path.dirname(os.path.abspath(manifest_file))
+    for column in ("path", "taxonomy", "hash_index"):
+        segments[column] = [os.path.join(base_dir, path) if path else ""
+                            for path in segments[column]]
+    return segments
+
+def guided_search_indexes(mash_db, lineage_index=None, species_index=None, lsh_index=None):
+    """
+    Returns the lineage, species and LSH indexes to search mash_db with.
+    Configured indexes that do not exist are dropped with a warning, so the
+    parameter fingerprint records the search that actually runs. The indexes
+    are built from the base database only, so when mash_db is a segment
+    manifest with delta segments they are all dropped with a warning and all
+    segments are searched exhaustively, which keeps the genomes of the delta
+    segments findable.
+    """
+    indexes = {"lineage": lineage_index, "species": species_index, "LSH": lsh_index}
+    paths = {"lineage": lineage_index, "species": species_index,
+             "LSH": os.path.join(lsh_index, "meta.json") if lsh_index else None}
+    for name, path in paths.items():
+        if path and not os.path.exists(path):
+            logging.info(f"⚠️ Warning: The {name} index {indexes[name]} does not exist. "
+                         f"Searching without it.")
+            indexes[name] = None
+    lineage_index, species_index, lsh_index = indexes.values()
+    guided = [name for name, index in indexes.items() if index]
+    if guided and is_segment_manifest(mash_db) and len(load_segment_manifest(mash_db)) > 1:
+        logging.info(f"⚠️ Warning: The {', '.join(guided)} index only covers the base segment "
+                     f"of {mash_db}. Searching all segments without it.")
+        return None, None, None
+    return lineage_index, species_index, lsh_index
+
+def _search_sketch_file(task):
+    """
+    Streams `mash dist` of one sketch file into a TopMatches per query id.
+    """
+    mash_db, query, top_n, max_mash_distance = task
+    top_matches = {}
+    for line in _stream_mash_dist(mash_db, query):
+        parsed = _parse_mash_line(line)
+        if parsed:
+            genome_filename, query_id, distance = parsed
+            if distance <= max_mash_distance:
+                if query_id not in top_matches:
+                    top_matches[query_id] = TopMatches(top_n)
+                top_matches[query_id].add(genome_filename, distance)
+    return {query_id: matches.matches() for query_id, matches in top_matches.items()}
+
+def search_sketch_files(sketch_files, query, top_n=10, max_mash_distance=0.05, processes=None,
+                        top_matches=None):
+    """
+    Searches several sketch files concurrently on a process pool and merges
+    their top_n lists into one TopMatches per query id, which gives the same
+    matches as searching all genomes at once.
+    Matches are added to top_matches when given, so searches can be chained.
+    """
+    tasks = [(sketch_file, query, top_n, max_mash_distance) for sketch_file in sketch_files]
+    processes = min(processes or os.cpu_count(), len(tasks))
+    if processes <= 1:
+        file_hits = [_search_sketch_file(task) for task in tasks]
+    else:
+        with pool_context().Pool(processes) as pool:
+            file_hits = pool.map(_search_sketch_file, tasks)
+
+    if top_matches is None:
+        top_matches = {}
+    for hits in file_hits:
+        for query_id, matches in hits.items():
+            if query_id not in top_matches:
+                top_matches[query_id] = TopMatches(top_n)
+            for genome_filename, distance in matches:
+                top_matches[query_id].add(genome_filename, distance)
+    return top_matches
+
+def search_mash_db(mash_db, query, top_n=10, max_mash_distance=0.05, processes=None):
+    """
+    Returns a dictionary mapping each query id in `query` (a FASTA or .msh file)
+    to its top (reference filename, distance) matches in mash_db.
+    mash_db is a .msh file or a shard manifest, whose shards are searched
+    concurrently with search_sketch_files.
+    """
+    if not is_shard_manifest(mash_db):
+        return _search_sketch_file((mash_db, query, top_n, max_mash_distance))
+
+    top_matches = search_sketch_files(load_shard_manifest(mash_db), query, top_n, max_mash_distance,
+                                      processes)
+    return {query_id: matches.matches() for query_id, matches in top_matches.items()}
+
+def run_mash_search(query_fasta, mash_db, top_n=10, max_mash_distance=0.05, sketch_cache=None,
+                    sketch_params=None, lsh_index=None, query_hash=None):
     """
     Runs Mash search to find the closest matches for a given query genome.
-    Filters results based on Mash distance.
+    Filters results based on Mash distance while streaming the output and
+    keeps only the best top_n in a bounded heap.
+    With a QuerySketchCache the query sketch is reused from (or added to) the
+    cache; sketch_params avoids reading them from mash_db again, and a known
+    query_hash (contig_set_hash) hashing the query again.
+    mash_db may be a shard manifest, in which case the query is sketched once
+    and all shards are searched in parallel.
+    With an LSHIndex, only the candidates it selects from its sketch database
+    are scored, in process, instead of running `mash dist` over mash_db.
     """
-    mash_cmd = f"mash dist {mash_db} {query_fasta}"
-    result = subprocess.run(mash_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if lsh_index is not None:
+        return run_lsh_mash_search(query_fasta, lsh_index, top_n, max_mash_distance, sketch_cache,
+                                   query_hash)
 
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        query = query_fasta
+        if sketch_cache is not None or is_shard_manifest(mash_db):
+            params = sketch_params or get_sketch_params(mash_db)
+            if sketch_cache is not None:
+                _, query = sketch_cache.get_or_sketch(query_fasta, params["kmer_size"],
+                                                      params["sketch_size"], query_hash)
+            else:
+                query = sketch_queries([query_fasta], os.path.join(tmp_dir, "query"),
+                                       params["kmer_size"], params["sketch_size"])
+        hits = search_mash_db(mash_db, query, top_n, max_mash_distance)
+
+    return next(iter(hits.values()), [])
+
+def run_lsh_mash_search(query_fasta, lsh_index, top_n=10, max_mash_distance=0.05, sketch_cache=None,
+                        query_hash=None):
+    """
+    Sketches the query with the parameters of the LSHIndex's sketch database
+    and scores the reference sketches the index selects for it.
+    """
+    sketch_db = lsh_index.sketch_db
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if sketch_cache is not None:
+            _, query = sketch_cache.get_or_sketch(query_fasta, sketch_db.kmer_size,
+                                                  sketch_db.sketch_size, query_hash)
+        else:
+            query = sketch_queries([query_fasta], os.path.join(tmp_dir, "query"),
+                                   sketch_db.kmer_size, sketch_db.sketch_size)
+        native_query = convert_msh(query, os.path.join(tmp_dir, "query" + NATIVE_SUFFIX))
+        queries = MinHashSketchDB(native_query)
+        matches = lsh_index.search(queries.sketch(0), top_n, max_mash_distance)
+
+    return [(os.path.basename(genome_path), distance) for genome_path, distance in matches]
+
+def parse_lineage(lineage):
+    """
+    Returns the domain..genus names of a GTDB lineage string such as
+    "d__Bacteria;p__Bacillota;...;g__Bacillus;s__Bacillus subtilis",
+    with missing or unnamed ranks (e.g. "g__") as "".
+    """
+    levels = [level.strip() for level in (lineage or "").split(";")]
+    levels = ["" if level.endswith("__") else level for level in levels]
+    levels += [""] * len(LINEAGE_RANKS)
+    return tuple(levels[:len(LINEAGE_RANKS)])
+
+def load_lineage_index(index_file):
+    """
+    Reads a lineage manifest written by lineage_sketches and returns a list of
+    (lineage levels, sub-sketch path) pairs.
+    """
+    lineages = pd.read_csv(index_file, sep="\t", keep_default_na=False)
+    base_dir = os.path.dirname(os.path.abspath(index_file))
+    return [(parse_lineage(lineage), os.path.join(base_dir, path))
+            for lineage, path in zip(lineages["lineage"], lineages["path"])]
+
+def run_lineage_mash_search(query_fasta, lineage, lineage_index, top_n=10, max_mash_distance=0.05,
+                            start_rank="genus", sketch_cache=None, sketch_params=None,
+                            processes=None, mash_db=None, max_rank=LINEAGE_MAX_RANK,
+                            query_hash=None, min_hits=None):
+    """
+    Lineage-guided Mash search for a query with a known GTDB lineage.
+    Only the sub-sketches of the query's genus (or start_rank) are searched first;
+    the search widens one rank at a time while fewer than min_hits (default top_n)
+    hits pass max_mash_distance. Above max_rank a rank spans thousands of genus files, so
+    the combined mash_db is searched once instead; without mash_db the search
+    widens up to the domain.
+
+    :param lineage: GTDB lineage string of the query.
+    :param lineage_index: Lineage manifest path, or its load_lineage_index() result.
+    :param mash_db: Combined database (a .msh file or a shard or segment manifest).
+    :return: Top (reference filename, distance) matches, as run_mash_search.
+    """
+    if isinstance(lineage_index, str):
+        lineage_index = load_lineage_index(lineage_index)
+    levels = parse_lineage(lineage)
+    params = sketch_params or get_sketch_params(lineage_index[0][1])
+
+    top_matches = {}
+    searched = set()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if sketch_cache is not None:
+            _, query = sketch_cache.get_or_sketch(query_fasta, params["kmer_size"],
+                                                  params["sketch_size"], query_hash)
+        else:
+            query = sketch_queries([query_fasta], os.path.join(tmp_dir, "query"),
+                                   params["kmer_size"], params["sketch_size"])
+        for rank in range(LINEAGE_RANKS.index(start_rank), -1, -1):
+            if mash_db is not None and rank < LINEAGE_RANKS.index(max_rank):
+                logging.info(f"🔹 Fewer than {min_hits or top_n} hits up to the {max_rank} of "
+                             f"{os.path.basename(query_fasta)}, searching {mash_db}...")
+                hits = search_mash_db(mash_db, query, top_n, max_mash_distance, processes)
+                return next(iter(hits.values()), [])
+            if not levels[rank]:
+                continue
+            sketch_files = [path for sub_levels, path in lineage_index
+                            if sub_levels[:rank + 1] == levels[:rank + 1] and path not in searched]
+            if sketch_files:
+                logging.info(f"🔹 Searching {len(sketch_files)} {LINEAGE_RANKS[rank]} sub-sketches "
+                             f"of {levels[rank]} for {os.path.basename(query_fasta)}...")
+                search_sketch_files(sketch_files, query, top_n, max_mash_distance, processes,
+                                    top_matches)
+                searched.update(sketch_files)
+            if sum(len(matches) for matches in top_matches.values()) >= (min_hits or top_n):
+                break
+
+    return next(iter(top_matches.values())).matches() if top_matches else []
+
+def load_species_index(index_file):
+    """
+    Reads a species index written by species_index and returns the path of the
+    representatives sketch and a dictionary mapping each representative's
+    filename to (species, member sketch path or None for single-genome species).
+    """
+    species_df = pd.read_csv(index_file, sep="\t", keep_default_na=False)
+    base_dir = os.path.dirname(os.path.abspath(index_file))
+    reps_sketch = index_file[:-len(SPECIES_INDEX_SUFFIX)] + SPECIES_REPS_SUFFIX
+    clusters = {os.path.basename(rep): (species, os.path.join(base_dir, path) if path else None)
+                for species, rep, path in zip(species_df["species"], species_df["representative"],
+                                              species_df["path"])}
+    return reps_sketch, clusters
+
+def run_two_tier_mash_search(query_fasta, species_index, top_n=10, max_mash_distance=0.05,
+                             max_species=5, species_radius=0.05, sketch_cache=None,
+                             sketch_params=None, processes=None, query_hash=None):
+    """
+    Two-tier Mash search. Stage one searches the sketch of one representative per
+    species, allowing species_radius on top of max_mash_distance because a close
+    member can sit that far from its representative. Stage two searches only the
+    members of the max_species closest species clusters.
+
+    :param species_index: Species index path, or its load_species_index() result.
+    :return: Top (reference filename, distance) matches, as run_mash_search.
+    """
+    if isinstance(species_index, str):
+        species_index = load_species_index(species_index)
+    reps_sketch, clusters = species_index
+    params = sketch_params or get_sketch_params(reps_sketch)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if sketch_cache is not None:
+            _, query = sketch_cache.get_or_sketch(query_fasta, params["kmer_size"],
+                                                  params["sketch_size"], query_hash)
+        else:
+            query = sketch_queries([query_fasta], os.path.join(tmp_dir, "query"),
+                                   params["kmer_size"], params["sketch_size"])
+        rep_hits = search_mash_db(reps_sketch, query, max_species,
+                                  max_mash_distance + species_radius)
+        rep_matches = next(iter(rep_hits.values()), [])
+
+        top_matches = TopMatches(top_n)
+        member_sketches = []
+        for rep_filename, distance in rep_matches:
+            species, member_sketch = clusters.get(rep_filename, (None, None))
+            if member_sketch is not None:
+                member_sketches.append(member_sketch)
+            elif distance <= max_mash_distance:
+                top_matches.add(rep_filename, distance)
+        logging.info(f"🔹 {os.path.basename(query_fasta)} matched {len(rep_matches)} species, "
+                     f"searching {len(member_sketches)} member sketches...")
+        member_hits = search_sketch_files(member_sketches, query, top_n, max_mash_distance,
+                                          processes)
+
+    for matches in member_hits.values():
+        for genome_filename, distance in matches.matches():
+            top_matches.add(genome_filename, distance)
+    return top_matches.matches()
+
+def get_sketch_params(mash_db):
+    """
+    Reads the k-mer size and sketch size of a Mash sketch database.
+    """
+    if is_shard_manifest(mash_db):
+        mash_db = load_shard_manifest(mash_db)[0]
+    result = subprocess.run(["mash", "info", "-H", mash_db], stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True)
     if result.returncode != 0:
-        raise RuntimeError(f"Error running Mash: {result.stderr}")
+        raise RuntimeError(f"Error running Mash info: {result.stderr}")
 
-    mash_results = []
-    for line in result.stdout.strip().split("\n"):
-        fields = line.split("\t")
-        if len(fields) >= 3:
-            genome_path, _, distance, *_ = fields
-            distance = float(distance)
-            genome_filename = os.path.basename(genome_path)  # Extract only filename
-            if distance <= max_mash_distance:
-                mash_results.append((genome_filename, distance))
+    params = {}
+    for line in result.stdout.split("\n"):
+        if ":" not in line:
+            continue
+        key, value = line.split(":", 1)
+        if key.strip() == "K-mer size":
+            params["kmer_size"] = int(value.split()[0])
+        elif key.strip() == "Target min-hashes per sketch":
+            params["sketch_size"] = int(value.split()[0])
+    return params
+
+def sketch_queries(query_fastas, output_prefix, kmer_size, sketch_size, threads=1):
+    """
+    Sketches all query genomes into a single .msh file with the given parameters.
+    """
+    list_file = output_prefix + "_queries.txt"
+    with open(list_file, "w") as fh:
+        fh.write("\n".join(query_fastas) + "\n")
+    sketch_cmd = ["mash", "sketch", "-k", str(kmer_size), "-s", str(sketch_size),
+                  "-p", str(threads), "-o", output_prefix, "-l", list_file]
+    result = subprocess.run(sketch_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Error running Mash sketch: {result.stderr}")
+    return output_prefix + ".msh"
+
+def build_query_sketch(query_fastas, output_prefix, kmer_size, sketch_size, sketch_cache=None,
+                       query_hashes=None):
+    """
+    Sketches the query genomes into one .msh file.
+    With a QuerySketchCache, each genome's sketch comes from the cache (named
+    after its cdm_hash, taken from query_hashes when known) and the sketches
+    are pasted together.
+    Returns (sketch path, dictionary mapping sketch names to query paths).
+    """
+    if sketch_cache is None:
+        return (sketch_queries(query_fastas, output_prefix, kmer_size, sketch_size),
+                {query_fasta: [query_fasta] for query_fasta in query_fastas})
+
+    queries_by_name = {}
+    sketch_paths = {}
+    for query_fasta in query_fastas:
+        cdm_hash, sketch_path = sketch_cache.get_or_sketch(query_fasta, kmer_size, sketch_size,
+                                                           (query_hashes or {}).get(query_fasta))
+        queries_by_name.setdefault(cdm_hash, []).append(query_fasta)
+        sketch_paths[cdm_hash] = sketch_path
+    return paste_sketches(list(sketch_paths.values()), output_prefix), queries_by_name
+
+def run_mash_search_batch(query_fastas, mash_db, top_n=10, max_mash_distance=0.05, work_dir=None,
+                          sketch_cache=None, query_hashes=None):
+    """
+    Runs one Mash search for all query genomes: the queries are sketched into a
+    single .msh with the database's sketch parameters and compared in one
+    `mash dist` call, so the database is loaded only once.
+    Returns a dictionary mapping each query path to the same top matches
+    run_mash_search would return for it.
+    Query sketches are reused from sketch_cache when one is given, keyed by
+    query_hashes (query path -> contig_set_hash) where known.
+    """
+    query_fastas = list(dict.fromkeys(query_fastas))
+    params = get_sketch_params(mash_db)
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        query_sketch, queries_by_name = build_query_sketch(
+            query_fastas, os.path.join(tmp_dir, "queries"), params["kmer_size"],
+            params["sketch_size"], sketch_cache, query_hashes)
+        hits = search_mash_db(mash_db, query_sketch, top_n, max_mash_distance)
+
+    return {query_fasta: hits.get(name, [])
+            for name, names_queries in queries_by_name.items() for query_fasta in names_queries}
+
+def run_minhash_search_batch(query_fastas, mash_db, top_n=10, max_mash_distance=0.05, work_dir=None,
+                             cache_dir=None, processes=None, sketch_cache=None, query_hashes=None):
+    """
+    Same as run_mash_search_batch, but distances are computed in process by the
+    MinHash engine over a memory-mapped native copy of mash_db instead of by
+    `mash dist`. Mash is still used to sketch the queries, or query sketches
+    are reused from sketch_cache.
+    """
+    if is_shard_manifest(mash_db):
+        raise ValueError("The MinHash engine searches a single .msh file, not a shard manifest")
+    query_fastas = list(dict.fromkeys(query_fastas))
+    sketch_db = MinHashSketchDB.from_msh(mash_db, cache_dir)
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        query_sketch, queries_by_name = build_query_sketch(
+            query_fastas, os.path.join(tmp_dir, "queries"), sketch_db.kmer_size,
+            sketch_db.sketch_size, sketch_cache, query_hashes)
+        queries = MinHashSketchDB.from_msh(query_sketch)
+        hits = sketch_db.search(queries, top_n, max_mash_distance, processes)
+
+    return {query_fasta: [(os.path.basename(genome_path), distance)
+                          for genome_path, distance in hits.get(name, [])]
+            for name, names_queries in queries_by_name.items() for query_fasta in names_queries}
+
+def reference_cdm_hash(reference_path, hash_index=None, hash_cache=None):
+    """
+    Returns the cdm_hash of a reference genome, preferring the precomputed
+    hash index, then the hash cache, and hashing the file only as a last resort.
+    """
+    if hash_index:
+        cdm_hash = hash_index.get(reference_path)
+        if cdm_hash is not None:
+            return cdm_hash
+    if hash_cache is not None:
+        return hash_cache.get_or_compute(reference_path)
+    return fasta_contig_set_hash(reference_path)
+
+def get_skani_version():
+    result = subprocess.run(["skani", "--version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Error running Skani: {result.stderr}")
+    return result.stdout.strip()
 
-    mash_results.sort(key=lambda x: x[1])
-    top_matches = mash_results[:top_n]
-    return top_matches  
+def skani_sketch_meta_path(manifest_file):
+    return manifest_file[:-len(".tsv")] + ".json"
 
-def run_skani(ref,query_fasta, reference_fasta_full_path, min_ani_threshold=95.0):
+def load_skani_sketches(manifest_file):
+    """
+    Reads a skani sketch manifest written by skani_sketches and returns a
+    dictionary mapping reference FASTA paths to their .sketch files.
+    Sketches made by a different skani version are not used.
+    """
+    with open(skani_sketch_meta_path(manifest_file)) as fh:
+        meta = json.load(fh)
+    skani_version = get_skani_version()
+    if meta.get("skani_version") != skani_version:
+        logging.info(f"⚠️ Warning: Skani sketches in {manifest_file} were made by "
+                     f"{meta.get('skani_version')}, not {skani_version}. "
+                     f"Comparing against FASTA files instead.")
+        return {}
+    sketches = pd.read_csv(manifest_file, sep="\t")
+    base_dir = os.path.dirname(os.path.abspath(manifest_file))
+    return {filepath: os.path.join(base_dir, sketch)
+            for filepath, sketch in zip(sketches["filepath"], sketches["sketch"])}
+
+def _skani_targets(reference_paths, skani_sketches=None):
+    """
+    Returns the files to pass to Skani for the reference genomes, their
+    prebuilt sketch where one exists and the FASTA file otherwise, and a
+    dictionary mapping the sketch paths back to the FASTA paths.
+    """
+    targets = []
+    fasta_by_sketch = {}
+    for path in reference_paths:
+        sketch_path = skani_sketches.get(path) if skani_sketches else None
+        if sketch_path and os.path.exists(sketch_path):
+            fasta_by_sketch[sketch_path] = path
+            path = sketch_path
+        targets.append(path)
+    return targets, fasta_by_sketch
+
+def _parse_skani_line(line):
+    """
+    Returns (reference path, skani, ani, shared_kmers) for a `skani dist`
+    output line, or None for the header and short lines.
+    Raises ValueError for a line with non-numeric values.
+    """
+    fields = line.split("\t")
+    if len(fields) < 5 or fields[2] == "ANI":
+        return None
+    return fields[0], float(fields[2]), float(fields[3]), fields[4]
+
+def _skani_record(ref, query_fasta, ref_genome_path, skani_dist, ani, shared_kmers, hash_cache=None,
+                  hash_index=None):
+    return {
+        "input_ref": ref,
+        "query": os.path.basename(query_fasta),  # Extract query filename only
+        "cdm_hash": reference_cdm_hash(ref_genome_path, hash_index, hash_cache),
+        "reference": os.path.basename(ref_genome_path),  # Extract only filename
+        "skani": skani_dist,
+        "ani": ani,
+        "shared_kmers": shared_kmers
+    }
+
+SKANI_CACHE_PARAMS = "dist"
+
+def skani_ani_cache(ani_cache):
+    """Binds a PairAniCache to the installed skani version and the `skani dist` parameters."""
+    return ani_cache.for_tool("skani", get_skani_version(), SKANI_CACHE_PARAMS)
+
+def _cached_skani_record(ref, query_fasta, ref_genome_path, cached, min_ani_threshold,
+                         hash_cache=None, hash_index=None):
+    """Returns the run_skani record for a cached pair, or None below the ANI threshold."""
+    if cached["ani"] is None or cached["aligned_fraction"] < min_ani_threshold:
+        return None
+    return _skani_record(ref, query_fasta, ref_genome_path, cached["ani"],
+                         cached["aligned_fraction"], cached["shared_kmers"], hash_cache, hash_index)
+
+def _cache_skani_results(ani_cache, query_hash, reference_paths, parsed_results):
+    """
+    Stores the parsed Skani result of every reference, and an empty result for
+    references Skani reported nothing for.
+    """
+    for path in reference_paths:
+        skani_dist, ani, shared_kmers = parsed_results.get(path, (None, None, None))
+        ani_cache.put(query_hash, path, skani_dist, ani, shared_kmers)
+
+def run_skani(ref,query_fasta, reference_fasta_full_path, min_ani_threshold=95.0, hash_cache=None,
+              hash_index=None, skani_sketches=None, ani_cache=None, query_hash=None, failures=None):
     """
     Runs Skani similarity search between a query genome and a reference genome.
     Filters results based on ANI threshold.
+    The reference cdm_hash is read from hash_index or hash_cache before hashing the file.
+    With skani_sketches (FASTA path -> .sketch file), the query is compared against
+    the reference's prebuilt sketch when it has one.
+    With ani_cache (a PairAniCache bound by skani_ani_cache), a pair compared before
+    is answered from the cache without running Skani; query_hash is the query's
+    contig_set_hash, computed when not given.
+    When Skani fails, the reference path is appended to the failures list, so the
+    caller can tell the error apart from a pair below the threshold.
     """
-    skani_cmd = f"skani dist {query_fasta} {reference_fasta_full_path}"
-    result = subprocess.run(skani_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if ani_cache is not None:
+        if query_hash is None:
+            query_hash = fasta_contig_set_hash(query_fasta, parallel=True)
+        cached = ani_cache.get(query_hash, reference_fasta_full_path)
+        if cached is not None:
+            return _cached_skani_record(ref, query_fasta, reference_fasta_full_path, cached,
+                                        min_ani_threshold, hash_cache, hash_index)
+
+    (skani_target,), fasta_by_sketch = _skani_targets([reference_fasta_full_path], skani_sketches)
+    result = run_tool(["skani", "dist", query_fasta, skani_target])
 
     if result.returncode != 0:
         logging.info(f"⚠️ Warning: Skipping {reference_fasta_full_path} due to Skani error: {result.stderr}")
+        if failures is not None:
+            failures.append(reference_fasta_full_path)
         return None
 
+    parsed_results = {}
     for line in result.stdout.strip().split("\n"):
-        fields = line.split("\t")
+        try:
+            parsed = _parse_skani_line(line)
+            if parsed is None:
+                continue
+            ref_genome_path, skani_dist, ani, shared_kmers = parsed
+            ref_genome_path = fasta_by_sketch.get(ref_genome_path, ref_genome_path)
+            parsed_results[ref_genome_path] = (skani_dist, ani, shared_kmers)
+            break
 
-        if len(fields) < 5 or fields[2] == "ANI":
-            continue
+        except ValueError:
+            logging.info(f"⚠️ Warning: Skipping invalid Skani result line - {line}")
+
+    if ani_cache is not None:
+        _cache_skani_results(ani_cache, query_hash, [reference_fasta_full_path], parsed_results)
+    for ref_genome_path, (skani_dist, ani, shared_kmers) in parsed_results.items():
+        if ani >= min_ani_threshold:
+            return _skani_record(ref, query_fasta, ref_genome_path, skani_dist, ani, shared_kmers,
+                                 hash_cache, hash_index)
+
+    return None  
 
+def run_skani_batch(ref, query_fasta, reference_paths, min_ani_threshold=95.0, hash_cache=None,
+                    hash_index=None, work_dir=None, skani_sketches=None, ani_cache=None,
+                    query_hash=None):
+    """
+    Compares a query genome against all its Mash candidates in one `skani dist`
+    call, passing the references as a list file, so the query is sketched once.
+    Returns a dictionary mapping each reference path that passes the ANI
+    threshold to the same record run_skani returns for it, or None when Skani
+    fails, so the caller can fall back to run_skani per reference.
+    Prebuilt reference sketches from skani_sketches and cached pairs from
+    ani_cache are used as in run_skani; Skani only runs for uncached pairs.
+    """
+    records = {}
+    if ani_cache is not None:
+        if query_hash is None:
+            query_hash = fasta_contig_set_hash(query_fasta, parallel=True)
+        uncached_paths = []
+        for path in reference_paths:
+            cached = ani_cache.get(query_hash, path)
+            if cached is None:
+                uncached_paths.append(path)
+                continue
+            record = _cached_skani_record(ref, query_fasta, path, cached, min_ani_threshold,
+                                          hash_cache, hash_index)
+            if record is not None:
+                records[path] = record
+        reference_paths = uncached_paths
+        if not reference_paths:
+            return records
+
+    targets, fasta_by_sketch = _skani_targets(reference_paths, skani_sketches)
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        list_file = os.path.join(tmp_dir, "references.txt")
+        with open(list_file, "w") as fh:
+            fh.write("\n".join(targets) + "\n")
+        result = run_tool(["skani", "dist", "-q", query_fasta, "--rl", list_file])
+
+    if result.returncode != 0:
+        logging.info(f"⚠️ Warning: Batched Skani failed for {query_fasta}: {result.stderr}")
+        return None
+
+    parsed_results = {}
+    for line in result.stdout.strip().split("\n"):
         try:
-            ref_genome_path = fields[0]
-            skani_dist = float(fields[2])
-            ani = float(fields[3])
-            shared_kmers = fields[4]
-
-            query_filename = os.path.basename(query_fasta)  # Extract query filename only
-            if ani >= min_ani_threshold:
-                contigs = read_fasta2(ref_genome_path)
-                cdm_hash = contig_set_hash(contigs)
-                return {
-                    "input_ref": ref,
-                    "query": query_filename,
-                    "cdm_hash":cdm_hash,
-                    "reference": os.path.basename(ref_genome_path),  # Extract only filename
-                    "skani": skani_dist,
-                    "ani": ani,
-                    "shared_kmers": shared_kmers
-                }
+            parsed = _parse_skani_line(line)
+            if parsed is None:
+                continue
+            ref_genome_path, skani_dist, ani, shared_kmers = parsed
+            ref_genome_path = fasta_by_sketch.get(ref_genome_path, ref_genome_path)
+            if ref_genome_path not in parsed_results:
+                parsed_results[ref_genome_path] = (skani_dist, ani, shared_kmers)
 
         except ValueError:
             logging.info(f"⚠️ Warning: Skipping invalid Skani result line - {line}")
 
-    return None  
+    if ani_cache is not None:
+        _cache_skani_results(ani_cache, query_hash, reference_paths, parsed_results)
+    for ref_genome_path, (skani_dist, ani, shared_kmers) in parsed_results.items():
+        if ani >= min_ani_threshold:
+            records[ref_genome_path] = _skani_record(ref, query_fasta, ref_genome_path, skani_dist,
+                                                     ani, shared_kmers, hash_cache, hash_index)
 
-def mash_skani_pipeline(ref_fasta_path_dict, mash_db, taxonomy_file, ws_url, workspace_name, provenance, top_n=10, 
-                        max_mash_distance=0.05, min_ani_threshold=95.0, 
-                        output_csv="mash_skani_results.csv"):
+    return records
+
+def find_exact_matches(ref, query_fasta, genomes_by_hash, taxonomy_dict, top_n=10, query_hash=None):
     """
-    Runs Mash search, followed by Skani similarity search, and appends taxonomy data.
-    Processes multiple query genomes.
-    
+    Looks up the query's contig_set_hash in the cdm_hash -> genomes lookup and
+    returns result records (ANI 100, Mash distance 0) for identical CDM genomes.
+    A query_hash computed earlier is used instead of hashing the query again.
+    """
+    if query_hash is None:
+        query_hash = fasta_contig_set_hash(query_fasta, parallel=True)
+    query_filename = os.path.basename(query_fasta)
+    exact_results = []
+    for ref_genome_path in genomes_by_hash.get(query_hash, [])[:top_n]:
+        ref_genome_filename = os.path.basename(ref_genome_path)
+        _, taxonomy = taxonomy_dict.get(ref_genome_filename, (None, "Unknown"))
+        exact_results.append({
+            "input_ref": ref,
+            "query": query_filename,
+            "cdm_hash": query_hash,
+            "reference": ref_genome_filename,
+            "skani": 100.0,
+            "ani": 100.0,
+            "shared_kmers": 100.0,
+            "mash_distance": 0.0,
+            "taxonomy": taxonomy
+        })
+    return exact_results
+
+def _fingerprint(values):
+    return hashlib.sha256(json.dumps(values, sort_keys=True).encode()).hexdigest()[:16]
+
+def reference_db_version(mash_db, taxonomy_file, hash_index_file=None, lineage_index=None,
+                         species_index=None, lsh_index=None):
+    """
+    Identifies the reference database a result was computed against by the
+    names, sizes and modification times of the Mash database (with the .msh,
+    taxonomy and hash index files of its shards or segments), the taxonomy file
+    and the hash, lineage, species and LSH indexes the search used. As in
+    pipeline_fingerprint, the LSH index only counts without a species index.
+    """
+    paths = [mash_db, taxonomy_file, hash_index_file, lineage_index, species_index,
+             os.path.join(lsh_index, "meta.json") if lsh_index and not species_index else None]
+    if is_shard_manifest(mash_db) and os.path.exists(mash_db):
+        paths += load_shard_manifest(mash_db)
+        if is_segment_manifest(mash_db):
+            segments = load_segment_manifest(mash_db)
+            paths += list(segments["taxonomy"]) + list(segments["hash_index"])
+    keys = [[os.path.basename(path)] + (msh_file_key(path) if os.path.exists(path) else [])
+            for path in paths if path]
+    return _fingerprint(keys)
+
+def pipeline_fingerprint(top_n, max_mash_distance, min_ani_threshold, full_search=False,
+                         lineage_index=None, species_index=None, lsh_index=None,
+                         lsh_min_band_hits=1, lsh_max_candidates=None, max_hits=None,
+                         deepen_max_distance=None, deepen_step=None):
+    """
+    Fingerprint of the mash_skani_pipeline parameters that change the results of
+    a query. Options that only change how fast they are found (batching,
+    engines, caches, workers) are left out.
+    """
+    return _fingerprint({
+        "top_n": int(top_n), "max_mash_distance": float(max_mash_distance),
+        "min_ani_threshold": float(min_ani_threshold), "full_search": bool(full_search),
+        "lineage_prefilter": bool(lineage_index), "two_tier": bool(species_index),
+        "lsh": [lsh_min_band_hits, lsh_max_candidates] if lsh_index and not species_index else None,
+        "max_hits": max_hits, "deepen_max_distance": deepen_max_distance,
+        "deepen_step": deepen_step if deepen_max_distance is not None else None,
+    })
+
+class SearchOptions(_NamedTuple):
+    '''
+    Options of mash_skani_pipeline beyond the number of Mash candidates and the
+    Mash distance and ANI thresholds.
+    '''
+
+    full_search: bool = False
+    ''' Also search queries identical to a CDM genome for their near neighbours. '''
+
+    hash_index_file: str = None
+    ''' Precomputed reference cdm_hashes (see hash_index), also used for exact matches. '''
+
+    batch_mash: bool = False
+    ''' Search all unguided queries with a single `mash dist` call. '''
+
+    mash_engine: str = "mash"
+    ''' "minhash" computes Mash distances in process (see minhash_engine). '''
+
+    minhash_cache_dir: str = None
+    ''' Where the minhash engine keeps its native copy of the Mash database. '''
+
+    lineage_index: str = None
+    ''' Lineage sub-sketches searched for queries with a GTDB lineage (see lineage_sketches). '''
+
+    species_index: str = None
+    ''' Species clusters for the two-tier search of the other queries (see species_index). '''
+
+    lsh_index: str = None
+    ''' Banded MinHash index directory selecting the candidates to score (see lsh_index). '''
+
+    lsh_min_band_hits: int = 1
+    ''' Bands a reference must share with the query to be a candidate. '''
+
+    lsh_max_candidates: int = None
+    ''' Most candidates taken from the LSH index. '''
+
+    batch_skani: bool = False
+    ''' Compare each query against all its Mash candidates in one `skani dist` call. '''
+
+    skani_sketch_db: str = None
+    ''' Manifest of prebuilt reference Skani sketches (see skani_sketches). '''
 
+    query_workers: int = 1
+    ''' Threads the queries are searched on; rows keep the input order. '''
+
+    max_hits: int = None
+    ''' Stop verifying the candidates of a query once this many hits are confirmed. '''
+
+    deepen_max_distance: float = None
+    ''' Check further candidates up to this Mash distance until max_hits (or one) hit is found. '''
+
+    deepen_step: int = None
+    ''' Candidates added at each deepening step, top_n when not given. '''
+
+    tool_limits: dict = None
+    ''' Concurrent Mash searches and Skani processes, e.g. {"mash": 2, "skani": 4}
+        (see tool_limits). '''
+
+    force_refresh: bool = False
+    ''' Search all queries again instead of reusing stored results. '''
+
+    def guided(self, mash_db):
+        """Returns the options with only the guided search indexes usable with mash_db."""
+        lineage_index, species_index, lsh_index = guided_search_indexes(
+            mash_db, self.lineage_index, self.species_index, self.lsh_index)
+        return self._replace(lineage_index=lineage_index, species_index=species_index,
+                             lsh_index=lsh_index)
+
+    def db_version(self, mash_db, taxonomy_file):
+        """The reference_db_version of mash_db with the indexes of these options."""
+        return reference_db_version(mash_db, taxonomy_file, self.hash_index_file,
+                                    self.lineage_index, self.species_index, self.lsh_index)
+
+    def fingerprint(self, top_n, max_mash_distance, min_ani_threshold):
+        """The pipeline_fingerprint of these options."""
+        return pipeline_fingerprint(top_n, max_mash_distance, min_ani_threshold, self.full_search,
+                                    self.lineage_index, self.species_index, self.lsh_index,
+                                    self.lsh_min_band_hits, self.lsh_max_candidates, self.max_hits,
+                                    self.deepen_max_distance, self.deepen_step)
+
+def best_hit_rows(current_hits, taxonomy_dict=None):
+    """
+    Result rows for genomes skipped because their object metadata already holds
+    a current cdm_best_hit (see KBaseObjectUtils.get_current_cdm_best_hits),
+    used when the result memo no longer has their full results. The taxonomy
+    of the hit is looked up in taxonomy_dict; its Mash distance is not known.
+    """
+    rows = []
+    for ref, (query, _, best_hit) in current_hits.items():
+        row = {"input_ref": ref, "query": query}
+        if best_hit:
+            row.update({"cdm_hash": best_hit.get("cdm_hash"), "reference": best_hit.get("name"),
+                        "skani": best_hit.get("skani"), "ani": best_hit.get("ani"),
+                        "shared_kmers": best_hit.get("shared_kmers")})
+            if taxonomy_dict is not None:
+                row["taxonomy"] = taxonomy_dict.get(best_hit.get("name"), (None, "Unknown"))[1]
+        rows.append(row)
+    return rows
+
+def _input_order(ref_list, skipped_refs, searched_refs):
+    """
+    Orders the skipped and searched genomes as their refs (or the sets holding
+    them) appear in ref_list. The genomes of a set follow each other in
+    searched_refs, in the place of the set.
+    """
+    requested = set(ref_list)
+    remaining = deque(ref for ref in searched_refs if ref not in skipped_refs)
+    searched = set(remaining)
+    order = {}
+    for ref in ref_list:
+        if ref in skipped_refs:
+            order[ref] = None
+        elif ref in searched:
+            while ref not in order:
+                order[remaining.popleft()] = None
+        else:
+            while remaining and remaining[0] not in requested:
+                order[remaining.popleft()] = None
+    order.update(dict.fromkeys(remaining))
+    return list(order)
+
+def _ordered_map(executor, fn, items, max_pending):
+    """
+    Like executor.map, but submits at most max_pending items ahead of the one
+    being consumed, so finished results wait in a bounded queue when the
+    consumer is slower than the workers.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def ordered_outputs(fn, refs, workers=1):
+    """
+    Yields fn(ref) for each of refs, in order. With more than one worker, refs
+    are processed on that many threads, up to 2 * workers ahead of the consumer.
+    """
+    if workers <= 1:
+        yield from map(fn, refs)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        yield from _ordered_map(executor, fn, refs, 2 * workers)
+
+def stored_query_results(result_memo, query_hashes, query_names, fingerprint, db_version):
+    """
+    Returns the (rows, hits) result_memo holds for the queries in query_names
+    (ref -> query file name), by ref, looked up by their query_hashes.
+    """
+    stored_outputs = {}
+    for ref, query in query_names.items():
+        stored = result_memo.get(query_hashes[ref], fingerprint, db_version, ref, query)
+        if stored is not None:
+            stored_outputs[ref] = stored
+    return stored_outputs
+
+def skipped_query_results(current_hits, taxonomy_dict, result_memo=None, fingerprint=None,
+                          db_version=None):
+    """
+    Returns the (rows, hits) of the genomes skipped with a current cdm_best_hit,
+    by ref, from result_memo, or rebuilt from the best hit when it does not
+    hold them (see best_hit_rows).
+    """
+    stored_outputs = {}
+    for ref, (query, cdm_hash, best_hit) in current_hits.items():
+        stored = None
+        if result_memo is not None and cdm_hash:
+            stored = result_memo.get(cdm_hash, fingerprint, db_version, ref, query)
+        if stored is None:
+            stored = (best_hit_rows({ref: (query, cdm_hash, best_hit)}, taxonomy_dict), [])
+        stored_outputs[ref] = stored
+    return stored_outputs
+
+def mash_skani_pipeline(ref_fasta_path_dict, mash_db, taxonomy_file, ws_url, workspace_name,
+                        provenance, top_n=10, max_mash_distance=0.05, min_ani_threshold=95.0,
+                        output_csv="mash_skani_results.csv", options=None, query_lineages=None,
+                        hash_cache=None, sketch_cache=None, ani_cache=None, result_memo=None,
+                        current_hits=None, ref_list=None):
+    """
+    Runs Mash search, followed by Skani similarity search, and appends taxonomy data.
+    Processes multiple query genomes, searched as set out in options (a SearchOptions).
+    Genomes in current_hits are not searched again (see skipped_query_results).
     """
+    current_hits = current_hits or {}
+    options = (options or SearchOptions()).guided(mash_db)
+    if query_lineages is None:
+        options = options._replace(lineage_index=None)
+
+    lineage_sub_sketches = []
+    if options.lineage_index and query_lineages:
+        lineage_sub_sketches = load_lineage_index(options.lineage_index)
+        logging.info(f"Loaded {len(lineage_sub_sketches)} lineage sub-sketches "
+                     f"from {options.lineage_index}")
+    species_clusters = None
+    if options.species_index:
+        species_clusters = load_species_index(options.species_index)
+        logging.info(f"Loaded {len(species_clusters[1])} species clusters "
+                     f"from {options.species_index}")
+    lsh = None
+    if species_clusters is None and options.lsh_index:
+        try:
+            lsh = LSHIndex(options.lsh_index, options.lsh_min_band_hits, options.lsh_max_candidates,
+                           None if is_shard_manifest(mash_db) else mash_db)
+            logging.info(f"Loaded LSH index with {lsh.bands} bands of {lsh.rows} rows "
+                         f"from {options.lsh_index}")
+        except ValueError as e:
+            logging.info(f"⚠️ Warning: {e}. Searching without the LSH index.")
+            options = options._replace(lsh_index=None)
+    db_version = options.db_version(mash_db, taxonomy_file)
+    fingerprint = options.fingerprint(top_n, max_mash_distance, min_ani_threshold)
+    # Each query's contig_set_hash is computed once and shared by the result memo, the exact-match
+    # lookup, the query sketch cache and the Skani ANI cache
+    query_hashes = {}
+
+    def query_hash(ref):
+        if ref not in query_hashes:
+            query_hashes[ref] = fasta_contig_set_hash(ref_fasta_path_dict[ref], parallel=True)
+        return query_hashes[ref]
+
+    stored_outputs = {}
+    if result_memo is not None:
+        with ThreadPoolExecutor(max_workers=max(options.query_workers, 1)) as executor:
+            query_hashes.update(zip(ref_fasta_path_dict,
+                                    executor.map(query_hash, ref_fasta_path_dict)))
+        if not options.force_refresh:
+            query_names = {ref: os.path.basename(query_fasta)
+                           for ref, query_fasta in ref_fasta_path_dict.items()}
+            stored_outputs = stored_query_results(result_memo, query_hashes, query_names,
+                                                  fingerprint, db_version)
+        logging.info(f"🔹 Reusing stored results for {len(stored_outputs)} of "
+                     f"{len(ref_fasta_path_dict)} queries")
+    search_fasta_paths = {ref: query_fasta for ref, query_fasta in ref_fasta_path_dict.items()
+                          if ref not in stored_outputs}
 
-    taxonomy_dict = load_taxonomy_data(taxonomy_file)
+    hash_index = None
+    genomes_by_hash = {}
+    if is_segment_manifest(mash_db):
+        segments = load_segment_manifest(mash_db)
+        taxonomy_dict = {}
+        for segment_taxonomy in segments["taxonomy"]:
+            taxonomy_dict.update(load_taxonomy_data(segment_taxonomy))
+        segment_indices = [path for path in segments["hash_index"] if path and os.path.exists(path)]
+        if segment_indices:
+            hash_index = {}
+            for segment_index in segment_indices:
+                hash_index.update(load_hash_index(segment_index))
+        logging.info(f"Loaded {len(segments)} segments with {len(taxonomy_dict)} genomes "
+                     f"from {mash_db}")
+    else:
+        taxonomy_dict = load_taxonomy_data(taxonomy_file)
+        if options.hash_index_file and os.path.exists(options.hash_index_file):
+            hash_index = load_hash_index(options.hash_index_file)
+    if hash_index:
+        genomes_by_hash = invert_hash_index(hash_index)
+        logging.info(f"Loaded {len(hash_index)} precomputed hashes")
+    skani_sketches = None
+    if options.skani_sketch_db and os.path.exists(options.skani_sketch_db):
+        skani_sketches = load_skani_sketches(options.skani_sketch_db)
+        logging.info(f"Loaded {len(skani_sketches)} prebuilt Skani sketches "
+                     f"from {options.skani_sketch_db}")
+    stored_outputs.update(skipped_query_results(current_hits, taxonomy_dict, result_memo,
+                                                fingerprint, db_version))
     all_results = []
 
-    for ref in ref_fasta_path_dict:
+    exact_results_by_ref = {}
+    for ref, query_fasta in search_fasta_paths.items():
+        exact_results_by_ref[ref] = []
+        if genomes_by_hash:
+            exact_results_by_ref[ref] = find_exact_matches(ref, query_fasta, genomes_by_hash,
+                                                           taxonomy_dict, top_n, query_hash(ref))
+    mash_queries = [query_fasta for ref, query_fasta in search_fasta_paths.items()
+                    if options.full_search or not exact_results_by_ref[ref]]
+
+    lineage_refs = {ref for ref, query_fasta in search_fasta_paths.items()
+                    if lineage_sub_sketches and query_lineages.get(ref)
+                    and query_fasta in mash_queries}
+    unguided_queries = [query_fasta for ref, query_fasta in search_fasta_paths.items()
+                        if ref not in lineage_refs and query_fasta in mash_queries
+                        and species_clusters is None and lsh is None]
+
+    # With deepening, each query is searched once for all candidates up to the distance ceiling,
+    # which are then verified top_n (and later deepen_step) at a time
+    mash_n, mash_distance = top_n, max_mash_distance
+    if options.deepen_max_distance is not None:
+        mash_n = DEEPEN_MAX_CANDIDATES
+        mash_distance = max(max_mash_distance, options.deepen_max_distance)
+    batch_mash_hits = {}
+    known_hashes = {ref_fasta_path_dict[ref]: cdm_hash for ref, cdm_hash in query_hashes.items()}
+    if options.mash_engine == "minhash" and unguided_queries:
+        logging.info(f"🔹 Running in-process Mash search on {len(unguided_queries)} queries "
+                     f"against {mash_db}...")
+        batch_mash_hits = run_minhash_search_batch(unguided_queries, mash_db, mash_n, mash_distance,
+                                                   os.path.dirname(os.path.abspath(output_csv)),
+                                                   options.minhash_cache_dir,
+                                                   sketch_cache=sketch_cache,
+                                                   query_hashes=known_hashes)
+    elif options.batch_mash and len(unguided_queries) > 1:
+        logging.info(f"🔹 Running batched Mash search on {len(unguided_queries)} queries "
+                     f"against {mash_db}...")
+        batch_mash_hits = run_mash_search_batch(unguided_queries, mash_db, mash_n, mash_distance,
+                                                os.path.dirname(os.path.abspath(output_csv)),
+                                                sketch_cache, known_hashes)
+    sketch_params = None
+    if sketch_cache is not None and unguided_queries and not batch_mash_hits:
+        sketch_params = get_sketch_params(mash_db)
+
+    skani_cache = skani_ani_cache(ani_cache) if ani_cache is not None else None
+    work_dir = os.path.dirname(os.path.abspath(output_csv))
+
+    def find_mash_matches(ref, query_fasta, n_matches, max_distance):
+        # The whole Mash stage of a query holds one "mash" slot, so shard or lineage searches that
+        # fork their own worker processes count once
+        with tool_slot("mash"):
+            return _find_mash_matches(ref, query_fasta, n_matches, max_distance)
+
+    def _find_mash_matches(ref, query_fasta, n_matches, max_distance):
+        """Returns the n_matches closest CDM genomes of a query with the search selected for it."""
+        query_filename = os.path.basename(query_fasta)
+        if query_fasta in batch_mash_hits and (n_matches, max_distance) == (mash_n, mash_distance):
+            return batch_mash_hits[query_fasta]
+        cdm_hash = query_hash(ref) if sketch_cache is not None else None
+        if ref in lineage_refs:
+            logging.info(f"🔹 Running lineage-guided Mash search on {query_filename} "
+                         f"({query_lineages[ref]})...")
+            return run_lineage_mash_search(query_fasta, query_lineages[ref], lineage_sub_sketches,
+                                           n_matches, max_distance, sketch_cache=sketch_cache,
+                                           mash_db=mash_db, query_hash=cdm_hash, min_hits=top_n)
+        if species_clusters is not None:
+            logging.info(f"🔹 Running two-tier Mash search on {query_filename}...")
+            return run_two_tier_mash_search(query_fasta, species_clusters, n_matches, max_distance,
+                                            sketch_cache=sketch_cache, query_hash=cdm_hash)
+        if lsh is not None:
+            logging.info(f"🔹 Running LSH-guided Mash search on {query_filename}...")
+            return run_mash_search(query_fasta, mash_db, n_matches, max_distance, sketch_cache,
+                                   lsh_index=lsh, query_hash=cdm_hash)
+        logging.info(f"🔹 Running Mash search on {query_filename} against {mash_db}...")
+        return run_mash_search(query_fasta, mash_db, n_matches, max_distance, sketch_cache,
+                               sketch_params, query_hash=cdm_hash)
+
+    def search_query(ref):
+        """
+        Runs the searches of one query and returns its result rows, its hit metadata and
+        whether a Skani comparison failed, in which case the result may be incomplete.
+        """
         query_fasta = ref_fasta_path_dict[ref]
         query_filename = os.path.basename(query_fasta)  # Extract query filename only
-        logging.info(f"🔹 Running Mash search on {query_filename} against {mash_db}...")
-        top_matches = run_mash_search(query_fasta, mash_db, top_n, max_mash_distance)
+        cdm_hash = query_hash(ref) if skani_cache is not None else query_hashes.get(ref)
 
         ref_cdm_hits_metadata = list()
+        query_results = []
+        skani_failures = []
         count_hits = 0
-        for ref_genome_filename, mash_dist in top_matches:
-            # Retrieve the full path for Skani
-            ref_genome_full_path, taxonomy = taxonomy_dict.get(ref_genome_filename, (None, "Unknown"))
-            
-            if ref_genome_full_path is None:
-                logging.info(f"⚠️ Warning: No full path found for {ref_genome_filename}. Skipping.")
-                continue
+        exact_references = set()
+        for exact_result in exact_results_by_ref[ref]:
+            logging.info(f"🔹 {query_filename} is identical to CDM genome "
+                         f"{exact_result['reference']}")
+            count_hits += 1
+            exact_references.add(exact_result["reference"])
+            ref_cdm_hits_metadata.append({"cdm_hash":exact_result["cdm_hash"],
+                                          "skani":exact_result['skani'],
+                                          "ani":exact_result['ani'],
+                                          "shared_kmers":exact_result['shared_kmers'],
+                                          "name":exact_result["reference"]
+                                          })
+            query_results.append(exact_result)
+
+        hit_target = options.max_hits or (1 if options.deepen_max_distance is not None else None)
+        if query_fasta not in mash_queries or (hit_target is not None and count_hits >= hit_target):
+            mash_matches = []
+        else:
+            mash_matches = find_mash_matches(ref, query_fasta, mash_n, mash_distance)
+        top_matches = [match for match in mash_matches[:top_n] if match[1] <= max_mash_distance]
+
+        # Candidates are verified in Mash distance order; with a hit target, Skani stops once it is
+        # reached and, with deepen_max_distance, further candidates are taken from the Mash matches
+        # in batches of deepen_step
+        seen_references = set(exact_references)
+        n_matches = top_n
+        while True:
+            skani_candidates = []
+            for ref_genome_filename, mash_dist in top_matches:
+                if ref_genome_filename in seen_references:
+                    continue
+                seen_references.add(ref_genome_filename)
+                # Retrieve the full path for Skani
+                ref_genome_full_path, taxonomy = taxonomy_dict.get(ref_genome_filename,
+                                                                   (None, "Unknown"))
+
+                if ref_genome_full_path is None:
+                    logging.info(f"⚠️ Warning: No full path found for {ref_genome_filename}. "
+                                 "Skipping.")
+                    continue
+                skani_candidates.append((ref_genome_filename, mash_dist, ref_genome_full_path,
+                                         taxonomy))
+
+            while skani_candidates and (hit_target is None or count_hits < hit_target):
+                # Never verify more candidates at once than hits are still needed
+                chunk_size = (len(skani_candidates) if hit_target is None
+                              else hit_target - count_hits)
+                chunk = skani_candidates[:chunk_size]
+                skani_candidates = skani_candidates[chunk_size:]
 
-            logging.info(f"🔹 Running Skani for {query_filename} vs {ref_genome_filename}...")
-            skani_result = run_skani(ref,query_fasta, ref_genome_full_path, min_ani_threshold)
-            if skani_result:
-                count_hits += 1
-                ref_cdm_hits_metadata.append({"cdm_hash":skani_result["cdm_hash"], "skani":skani_result['skani'],
-                                              "ani":skani_result['ani'], "shared_kmers":skani_result['shared_kmers'],
-                                              "name":ref_genome_filename
-                                              })
-                skani_result["query"] = query_filename  # Store query filename
-                skani_result["mash_distance"] = mash_dist
-                skani_result["taxonomy"] = taxonomy  # Match taxonomy
-                all_results.append(skani_result)
+                batch_skani_results = None
+                if options.batch_skani and len(chunk) > 1:
+                    logging.info(f"🔹 Running Skani for {query_filename} vs {len(chunk)} "
+                                 "Mash candidates...")
+                    batch_skani_results = run_skani_batch(ref, query_fasta,
+                                                          [candidate[2] for candidate in chunk],
+                                                          min_ani_threshold, hash_cache, hash_index,
+                                                          work_dir, skani_sketches, skani_cache,
+                                                          cdm_hash)
+
+                for ref_genome_filename, mash_dist, ref_genome_full_path, taxonomy in chunk:
+                    if batch_skani_results is not None:
+                        skani_result = batch_skani_results.get(ref_genome_full_path)
+                    else:
+                        logging.info(f"🔹 Running Skani for {query_filename} vs "
+                                     f"{ref_genome_filename}...")
+                        skani_result = run_skani(ref,query_fasta, ref_genome_full_path,
+                                                 min_ani_threshold, hash_cache, hash_index,
+                                                 skani_sketches, skani_cache, cdm_hash,
+                                                 skani_failures)
+                    if skani_result:
+                        count_hits += 1
+                        ref_cdm_hits_metadata.append({"cdm_hash":skani_result["cdm_hash"],
+                                                      "skani":skani_result['skani'],
+                                                      "ani":skani_result['ani'],
+                                                      "shared_kmers":skani_result['shared_kmers'],
+                                                      "name":ref_genome_filename
+                                                      })
+                        skani_result["query"] = query_filename  # Store query filename
+                        skani_result["mash_distance"] = mash_dist
+                        skani_result["taxonomy"] = taxonomy  # Match taxonomy
+                        query_results.append(skani_result)
+
+            if options.deepen_max_distance is None or count_hits >= hit_target \
+                    or n_matches >= len(mash_matches):
+                break  # Done, or no further candidates within the distance ceiling
+            n_matches += options.deepen_step or top_n
+            logging.info(f"🔹 {count_hits} of {hit_target} hits for {query_filename}, checking "
+                         f"{n_matches} candidates within distance {mash_distance}...")
+            top_matches = mash_matches[:n_matches]
         if count_hits == 0:
             skani_result = {"input_ref":ref,
                            "query":query_filename}
-            all_results.append(skani_result)
+            query_results.append(skani_result)
+        return query_results, ref_cdm_hits_metadata, bool(skani_failures)
+
+    def query_output(ref):
+        if ref in stored_outputs:
+            return stored_outputs[ref] + (False,)
+        query_results, ref_cdm_hits_metadata, failed = search_query(ref)
+        # A Skani error is not a "no hit": such results are not stored, so the query is searched
+        # again on the next run. A failed Mash search raises and stops the run before anything is
+        # stored.
+        if result_memo is not None and not failed:
+            result_memo.put(query_hashes[ref], fingerprint, db_version, query_results,
+                            ref_cdm_hits_metadata)
+        return query_results, ref_cdm_hits_metadata, failed
+
+    set_tool_limits(options.tool_limits)
+    # Queries are searched on up to query_workers threads; results are consumed in input order, so
+    # the CSV matches a serial run while metadata writes overlap with the searches of later queries
+    refs = _input_order(ref_list or list(current_hits), current_hits, ref_fasta_path_dict)
+    workers = options.query_workers if len(search_fasta_paths) > 1 else 1
+    query_outputs = ordered_outputs(query_output, refs, workers)
+    for ref, (query_results, ref_cdm_hits_metadata, failed) in zip(refs, query_outputs):
+        all_results.extend(query_results)
+        if ref in current_hits:
+            continue
         logging.info(f" =========Now appending Metadata appended to {ref}===============")
-        append_metadata_to_object(ref, ws_url, workspace_name, ref_cdm_hits_metadata,  provenance)
+        # Without the database version and fingerprint, a result that may be incomplete is
+        # never taken as current by the next run
+        append_metadata_to_object(ref, ws_url, workspace_name, ref_cdm_hits_metadata,  provenance,
+                                  None if failed else db_version, None if failed else fingerprint,
+                                  os.path.basename(ref_fasta_path_dict[ref]), query_hashes.get(ref))
     
+    if ani_cache is not None:
+        ani_cache.log_stats("Skani ANI cache")
+
     df = pd.DataFrame(all_results)
     df.fillna("", inplace=True)
     df.to_csv(output_csv, index=False)
@@ -1,7 +1,32 @@
+import os
 import subprocess
+import tempfile
 import pandas as pd
 
-def run_mash_search(query_fasta, mash_db, top_n=10, max_mash_distance=0.05):
+from .minhash_engine import MinHashSketchDB
+
+def run_minhash_search(query_fasta, mash_db, top_n=10, max_mash_distance=0.05, cache_dir=None):
+    """
+    In-process equivalent of run_mash_search using the MinHash engine.
+    The query is sketched with the database's parameters and compared against
+    a memory-mapped native copy of the Mash database.
+    """
+    sketch_db = MinHashSketchDB.from_msh(mash_db, cache_dir)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        prefix = os.path.join(tmp_dir, "query")
+        sketch_cmd = ["mash", "sketch", "-k", str(sketch_db.kmer_size),
+                      "-s", str(sketch_db.sketch_size), "-o", prefix, query_fasta]
+        result = subprocess.run(sketch_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"Error running Mash sketch: {result.stderr}")
+        queries = MinHashSketchDB.from_msh(prefix + ".msh")
+        hits = sketch_db.search(queries, top_n, max_mash_distance)
+    return [genome for genome, _ in hits.get(query_fasta, [])]
+
+
+def run_mash_search(query_fasta, mash_db, top_n=10, max_mash_distance=0.05, engine="mash",
+                    minhash_cache_dir=None):
     """
     Runs Mash search to find the closest matches for a given query genome.
     Filters results based on Mash distance.
@@ -10,8 +35,13 @@ def run_mash_search(query_fasta, mash_db, top_n=10, max_mash_distance=0.05):
     :param mash_db: Path to the Mash database (.msh file).
     :param top_n: Number of top matches to return.
     :param max_mash_distance: Maximum Mash distance allowed.
+    :param engine: "mash" to run `mash dist`, "minhash" for the in-process engine.
+    :param minhash_cache_dir: Where the MinHash engine keeps its native copy of mash_db.
     :return: List of top matching genome paths.
     """
+    if engine == "minhash":
+        return run_minhash_search(query_fasta, mash_db, top_n, max_mash_distance, minhash_cache_dir)
+
     mash_cmd = f"mash dist {mash_db} {query_fasta}"
     result = subprocess.run(mash_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
 
@@ -68,7 +98,9 @@ def run_skani(query_fasta, reference_fasta, min_ani_threshold=95.0):
     return None
 
 
-def mash_skani_pipeline(query_fasta, mash_db, top_n=10, max_mash_distance=0.05, min_ani_threshold=95.0, output_csv="mash_skani_results.csv"):
+def mash_skani_pipeline(query_fasta, mash_db, top_n=10, max_mash_distance=0.05,
+                        min_ani_threshold=95.0, output_csv="mash_skani_results.csv", engine="mash",
+                        minhash_cache_dir=None):
     """
     Runs Mash search to find top matches and then Skani to refine similarity scores.
     Applies filtering based on Mash distance and ANI threshold.
@@ -79,10 +111,14 @@ def mash_skani_pipeline(query_fasta, mash_db, top_n=10, max_mash_distance=0.05,
     :param max_mash_distance: Maximum Mash distance allowed.
     :param min_ani_threshold: Minimum ANI required for Skani results.
     :param output_csv: Path to save the final results.
+    :param engine: Mash search engine, "mash" or "minhash".
+    :param minhash_cache_dir: Where the MinHash engine keeps its native copy of mash_db.
     :return: DataFrame with results.
     """
-    print(f"Running Mash search on {query_fasta} against {mash_db} with max Mash distance {max_mash_distance}...")
-    top_matches = run_mash_search(query_fasta, mash_db, top_n, max_mash_distance)
+    print(f"Running Mash search on {query_fasta} against {mash_db} "
+          f"with max Mash distance {max_mash_distance}...")
+    top_matches = run_mash_search(query_fasta, mash_db, top_n, max_mash_distance, engine,
+                                  minhash_cache_dir)
 
     results = []
     for ref_genome in top_matches:
@@ -0,0 +1,339 @@
+"""
+In-process Mash distance engine over a native copy of a .msh sketch file.
+
+Each `mash dist` call deserializes the whole 410k-genome sketch database.
+Here the database is converted once (through `mash info -d`) into a native
+layout that is memory-mapped afterwards, `<db>.msh.minhash/`:
+
+    hashes.u64   all sketch hashes as little-endian uint64, sorted per sketch
+    offsets.npy  start of each sketch in hashes.u64 (n + 1 entries)
+    lengths.npy  genome length of each sketch
+    names.txt    sketch names, one per line
+    meta.json    k-mer size, sketch size, hash bits and the source file key
+
+Distances are computed with vectorized NumPy kernels over chunks of
+sketches in worker processes and follow `mash dist` exactly: the shared
+count is taken over the bottom-s of the union of the two sketches and the
+distance is -ln(2j / (1 + j)) / k. The conversion can be run offline with
+
+    python -m kb_cdm_genome_match.utils2.minhash_engine --db combined.msh
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+import numpy as np
+
+from .tool_limits import pool_context
+
+logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
+                            level=logging.INFO)
+
+NATIVE_SUFFIX = ".minhash"
+CHUNK_SKETCHES = 2048
+
+_KEY_RE = re.compile(r'^\s*"(\w+)"\s*:\s*(.*?),?\s*$')
+_HASH_RE = re.compile(r'^\s*(\d+),?\s*$')
+
+# Sketch database and query sketches opened by pool worker processes
+_WORKER_STATE = {}
+
+
+def native_sketch_dir(msh_path, cache_dir=None):
+    """
+    Returns where the native copy of a .msh file is kept: next to it, or in
+    cache_dir when the database lives on read-only reference data.
+    """
+    if cache_dir is None:
+        return msh_path + NATIVE_SUFFIX
+    return os.path.join(cache_dir, os.path.basename(msh_path) + NATIVE_SUFFIX)
+
+
+def msh_file_key(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def write_native_sketches(dump_lines, out_dir, file_key=None):
+    """
+    Converts `mash info -d` JSON output, read line by line so the 410k
+    sketches are never held in memory at once, into the native layout.
+
+    :param dump_lines: Iterable of `mash info -d` output lines.
+    :param out_dir: Directory to write the native layout to.
+    :param file_key: [size, mtime_ns] of the source .msh, used to detect stale copies.
+    :return: Number of sketches written.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    meta = {"file_key": file_key}
+    offsets = [0]
+    lengths = []
+    sketch = None
+    array_key = None
+    hashes = []
+    with open(os.path.join(out_dir, "hashes.u64"), "wb") as hash_fh, \
+            open(os.path.join(out_dir, "names.txt"), "w") as name_fh:
+        for line in dump_lines:
+            if array_key is not None:
+                match = _HASH_RE.match(line)
+                if match:
+                    if array_key == "hashes":
+                        hashes.append(int(match.group(1)))
+                    continue
+                if line.strip().startswith("]"):
+                    array_key = None
+                continue
+            match = _KEY_RE.match(line)
+            if not match:
+                stripped = line.strip()
+                if stripped.startswith("}") and sketch is not None:
+                    hash_array = np.sort(np.array(hashes, dtype="<u8"))
+                    hash_array.tofile(hash_fh)
+                    offsets.append(offsets[-1] + len(hash_array))
+                    lengths.append(int(sketch.get("length", 0)))
+                    name_fh.write(sketch["name"] + "\n")
+                    sketch, hashes = None, []
+                elif stripped.startswith("{") and "sketches" in meta:
+                    sketch = {}
+                continue
+            key, value = match.groups()
+            if value in ("", "["):
+                array_key = key
+                if key == "sketches":
+                    meta["sketches"] = True
+                    array_key = None
+            elif sketch is not None:
+                sketch[key] = json.loads(value)
+            else:
+                meta[key] = json.loads(value)
+
+    meta = {"kmer_size": int(meta["kmer"]), "sketch_size": int(meta["sketchSize"]),
+            "hash_bits": int(meta.get("hashBits", 64)), "file_key": file_key}
+    np.save(os.path.join(out_dir, "offsets.npy"), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(out_dir, "lengths.npy"), np.array(lengths, dtype=np.int64))
+    with open(os.path.join(out_dir, "meta.json"), "w") as fh:
+        json.dump(meta, fh)
+    return len(lengths)
+
+
+def convert_msh(msh_path, out_dir):
+    """
+    Streams `mash info -d` for a .msh file into the native layout, writing to
+    a temporary directory first so a crashed conversion leaves nothing behind.
+    """
+    parent = os.path.dirname(os.path.abspath(out_dir))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix=os.path.basename(out_dir) + ".")
+    try:
+        with tempfile.TemporaryFile(mode="w+") as err:
+            proc = subprocess.Popen(["mash", "info", "-d", msh_path], stdout=subprocess.PIPE,
+                                    stderr=err, universal_newlines=True)
+            try:
+                count = write_native_sketches(proc.stdout, tmp_dir, msh_file_key(msh_path))
+            finally:
+                proc.stdout.close()
+                if proc.wait() != 0:
+                    err.seek(0)
+                    raise RuntimeError(f"Error running Mash info: {err.read()}")
+        if os.path.exists(out_dir):
+            shutil.rmtree(out_dir)
+        os.replace(tmp_dir, out_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    logging.info(f"Converted {count} sketches from {msh_path} to {out_dir}")
+    return out_dir
+
+
+def sketch_distances(query, hashes, offsets, sketch_size, kmer_size):
+    """
+    Mash distances between one query sketch and a run of reference sketches.
+
+    A shared hash counts when its rank in the union of both sketches is below
+    sketch_size, which is what the merge loop in `mash dist` computes.
+
+    :param query: Sorted uint64 hashes of the query sketch.
+    :param hashes: Sorted-per-sketch uint64 hashes of the reference sketches.
+    :param offsets: Start of each reference sketch in hashes (n + 1 entries, from 0).
+    :return: Tuple of (distances, shared counts, union sizes) arrays.
+    """
+    n = len(offsets) - 1
+    sizes = np.diff(offsets)
+    seg = np.repeat(np.arange(n), sizes)
+    rank_in_ref = np.arange(len(hashes)) - np.repeat(offsets[:-1], sizes)
+    below = np.searchsorted(query, hashes)
+    if len(query):
+        shared = query[np.minimum(below, len(query) - 1)] == hashes
+    else:
+        shared = np.zeros(len(hashes), dtype=bool)
+    shared_cum = np.concatenate(([0], np.cumsum(shared)))
+    shared_before = shared_cum[:-1] - np.repeat(shared_cum[offsets[:-1]], sizes)
+    union_rank = rank_in_ref + below - shared_before
+    counted = shared & (union_rank < sketch_size)
+
+    common = np.bincount(seg, weights=counted, minlength=n).astype(np.int64)
+    total_shared = np.bincount(seg, weights=shared, minlength=n).astype(np.int64)
+    denom = np.minimum(sketch_size, sizes + len(query) - total_shared)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        jaccard = common / denom
+        distances = -np.log(2 * jaccard / (1 + jaccard)) / kmer_size
+    distances[common == 0] = 1.0
+    distances[common == denom] = 0.0
+    return distances, common, denom
+
+
+class MinHashSketchDB:
+    """
+    Memory-mapped native copy of a Mash sketch file.
+
+    :param native_dir: Directory written by write_native_sketches.
+    """
+
+    def __init__(self, native_dir):
+        self.native_dir = native_dir
+        with open(os.path.join(native_dir, "meta.json")) as fh:
+            self.meta = json.load(fh)
+        self.kmer_size = self.meta["kmer_size"]
+        self.sketch_size = self.meta["sketch_size"]
+        self.offsets = np.load(os.path.join(native_dir, "offsets.npy"))
+        self.lengths = np.load(os.path.join(native_dir, "lengths.npy"), mmap_mode="r")
+        hash_file = os.path.join(native_dir, "hashes.u64")
+        if self.offsets[-1]:
+            self.hashes = np.memmap(hash_file, dtype="<u8", mode="r")
+        else:
+            self.hashes = np.zeros(0, dtype="<u8")
+        with open(os.path.join(native_dir, "names.txt")) as fh:
+            self.names = [line.rstrip("\n") for line in fh]
+
+    @classmethod
+    def from_msh(cls, msh_path, cache_dir=None):
+        """
+        Opens the native copy of a .msh file, converting it first when it is
+        missing or older than the .msh file.
+        """
+        native_dir = native_sketch_dir(msh_path, cache_dir)
+        if cache_dir is not None and not os.path.exists(native_dir):
+            # A copy prebuilt next to the database is used as is
+            prebuilt = native_sketch_dir(msh_path)
+            if cls._is_fresh(prebuilt, msh_path):
+                return cls(prebuilt)
+        if not cls._is_fresh(native_dir, msh_path):
+            convert_msh(msh_path, native_dir)
+        return cls(native_dir)
+
+    @staticmethod
+    def _is_fresh(native_dir, msh_path):
+        try:
+            with open(os.path.join(native_dir, "meta.json")) as fh:
+                return json.load(fh)["file_key"] == msh_file_key(msh_path)
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def __len__(self):
+        return len(self.names)
+
+    def sketch(self, i):
+        return np.asarray(self.hashes[self.offsets[i]:self.offsets[i + 1]])
+
+    def chunk_distances(self, query, lo, hi):
+        """
+        Distances from a query sketch to reference sketches lo..hi-1.
+        """
+        start = self.offsets[lo]
+        hashes = np.asarray(self.hashes[start:self.offsets[hi]])
+        distances, _, _ = sketch_distances(query, hashes, self.offsets[lo:hi + 1] - start,
+                                           self.sketch_size, self.kmer_size)
+        return distances
+
+    def subset_distances(self, query, indices):
+        """
+        Distances from a query sketch to the reference sketches at indices.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.offsets[indices]
+        sizes = self.offsets[indices + 1] - starts
+        local_offsets = np.concatenate(([0], np.cumsum(sizes)))
+        positions = np.repeat(starts - local_offsets[:-1], sizes) + np.arange(local_offsets[-1])
+        hashes = np.asarray(self.hashes[positions]) if len(positions) else np.zeros(0, dtype="<u8")
+        distances, _, _ = sketch_distances(query, hashes, local_offsets, self.sketch_size,
+                                           self.kmer_size)
+        return distances
+
+    def search(self, queries, top_n=10, max_mash_distance=0.05, processes=None,
+               chunk_sketches=CHUNK_SKETCHES):
+        """
+        Finds the closest reference sketches for each query sketch.
+
+        :param queries: MinHashSketchDB holding the query sketches.
+        :param processes: Number of worker processes (default: all cpus, 1 runs inline).
+        :return: Dictionary mapping each query name to its top (reference name,
+                 distance) pairs, ordered as a stable sort of `mash dist` output.
+        """
+        if queries.kmer_size != self.kmer_size:
+            raise ValueError(f"Query k-mer size {queries.kmer_size} does not match "
+                             f"database k-mer size {self.kmer_size}")
+        query_hashes = [queries.sketch(i) for i in range(len(queries))]
+        tasks = [(lo, min(lo + chunk_sketches, len(self)), top_n, max_mash_distance)
+                 for lo in range(0, len(self), chunk_sketches)]
+        processes = processes or os.cpu_count()
+        if processes == 1 or len(tasks) <= 1:
+            _init_worker(self, query_hashes)
+            chunk_hits = [_search_chunk(task) for task in tasks]
+            _WORKER_STATE.clear()
+        else:
+            worker_args = (self.native_dir, query_hashes)
+            with pool_context().Pool(processes, _init_worker, worker_args) as pool:
+                chunk_hits = pool.map(_search_chunk, tasks)
+
+        results = {}
+        for q, name in enumerate(queries.names):
+            indices = np.concatenate([hits[q][0] for hits in chunk_hits] or [np.zeros(0, np.int64)])
+            distances = np.concatenate([hits[q][1] for hits in chunk_hits] or [np.zeros(0)])
+            order = np.argsort(distances, kind="stable")[:max(top_n, 0)]
+            results[name] = [(self.names[indices[i]], float(distances[i])) for i in order]
+        return results
+
+
+def _init_worker(sketch_db, query_hashes):
+    if not isinstance(sketch_db, MinHashSketchDB):
+        sketch_db = MinHashSketchDB(sketch_db)
+    _WORKER_STATE["db"] = sketch_db
+    _WORKER_STATE["queries"] = query_hashes
+
+
+def _search_chunk(task):
+    """
+    Best hits of every query within one chunk of reference sketches, as
+    (reference indices, distances) arrays in database order.
+    """
+    lo, hi, top_n, max_mash_distance = task
+    sketch_db = _WORKER_STATE["db"]
+    hits = []
+    for query in _WORKER_STATE["queries"]:
+        distances = sketch_db.chunk_distances(query, lo, hi)
+        passing = np.flatnonzero(distances <= max_mash_distance)
+        best = passing[np.argsort(distances[passing], kind="stable")[:max(top_n, 0)]]
+        best.sort()
+        hits.append((best + lo, distances[best]))
+    return hits
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert a Mash sketch file into the native "
+                                                 "layout used by the in-process distance engine.")
+    parser.add_argument("--db", required=True, help="Path to the .msh sketch file")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Directory for the native copy (default: next to the .msh file)")
+    args = parser.parse_args(argv)
+
+    convert_msh(args.db, native_sketch_dir(args.db, args.cache_dir))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
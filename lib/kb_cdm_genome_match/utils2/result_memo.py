@@ -0,0 +1,63 @@
+import json
+import sqlite3
+import logging
+
+from .hash_cache import DEFAULT_EVICT_INTERVAL, SqliteLruCache
+
+logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
+                            level=logging.INFO)
+
+DEFAULT_MAX_ENTRIES = 200000
+
+
+class QueryResultMemo(SqliteLruCache):
+    """
+    On-disk SQLite store of the final mash_skani_pipeline results of a query,
+    keyed by the query's contig_set_hash, the search parameter fingerprint and
+    the reference database version (see pipeline_fingerprint and
+    reference_db_version in mash_skani_multiple). A genome run again with the
+    same parameters against the same database is answered from the store.
+
+    Result rows are stored without their input_ref and query filename, which
+    are filled in for the object being searched, so a stored result also
+    serves the same genome saved as a different object. Store errors are
+    logged and never fail a run.
+    """
+    table = "query_results"
+    schema = """query_hash TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                db_version TEXT NOT NULL,
+                results TEXT NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (query_hash, fingerprint, db_version)"""
+    key_columns = ("query_hash", "fingerprint", "db_version")
+
+    def __init__(self, db_path, max_entries=DEFAULT_MAX_ENTRIES, timeout=60.0,
+                 evict_interval=DEFAULT_EVICT_INTERVAL):
+        super().__init__(db_path, max_entries, timeout, evict_interval)
+
+    def get(self, query_hash, fingerprint, db_version, ref, query_filename):
+        """
+        Returns the stored (result rows, hit metadata) of a query with the
+        rows addressed to ref and query_filename, or None when not stored.
+        """
+        try:
+            row = self._select(["results"], (query_hash, fingerprint, db_version))
+        except sqlite3.Error as e:
+            logging.info(f"⚠️ Warning: Query result lookup failed for {query_filename}: {e}")
+            return None
+        if row is None:
+            return None
+        results = json.loads(row[0])
+        rows = [{"input_ref": ref, "query": query_filename, **result} for result in results["rows"]]
+        return rows, results["hits"]
+
+    def put(self, query_hash, fingerprint, db_version, rows, hits_metadata):
+        results = json.dumps({"rows": [{key: value for key, value in row.items()
+                                        if key not in ("input_ref", "query")} for row in rows],
+                              "hits": hits_metadata}, default=float)
+        try:
+            self._insert({"query_hash": query_hash, "fingerprint": fingerprint,
+                          "db_version": db_version, "results": results})
+        except sqlite3.Error as e:
+            logging.info(f"⚠️ Warning: Could not store query results for {query_hash}: {e}")
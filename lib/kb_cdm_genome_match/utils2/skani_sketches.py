@@ -0,0 +1,132 @@
+"""
+Prebuilt Skani sketches of the CDM reference genomes.
+
+Every genome in the taxonomy TSV is sketched once with `skani sketch`, in
+parts of batch_size genomes (`part_0001/`, ...) so an interrupted build
+resumes with the next part. A `<name>.skani.tsv` manifest maps each
+genome to its sketch:
+
+    filepath  sketch
+
+and `<name>.skani.json` records the skani version and the Mash database the
+sketches were built for, so both are versioned together. Sketches from a
+different skani version are ignored by load_skani_sketches. run_skani then
+compares queries against the sketches instead of re-reading and sketching
+the reference FASTA files, and uses the FASTA only for genomes without a
+sketch, such as those added later as delta segments. Built offline with
+
+    python -m kb_cdm_genome_match.utils2.skani_sketches \\
+        --taxonomy /data/.../cdm_genomes_paths_taxonomy.tsv \\
+        --mash-db /data/.../combined_gtdb_sketch_410303_genome.msh \\
+        --output-dir /data/.../skani --threads 32
+
+Rebuild into an empty directory when the taxonomy TSV changes.
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import time
+
+import pandas as pd
+
+from .mash_skani_multiple import SKANI_SKETCHES_SUFFIX, get_skani_version, skani_sketch_meta_path
+from .minhash_engine import msh_file_key
+from .sketch_shards import write_manifest
+
+logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
+                            level=logging.INFO)
+
+BATCH_SIZE = 10000
+SKANI_SKETCH_SUFFIX = ".sketch"
+
+
+def sketch_part(filepaths, part_dir, threads=1):
+    """
+    Sketches a batch of genomes into part_dir unless it already exists,
+    writing to a temporary directory first so a partial part is never kept.
+    """
+    if os.path.exists(part_dir):
+        return part_dir
+    tmp_dir = part_dir + ".tmp"
+    list_file = part_dir + ".txt"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    with open(list_file, "w") as fh:
+        fh.write("\n".join(filepaths) + "\n")
+    sketch_cmd = ["skani", "sketch", "-l", list_file, "-o", tmp_dir, "-t", str(threads)]
+    result = subprocess.run(sketch_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    os.remove(list_file)
+    if result.returncode != 0:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise RuntimeError(f"Error running Skani sketch: {result.stderr}")
+    os.replace(tmp_dir, part_dir)
+    return part_dir
+
+
+def build_skani_sketches(taxonomy_file, mash_db, output_dir, threads=1, batch_size=BATCH_SIZE,
+                         manifest_name=None):
+    """
+    Sketches all genomes of the taxonomy TSV with Skani and writes the sketch
+    manifest and its version record. Genomes Skani could not sketch are left
+    out of the manifest and are compared through their FASTA file.
+
+    :param taxonomy_file: Path to cdm_genomes_paths_taxonomy.tsv.
+    :param mash_db: Mash database the sketches are versioned with.
+    :param output_dir: Directory for the sketch parts, manifest and version record.
+    :param threads: Threads passed to `skani sketch`.
+    :return: Path of the sketch manifest.
+    """
+    filepaths = pd.read_csv(taxonomy_file, sep="\t", usecols=["filepath"])["filepath"].tolist()
+    os.makedirs(output_dir, exist_ok=True)
+    if manifest_name is None:
+        manifest_name = os.path.splitext(os.path.basename(mash_db))[0]
+    manifest_file = os.path.join(output_dir, manifest_name + SKANI_SKETCHES_SUFFIX)
+
+    rows = []
+    parts = range(0, len(filepaths), batch_size)
+    for n, start in enumerate(parts, 1):
+        batch = filepaths[start:start + batch_size]
+        part = f"part_{n:04d}"
+        logging.info(f"Skani sketch part {n}/{len(parts)} ({len(batch)} genomes)")
+        sketch_part(batch, os.path.join(output_dir, part), threads)
+        for filepath in batch:
+            sketch = os.path.join(part, os.path.basename(filepath) + SKANI_SKETCH_SUFFIX)
+            if os.path.exists(os.path.join(output_dir, sketch)):
+                rows.append([filepath, sketch])
+    if len(rows) < len(filepaths):
+        logging.info(f"⚠️ Warning: {len(filepaths) - len(rows)} genomes have no Skani sketch")
+
+    write_manifest(manifest_file, ["filepath", "sketch"], rows)
+    meta_file = skani_sketch_meta_path(manifest_file)
+    with open(meta_file + ".tmp", "w") as fh:
+        json.dump({"skani_version": get_skani_version(), "mash_db": os.path.basename(mash_db),
+                   "mash_db_file_key": msh_file_key(mash_db), "genomes": len(rows),
+                   "created": time.strftime("%Y-%m-%dT%H:%M:%S")}, fh, indent=2)
+    os.replace(meta_file + ".tmp", meta_file)
+    logging.info(f"Skani sketch manifest with {len(rows)} genomes saved to {manifest_file}")
+    return manifest_file
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Prebuild Skani sketches of the CDM reference genomes.")
+    parser.add_argument("--taxonomy", required=True, help="Path to cdm_genomes_paths_taxonomy.tsv")
+    parser.add_argument("--mash-db", required=True,
+                        help="Mash database the sketches are versioned with")
+    parser.add_argument("--output-dir", required=True,
+                        help="Directory for the sketches and manifest")
+    parser.add_argument("--threads", type=int, default=1, help="Threads for skani sketch")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="Genomes per sketch part")
+    args = parser.parse_args(argv)
+
+    build_skani_sketches(args.taxonomy, args.mash_db, args.output_dir, args.threads,
+                         args.batch_size)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,130 @@
+"""
+On-disk cache of Mash query sketches.
+
+Each query genome is sketched once per (contig_set_hash, k-mer size, sketch
+size) into `<cache_dir>/<cdm_hash>_k<k>_s<s>.msh`. The sketch is named after
+the cdm_hash rather than the FASTA path, so a cached sketch can be reused for
+the same genome downloaded to a different path, and `mash dist` output can be
+mapped back to every query that shares it. File modification times record
+the last use; least recently used sketches are evicted once the cache grows
+beyond max_bytes.
+"""
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+
+from .fasta_index import fasta_contig_set_hash
+
+logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
+                            level=logging.INFO)
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+SKETCH_SUFFIX = ".msh"
+
+
+def sketch_genome(fasta_path, output_prefix, kmer_size, sketch_size, name):
+    """
+    Sketches one genome into `<output_prefix>.msh` with the sketch named `name`.
+    Mash names a sketch after the input path it was given, so the genome is
+    sketched through a symlink called `name` in a scratch directory.
+    """
+    scratch_parent = os.path.dirname(os.path.abspath(output_prefix))
+    with tempfile.TemporaryDirectory(dir=scratch_parent) as tmp_dir:
+        os.symlink(os.path.abspath(fasta_path), os.path.join(tmp_dir, name))
+        sketch_cmd = ["mash", "sketch", "-k", str(kmer_size), "-s", str(sketch_size),
+                      "-o", os.path.abspath(output_prefix), name]
+        result = subprocess.run(sketch_cmd, cwd=tmp_dir, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Error running Mash sketch: {result.stderr}")
+    return output_prefix + SKETCH_SUFFIX
+
+
+def paste_sketches(sketch_paths, output_prefix):
+    """
+    Combines single-genome sketches into one .msh file with `mash paste`.
+    """
+    paste_cmd = ["mash", "paste", output_prefix] + list(sketch_paths)
+    result = subprocess.run(paste_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Error running Mash paste: {result.stderr}")
+    return output_prefix + SKETCH_SUFFIX
+
+
+class QuerySketchCache:
+    """
+    Byte-bounded LRU cache of query sketches keyed by cdm_hash and sketch parameters.
+
+    :param cache_dir: Directory holding the cached sketches.
+    :param max_bytes: Total size above which least recently used sketches are removed.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path_for(self, cdm_hash, kmer_size, sketch_size):
+        return os.path.join(self.cache_dir,
+                            f"{cdm_hash}_k{kmer_size}_s{sketch_size}{SKETCH_SUFFIX}")
+
+    def get(self, cdm_hash, kmer_size, sketch_size):
+        """
+        Returns the cached sketch path, marking it as recently used, or None.
+        """
+        path = self.path_for(cdm_hash, kmer_size, sketch_size)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def get_or_sketch(self, fasta_path, kmer_size, sketch_size, cdm_hash=None):
+        """
+        Returns (cdm_hash, sketch path) for a query genome, sketching it with
+        Mash on a cache miss.
+        """
+        if cdm_hash is None:
+            cdm_hash = fasta_contig_set_hash(fasta_path, parallel=True)
+        path = self.get(cdm_hash, kmer_size, sketch_size)
+        if path is not None:
+            return cdm_hash, path
+
+        path = self.path_for(cdm_hash, kmer_size, sketch_size)
+        tmp_prefix = f"{path[:-len(SKETCH_SUFFIX)]}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            sketch_path = sketch_genome(fasta_path, tmp_prefix, kmer_size, sketch_size, cdm_hash)
+            os.replace(sketch_path, path)
+        finally:
+            if os.path.exists(tmp_prefix + SKETCH_SUFFIX):
+                os.remove(tmp_prefix + SKETCH_SUFFIX)
+        self._evict(keep=path)
+        return cdm_hash, path
+
+    def _evict(self, keep=None):
+        """
+        Removes least recently used sketches until the cache fits in max_bytes.
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(SKETCH_SUFFIX) and ".tmp" not in entry.name:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                # Already evicted by a concurrent job
+                pass
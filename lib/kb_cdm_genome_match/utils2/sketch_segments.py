@@ -0,0 +1,250 @@
+"""
+Incremental updates of the CDM Mash sketch database as delta segments.
+
+A segmented database is described by a `<name>.segments.tsv` manifest:
+
+    segment  path  taxonomy  hash_index  genomes
+
+The first row is the base (the combined .msh, the taxonomy TSV and its
+cdm_hash index) and every later row a delta segment holding newly added
+genomes, each with its own sketch, taxonomy rows and precomputed hashes.
+Passing the manifest as mash_db to run_mash_search or mash_skani_pipeline
+searches all segments together, and the pipeline reads the taxonomy and
+hashes of every segment. The lineage, species and LSH indexes are built from
+the base only, so while there are delta segments the pipeline searches
+without them. Compaction pastes the segments into a new base
+and removes the merged delta files; run it while no searches are running.
+
+    python -m kb_cdm_genome_match.utils2.sketch_segments init \\
+        --mash-db /data/.../combined_gtdb_sketch_410303_genome.msh \\
+        --taxonomy /data/.../cdm_genomes_paths_taxonomy.tsv --output-dir /data/.../segments
+    python -m kb_cdm_genome_match.utils2.sketch_segments append \\
+        --manifest /data/.../segments/combined_gtdb_sketch_410303_genome.segments.tsv \\
+        --genomes new_genomes_taxonomy.tsv --threads 32
+    python -m kb_cdm_genome_match.utils2.sketch_segments compact \\
+        --manifest /data/.../segments/combined_gtdb_sketch_410303_genome.segments.tsv
+
+where new_genomes_taxonomy.tsv has the columns of the taxonomy TSV.
+"""
+import argparse
+import csv
+import logging
+import os
+
+import pandas as pd
+
+from .hash_index import (HASH_INDEX_COLUMNS, build_hash_index, default_hash_index_path,
+                         load_hash_index)
+from .mash_skani_multiple import SEGMENT_MANIFEST_SUFFIX, get_sketch_params, load_segment_manifest
+from .sketch_cache import paste_sketches
+from .sketch_shards import sketch_shard, write_manifest
+
+logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
+                            level=logging.INFO)
+
+SEGMENT_COLUMNS = ["segment", "path", "taxonomy", "hash_index", "genomes"]
+DELTA_PREFIX = "delta_"
+
+
+def _manifest_rows(manifest_file):
+    """
+    Returns the manifest rows with paths relative to the manifest directory
+    where possible, so the segment directory can be moved as a whole.
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_file))
+    rows = []
+    for _, segment in load_segment_manifest(manifest_file).iterrows():
+        rows.append([segment["segment"]] +
+                    [_relative_path(segment[column], base_dir)
+                     for column in ("path", "taxonomy", "hash_index")] +
+                    [int(segment["genomes"])])
+    return rows
+
+
+def _relative_path(path, base_dir):
+    if path and os.path.dirname(os.path.abspath(path)) == base_dir:
+        return os.path.basename(path)
+    return path
+
+
+def _segment_filepaths(segments):
+    filepaths = set()
+    for taxonomy_file in segments["taxonomy"]:
+        filepaths.update(pd.read_csv(taxonomy_file, sep="\t", usecols=["filepath"])["filepath"])
+    return filepaths
+
+
+def init_segments(mash_db, taxonomy_file, output_dir, hash_index_file=None, manifest_name=None):
+    """
+    Writes a segment manifest whose only segment is the existing combined
+    database. The base files are referenced in place, not copied.
+
+    :return: Path of the segment manifest.
+    """
+    if hash_index_file is None:
+        hash_index_file = default_hash_index_path(taxonomy_file)
+    os.makedirs(output_dir, exist_ok=True)
+    if manifest_name is None:
+        manifest_name = os.path.splitext(os.path.basename(mash_db))[0]
+    manifest_file = os.path.join(output_dir, manifest_name + SEGMENT_MANIFEST_SUFFIX)
+    if os.path.exists(manifest_file):
+        raise ValueError(f"Segment manifest {manifest_file} already exists")
+
+    genomes = len(pd.read_csv(taxonomy_file, sep="\t", usecols=["filepath"]))
+    write_manifest(manifest_file, SEGMENT_COLUMNS,
+                   [["base", os.path.abspath(mash_db), os.path.abspath(taxonomy_file),
+                     os.path.abspath(hash_index_file) if os.path.exists(hash_index_file) else "",
+                     genomes]])
+    logging.info(f"Segment manifest for {genomes} base genomes saved to {manifest_file}")
+    return manifest_file
+
+
+def append_segment(manifest_file, genomes_file, threads=1, processes=None):
+    """
+    Adds the genomes of genomes_file (rows in the taxonomy TSV layout) that are
+    not yet in the database as a new delta segment: their sketches with the
+    base sketch parameters, their taxonomy rows and their cdm_hash index.
+    The manifest is only updated once all three are written, so a failed
+    append leaves the database unchanged and can be rerun.
+
+    :param threads: Threads passed to `mash sketch`.
+    :param processes: Worker processes for hashing (default: all cpus).
+    :return: Name of the new segment, or None when there was nothing to add.
+    """
+    segments = load_segment_manifest(manifest_file)
+    known = _segment_filepaths(segments)
+    new_genomes = pd.read_csv(genomes_file, sep="\t", dtype=str, keep_default_na=False)
+    duplicated = new_genomes["filepath"].isin(known) | new_genomes["filepath"].duplicated()
+    if duplicated.any():
+        logging.info(f"⚠️ Warning: Skipping {int(duplicated.sum())} genomes already in the "
+                     f"database")
+    new_genomes = new_genomes[~duplicated]
+    if new_genomes.empty:
+        logging.info("No new genomes to add")
+        return None
+
+    output_dir = os.path.dirname(os.path.abspath(manifest_file))
+    numbers = [int(name[len(DELTA_PREFIX):]) for name in segments["segment"]
+               if name.startswith(DELTA_PREFIX) and name[len(DELTA_PREFIX):].isdigit()]
+    segment = f"{DELTA_PREFIX}{max(numbers, default=0) + 1:04d}"
+    taxonomy_file = os.path.join(output_dir, segment + ".tsv")
+    sketch_path = os.path.join(output_dir, segment + ".msh")
+    new_genomes.to_csv(taxonomy_file, sep="\t", index=False)
+    # A sketch left by a failed append may hold a different set of genomes
+    if os.path.exists(sketch_path):
+        os.remove(sketch_path)
+
+    params = get_sketch_params(segments["path"].iloc[0])
+    logging.info(f"Sketching {len(new_genomes)} genomes into segment {segment}")
+    sketch_shard(new_genomes["filepath"].tolist(), sketch_path, params["kmer_size"],
+                 params["sketch_size"], threads)
+    hash_index_file, failed = build_hash_index(taxonomy_file, processes=processes)
+    if failed:
+        raise RuntimeError(f"{failed} genomes of segment {segment} could not be hashed, "
+                           f"rerun to retry them")
+
+    rows = _manifest_rows(manifest_file)
+    rows.append([segment, os.path.basename(sketch_path), os.path.basename(taxonomy_file),
+                 os.path.basename(hash_index_file), len(new_genomes)])
+    write_manifest(manifest_file, SEGMENT_COLUMNS, rows)
+    logging.info(f"Segment {segment} with {len(new_genomes)} genomes added to {manifest_file}")
+    return segment
+
+
+def compact_segments(manifest_file):
+    """
+    Merges the base and all delta segments into a new base segment: the
+    sketches are pasted with `mash paste` and the taxonomy rows and hashes
+    concatenated in segment order. The merged delta segments and any earlier
+    compacted base are removed afterwards; the original base files are left
+    in place.
+
+    :return: Name of the new base segment, or None when there were no deltas.
+    """
+    segments = load_segment_manifest(manifest_file)
+    if len(segments) < 2:
+        logging.info("No delta segments to compact")
+        return None
+
+    output_dir = os.path.dirname(os.path.abspath(manifest_file))
+    manifest_name = os.path.basename(manifest_file)[:-len(SEGMENT_MANIFEST_SUFFIX)]
+    numbers = [int(name.rsplit("_", 1)[1]) for name in segments["segment"]
+               if name.startswith("base_") and name.rsplit("_", 1)[1].isdigit()]
+    segment = f"base_{max(numbers, default=0) + 1:04d}"
+    prefix = os.path.join(output_dir, f"{manifest_name}.{segment}")
+
+    logging.info(f"Compacting {len(segments)} segments into {segment}")
+    sketch_path = paste_sketches(segments["path"].tolist(), prefix + ".tmp")
+    os.replace(sketch_path, prefix + ".msh")
+
+    taxonomy = pd.concat([pd.read_csv(path, sep="\t", dtype=str, keep_default_na=False)
+                          for path in segments["taxonomy"]], ignore_index=True, sort=False)
+    taxonomy.fillna("").to_csv(prefix + ".tsv.tmp", sep="\t", index=False)
+    os.replace(prefix + ".tsv.tmp", prefix + ".tsv")
+
+    hash_index_file = ""
+    segment_indices = [path for path in segments["hash_index"] if path and os.path.exists(path)]
+    if segment_indices:
+        hash_index = {}
+        for path in segment_indices:
+            hash_index.update(load_hash_index(path))
+        hash_index_file = default_hash_index_path(prefix + ".tsv")
+        with open(hash_index_file + ".tmp", "w", newline="") as fh:
+            writer = csv.writer(fh, delimiter="\t", lineterminator="\n")
+            writer.writerow(HASH_INDEX_COLUMNS)
+            writer.writerows((path, hash_index[path]) for path in taxonomy["filepath"]
+                             if path in hash_index)
+        os.replace(hash_index_file + ".tmp", hash_index_file)
+
+    write_manifest(manifest_file, SEGMENT_COLUMNS,
+                   [[segment, os.path.basename(prefix + ".msh"), os.path.basename(prefix + ".tsv"),
+                     os.path.basename(hash_index_file), len(taxonomy)]])
+
+    # Only files written by append_segment or an earlier compaction are removed
+    owned_prefixes = (DELTA_PREFIX, f"{manifest_name}.base_")
+    for column in ("path", "taxonomy", "hash_index"):
+        for path in segments[column]:
+            if path and os.path.dirname(path) == output_dir and \
+                    os.path.basename(path).startswith(owned_prefixes) and os.path.exists(path):
+                os.remove(path)
+    logging.info(f"Compacted {len(taxonomy)} genomes into segment {segment} of {manifest_file}")
+    return segment
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Maintain a CDM Mash sketch database as a base plus delta segments.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    init_parser = commands.add_parser("init",
+                                      help="Start a segment manifest from the combined database")
+    init_parser.add_argument("--mash-db", required=True, help="Combined .msh database")
+    init_parser.add_argument("--taxonomy", required=True,
+                             help="Path to cdm_genomes_paths_taxonomy.tsv")
+    init_parser.add_argument("--hash-index", default=None,
+                             help="cdm_hash index (default: sidecar TSV)")
+    init_parser.add_argument("--output-dir", required=True,
+                             help="Directory for the manifest and segments")
+
+    append_parser = commands.add_parser("append", help="Add new genomes as a delta segment")
+    append_parser.add_argument("--manifest", required=True, help="Segment manifest")
+    append_parser.add_argument("--genomes", required=True,
+                               help="Taxonomy TSV rows of the new genomes")
+    append_parser.add_argument("--threads", type=int, default=1, help="Threads for mash sketch")
+    append_parser.add_argument("--processes", type=int, default=None, help="Hashing processes")
+
+    compact_parser = commands.add_parser("compact", help="Merge the delta segments into a new base")
+    compact_parser.add_argument("--manifest", required=True, help="Segment manifest")
+    args = parser.parse_args(argv)
+
+    if args.command == "init":
+        init_segments(args.mash_db, args.taxonomy, args.output_dir, args.hash_index)
+    elif args.command == "append":
+        append_segment(args.manifest, args.genomes, args.threads, args.processes)
+    else:
+        compact_segments(args.manifest)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
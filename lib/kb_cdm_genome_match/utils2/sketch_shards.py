@@ -0,0 +1,142 @@
+"""
+Splits the CDM Mash sketch database into shards that can be searched in parallel.
+
+Genomes listed in the taxonomy TSV are grouped by phylum, or into a given
+number of shards of equal genome count, and each group is sketched with the
+k-mer size and sketch size of the combined database, so every shard holds the
+same sketches as the combined file. The shards are written to the output
+directory together with a `<name>.shards.tsv` manifest:
+
+    shard  path  genomes
+
+Passing the manifest instead of a .msh file to run_mash_search or
+run_mash_search_batch searches all shards concurrently. Built offline with
+
+    python -m kb_cdm_genome_match.utils2.sketch_shards \\
+        --taxonomy /data/.../cdm_genomes_paths_taxonomy.tsv \\
+        --mash-db /data/.../combined_gtdb_sketch_410303_genome.msh \\
+        --output-dir /data/.../shards --by phylum --threads 32
+"""
+import argparse
+import csv
+import logging
+import os
+import re
+
+import pandas as pd
+
+from .mash_skani_multiple import SHARD_MANIFEST_SUFFIX, get_sketch_params, sketch_queries
+
+logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
+                            level=logging.INFO)
+
+UNCLASSIFIED = "unclassified"
+
+
+def safe_file_name(label):
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", label)
+
+
+def group_genomes(taxonomy_file, by="phylum", shard_count=None):
+    """
+    Groups the genome filepaths of the taxonomy TSV into shards.
+
+    :param by: "phylum" for one shard per phylum, "size" for shard_count
+               shards of equal genome count (in taxonomy order).
+    :return: Dictionary mapping shard names to lists of filepaths.
+    """
+    taxonomy_df = pd.read_csv(taxonomy_file, sep="\t", usecols=["filepath", "phylum"])
+    if by == "phylum":
+        shards = {}
+        phyla = taxonomy_df["phylum"].fillna(UNCLASSIFIED)
+        for filepath, phylum in zip(taxonomy_df["filepath"], phyla):
+            shards.setdefault(safe_file_name(str(phylum)), []).append(filepath)
+        return shards
+    if by == "size":
+        if not shard_count or shard_count < 1:
+            raise ValueError("shard_count must be a positive number for size-balanced shards")
+        filepaths = taxonomy_df["filepath"].tolist()
+        shard_count = min(shard_count, max(len(filepaths), 1))
+        size, extra = divmod(len(filepaths), shard_count)
+        shards = {}
+        start = 0
+        for n in range(shard_count):
+            end = start + size + (1 if n < extra else 0)
+            shards[f"shard_{n:04d}"] = filepaths[start:end]
+            start = end
+        return shards
+    raise ValueError(f"Unknown shard grouping {by}, expected 'phylum' or 'size'")
+
+
+def sketch_shard(filepaths, shard_path, kmer_size, sketch_size, threads=1):
+    """
+    Sketches a group of genomes into shard_path unless it already exists,
+    writing to a temporary prefix first so a partial shard is never kept.
+    """
+    if os.path.exists(shard_path):
+        return shard_path
+    tmp_prefix = os.path.splitext(shard_path)[0] + ".tmp"
+    sketch_queries(filepaths, tmp_prefix, kmer_size, sketch_size, threads)
+    os.replace(tmp_prefix + ".msh", shard_path)
+    os.remove(tmp_prefix + "_queries.txt")
+    return shard_path
+
+
+def write_manifest(manifest_file, columns, rows):
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, "w", newline="") as fh:
+        writer = csv.writer(fh, delimiter="\t", lineterminator="\n")
+        writer.writerow(columns)
+        writer.writerows(rows)
+    os.replace(tmp_file, manifest_file)
+
+
+def build_shards(taxonomy_file, mash_db, output_dir, by="phylum", shard_count=None, threads=1,
+                 manifest_name=None):
+    """
+    Sketches each shard with the sketch parameters of mash_db and writes the manifest.
+    Shards already present in output_dir are kept, so an interrupted build resumes.
+
+    :param taxonomy_file: Path to cdm_genomes_paths_taxonomy.tsv.
+    :param mash_db: Combined Mash database whose k-mer size and sketch size are reused.
+    :param output_dir: Directory for the shard .msh files and the manifest.
+    :param threads: Threads passed to `mash sketch`.
+    :return: Path of the shard manifest.
+    """
+    params = get_sketch_params(mash_db)
+    shards = group_genomes(taxonomy_file, by, shard_count)
+    os.makedirs(output_dir, exist_ok=True)
+    if manifest_name is None:
+        manifest_name = os.path.splitext(os.path.basename(mash_db))[0]
+    manifest_file = os.path.join(output_dir, manifest_name + SHARD_MANIFEST_SUFFIX)
+
+    rows = []
+    for n, (shard, filepaths) in enumerate(shards.items(), 1):
+        shard_path = os.path.join(output_dir, shard + ".msh")
+        logging.info(f"Shard {n}/{len(shards)} {shard} ({len(filepaths)} genomes)")
+        sketch_shard(filepaths, shard_path, params["kmer_size"], params["sketch_size"], threads)
+        rows.append([shard, os.path.basename(shard_path), len(filepaths)])
+
+    write_manifest(manifest_file, ["shard", "path", "genomes"], rows)
+    logging.info(f"Shard manifest with {len(rows)} shards saved to {manifest_file}")
+    return manifest_file
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Split the CDM Mash sketch database into shards "
+                                                 "by phylum or into size-balanced shards.")
+    parser.add_argument("--taxonomy", required=True, help="Path to cdm_genomes_paths_taxonomy.tsv")
+    parser.add_argument("--mash-db", required=True,
+                        help="Combined .msh database to take sketch parameters from")
+    parser.add_argument("--output-dir", required=True, help="Directory for the shards and manifest")
+    parser.add_argument("--by", choices=["phylum", "size"], default="phylum", help="Shard grouping")
+    parser.add_argument("--shards", type=int, default=None, help="Number of shards for --by size")
+    parser.add_argument("--threads", type=int, default=1, help="Threads for mash sketch")
+    args = parser.parse_args(argv)
+
+    build_shards(args.taxonomy, args.mash_db, args.output_dir, args.by, args.shards, args.threads)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,103 @@
+"""
+Species-cluster index for the two-tier Mash search.
+
+One representative genome per species in the taxonomy TSV (the first one
+listed) is sketched into `<name>.species_reps.msh`, and the members of every
+species with more than one genome are sketched into their own .msh file.
+Both use the sketch parameters of the combined database. A
+`<name>.species.tsv` manifest links them:
+
+    species  representative  path  genomes
+
+with an empty path for single-genome species. Genomes without a species
+assignment form single-genome clusters of their own. run_two_tier_mash_search
+searches the representatives first and then only the members of the closest
+species. Built offline with
+
+    python -m kb_cdm_genome_match.utils2.species_index \\
+        --taxonomy /data/.../cdm_genomes_paths_taxonomy.tsv \\
+        --mash-db /data/.../combined_gtdb_sketch_410303_genome.msh \\
+        --output-dir /data/.../species --threads 32
+"""
+import argparse
+import logging
+import os
+
+import pandas as pd
+
+from .mash_skani_multiple import SPECIES_INDEX_SUFFIX, SPECIES_REPS_SUFFIX, get_sketch_params
+from .sketch_shards import safe_file_name, sketch_shard, write_manifest
+
+logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
+                            level=logging.INFO)
+
+
+def group_genomes_by_species(taxonomy_file):
+    """
+    Returns a dictionary mapping each species to the filepaths of its genomes,
+    in taxonomy order, so the first filepath is the representative.
+    """
+    taxonomy_df = pd.read_csv(taxonomy_file, sep="\t", usecols=["filepath", "species"])
+    groups = {}
+    for filepath, species in zip(taxonomy_df["filepath"], taxonomy_df["species"].fillna("")):
+        if not species or species.endswith("__"):
+            species = "unclassified_" + os.path.basename(filepath)
+        groups.setdefault(species, []).append(filepath)
+    return groups
+
+
+def build_species_index(taxonomy_file, mash_db, output_dir, threads=1, manifest_name=None):
+    """
+    Sketches the species representatives and the members of each multi-genome
+    species, and writes the species manifest. Existing sketches are kept, so a
+    build resumes.
+
+    :param taxonomy_file: Path to cdm_genomes_paths_taxonomy.tsv.
+    :param mash_db: Combined Mash database whose k-mer size and sketch size are reused.
+    :param output_dir: Directory for the sketches and the manifest.
+    :param threads: Threads passed to `mash sketch`.
+    :return: Path of the species manifest.
+    """
+    params = get_sketch_params(mash_db)
+    groups = group_genomes_by_species(taxonomy_file)
+    os.makedirs(output_dir, exist_ok=True)
+    if manifest_name is None:
+        manifest_name = os.path.splitext(os.path.basename(mash_db))[0]
+    manifest_file = os.path.join(output_dir, manifest_name + SPECIES_INDEX_SUFFIX)
+
+    representatives = [filepaths[0] for filepaths in groups.values()]
+    logging.info(f"Sketching {len(representatives)} species representatives")
+    sketch_shard(representatives, os.path.join(output_dir, manifest_name + SPECIES_REPS_SUFFIX),
+                 params["kmer_size"], params["sketch_size"], threads)
+
+    rows = []
+    for n, (species, filepaths) in enumerate(groups.items(), 1):
+        path = ""
+        if len(filepaths) > 1:
+            path = f"{n:06d}_{safe_file_name(species)}.msh"
+            sketch_shard(filepaths, os.path.join(output_dir, path), params["kmer_size"],
+                         params["sketch_size"], threads)
+        rows.append([species, filepaths[0], path, len(filepaths)])
+
+    write_manifest(manifest_file, ["species", "representative", "path", "genomes"], rows)
+    logging.info(f"Species index with {len(rows)} species saved to {manifest_file}")
+    return manifest_file
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the species representative and cluster "
+                                                 "member sketches for the two-tier Mash search.")
+    parser.add_argument("--taxonomy", required=True, help="Path to cdm_genomes_paths_taxonomy.tsv")
+    parser.add_argument("--mash-db", required=True,
+                        help="Combined .msh database to take sketch parameters from")
+    parser.add_argument("--output-dir", required=True,
+                        help="Directory for the sketches and manifest")
+    parser.add_argument("--threads", type=int, default=1, help="Threads for mash sketch")
+    args = parser.parse_args(argv)
+
+    build_species_index(args.taxonomy, args.mash_db, args.output_dir, args.threads)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,61 @@
+"""
+Per-tool limits on concurrently running external processes.
+
+When queries are searched on several threads (mash_skani_pipeline
+query_workers), each thread starts its own mash and skani processes. A
+limit per tool keeps e.g. the memory-heavy `mash dist` over the full
+database to a few processes while more skani comparisons run alongside, so
+the Mash search of one query overlaps with the Skani verification of
+another without oversubscribing the node. Commands are run from argument
+lists, never through a shell.
+
+Worker process pools that may be created from those threads take their
+context from pool_context.
+"""
+import contextlib
+import multiprocessing
+import subprocess
+import threading
+
+_tool_slots = {}
+
+
+def set_tool_limits(limits):
+    """
+    Sets the maximum number of concurrent processes per tool, e.g.
+    {"mash": 2, "skani": 4}. Tools without a limit (None or 0) are unbounded.
+    """
+    _tool_slots.clear()
+    for tool, limit in (limits or {}).items():
+        if limit:
+            _tool_slots[tool] = threading.BoundedSemaphore(limit)
+
+
+@contextlib.contextmanager
+def tool_slot(tool):
+    """Holds one of the process slots of tool for the duration of the block."""
+    slot = _tool_slots.get(tool)
+    if slot is None:
+        yield
+        return
+    with slot:
+        yield
+
+
+def pool_context():
+    """
+    Multiprocessing context for worker pools. Forking a process while other
+    threads run can deadlock the child on a lock one of them held (logging,
+    stdio, the import lock), so workers are started from a fork server.
+    """
+    return multiprocessing.get_context("forkserver")
+
+
+def run_tool(cmd, **kwargs):
+    """
+    subprocess.run for an external tool (cmd[0]) within its process limit,
+    capturing stdout and stderr as text.
+    """
+    with tool_slot(cmd[0]):
+        return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True, **kwargs)
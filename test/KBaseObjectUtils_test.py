@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest import mock
+
+from kb_cdm_genome_match.utils2 import KBaseObjectUtils
+from kb_cdm_genome_match.utils2.KBaseObjectUtils import get_current_cdm_best_hits
+from kb_cdm_genome_match.utils2.mash_skani_multiple import best_hit_rows
+
+
+def object_info(name, version, chsum, metadata=None, obj_type='KBaseGenomes.Genome-17.0'):
+    return [2, name, obj_type, '2026-01-01T00:00:00+0000', version, 'user', 1, 'ws', chsum, 100,
+            metadata]
+
+
+CURRENT = {'cdm_best_hit': "{'cdm_hash': 'h', 'skani': 99.0, 'ani': 98.5, 'shared_kmers': '90.1', "
+                           "'name': 'r.fa'}",
+           'cdm_db_version': 'db1', 'cdm_params': 'p1', 'cdm_query': 'a.fa', 'cdm_query_hash': 'qa'}
+
+
+class KBaseObjectUtilsTest(unittest.TestCase):
+
+    def current_hits(self, refs, workspace_name, infos, copy_infos):
+        with mock.patch.object(KBaseObjectUtils, 'Workspace') as workspace:
+            workspace.return_value.get_object_info3.side_effect = [
+                {'infos': infos, 'paths': []}, {'infos': copy_infos, 'paths': []}]
+            current_hits = get_current_cdm_best_hits('ws_url', refs, workspace_name, 'db1', 'p1')
+        calls = workspace.return_value.get_object_info3.call_args_list
+        return current_hits, [[obj['ref'] for obj in call[0][0]['objects']] for call in calls]
+
+    def test_current_best_hits_are_read_from_object_info(self):
+        infos = [
+            object_info('a', 3, 'c1'), object_info('b', 1, 'c2'), object_info('c', 1, 'c3'),
+            object_info('d', 1, 'c4'),
+            object_info('set', 1, 'c5', obj_type='KBaseSets.GenomeSet-2.1'), None,
+        ]
+        # Annotated copies: a is current, b holds changed data, c a result for another database
+        # and d had no hit (stored before the query name was recorded)
+        copy_infos = [
+            object_info('a', 4, 'c1', CURRENT), object_info('b', 2, 'changed', CURRENT),
+            object_info('c', 1, 'c3', dict(CURRENT, cdm_db_version='db0')),
+            object_info('d', 1, 'c4',
+                        {'cdm_best_hit': '{}', 'cdm_db_version': 'db1', 'cdm_params': 'p1'}),
+        ]
+        refs = ['1/2/3', '1/3/1', '1/4/1', '1/5/1', '1/6/1', '1/7/1']
+        current_hits, requested = self.current_hits(refs, 'out', infos, copy_infos)
+        self.assertEqual(requested, [refs, ['out/a', 'out/b', 'out/c', 'out/d']])
+        best_hit = {'cdm_hash': 'h', 'skani': 99.0, 'ani': 98.5, 'shared_kmers': '90.1',
+                    'name': 'r.fa'}
+        self.assertEqual(current_hits, {'1/2/3': ('a.fa', 'qa', best_hit),
+                                        '1/5/1': ('d', None, {})})
+
+        self.assertEqual(best_hit_rows(current_hits, {'r.fa': ('/r/r.fa', 'd__B')}),
+                         [{'input_ref': '1/2/3', 'query': 'a.fa', 'cdm_hash': 'h',
+                           'reference': 'r.fa', 'skani': 99.0, 'ani': 98.5,
+                           'shared_kmers': '90.1', 'taxonomy': 'd__B'},
+                          {'input_ref': '1/5/1', 'query': 'd'}])
+
+    def test_annotated_copy_in_another_workspace(self):
+        # The input genome lives in workspace 1; its annotated copy was saved into the output
+        # workspace
+        infos = [object_info('a', 1, 'c1', {})]
+        copy_infos = [object_info('a', 1, 'c1', CURRENT)]
+        current_hits, requested = self.current_hits(['1/2/1'], 'output_ws', infos, copy_infos)
+        self.assertEqual(requested, [['1/2/1'], ['output_ws/a']])
+        self.assertEqual(list(current_hits), ['1/2/1'])
+
+        # Not annotated in the output workspace yet
+        current_hits, _ = self.current_hits(['1/2/1'], 'output_ws', infos, [None])
+        self.assertEqual(current_hits, {})
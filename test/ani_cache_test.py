@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import os
+import pickle
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+from kb_cdm_genome_match.utils2 import mash_skani_multiple
+from kb_cdm_genome_match.utils2.ani_cache import PairAniCache
+from kb_cdm_genome_match.utils2.mash_skani_multiple import run_skani, run_skani_batch
+
+SKANI_HEADER = ("Ref_file\tQuery_file\tANI\tAlign_fraction_ref\tAlign_fraction_query\t"
+                "Ref_name\tQuery_name\n")
+
+
+class ani_cacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = PairAniCache(os.path.join(self.tmpdir, 'ani.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_entries_are_keyed_by_tool_version_and_params(self):
+        self.cache.put('q', '/r/a.fa', 'skani', 'skani 0.2.2', 'dist', 97.5, 96.1, '88.2')
+        self.cache.put('q', '/r/b.fa', 'skani', 'skani 0.2.2', 'dist')
+        reopened = PairAniCache(self.cache.db_path)
+        self.assertEqual(reopened.get('q', '/r/a.fa', 'skani', 'skani 0.2.2', 'dist'),
+                         {'ani': 97.5, 'aligned_fraction': 96.1, 'shared_kmers': '88.2',
+                          'details': None})
+        # A pair without a tool result is cached as such
+        self.assertIsNone(self.cache.get('q', '/r/b.fa', 'skani', 'skani 0.2.2', 'dist')['ani'])
+        self.assertIsNone(self.cache.get('q', '/r/a.fa', 'skani', 'skani 0.2.3', 'dist'))
+        self.assertIsNone(self.cache.get('q', '/r/a.fa', 'skani', 'skani 0.2.2', 'dist -m 200'))
+        self.assertIsNone(self.cache.get('other', '/r/a.fa', 'skani', 'skani 0.2.2', 'dist'))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 3))
+
+        self.cache.put('q', 'r', 'fastANI', '1.33', '--visualize', 98.0, 0.9, '900',
+                       {'fragments': '1000', 'visual': 'mapping'})
+        self.assertEqual(self.cache.get('q', 'r', 'fastANI', '1.33', '--visualize')['details'],
+                         {'fragments': '1000', 'visual': 'mapping'})
+        self.assertEqual(pickle.loads(pickle.dumps(self.cache)).db_path, self.cache.db_path)
+
+    @mock.patch.object(mash_skani_multiple, 'reference_cdm_hash', return_value='h' * 64)
+    def test_skani_runs_only_for_uncached_pairs(self, _):
+        skani_cache = self.cache.for_tool('skani', 'skani 0.2.2', 'dist')
+        references = ['/r/a.fa', '/r/b.fa', '/r/c.fa']
+        output = subprocess.CompletedProcess([], 0, SKANI_HEADER
+                                             + '/r/a.fa\t/q/query.fa\t97.0\t96.5\t80.1\tr\tq\n'
+                                             + '/r/b.fa\t/q/query.fa\t90.0\t94.0\t70.0\tr\tq\n', '')
+        with mock.patch.object(mash_skani_multiple.subprocess, 'run', return_value=output) as run:
+            records = run_skani_batch('1/2/3', '/q/query.fa', references, 95.0,
+                                      ani_cache=skani_cache, query_hash='q')
+        self.assertEqual(run.call_count, 1)
+
+        with mock.patch.object(mash_skani_multiple.subprocess, 'run') as run:
+            self.assertEqual(run_skani_batch('1/2/3', '/q/query.fa', references, 95.0,
+                                             ani_cache=skani_cache, query_hash='q'), records)
+            self.assertEqual(run_skani('1/2/3', '/q/query.fa', '/r/a.fa', 95.0,
+                                       ani_cache=skani_cache, query_hash='q'), records['/r/a.fa'])
+            self.assertIsNone(run_skani('1/2/3', '/q/query.fa', '/r/c.fa', 95.0,
+                                        ani_cache=skani_cache, query_hash='q'))
+        run.assert_not_called()
+        self.assertEqual((self.cache.hits, self.cache.misses), (5, 3))
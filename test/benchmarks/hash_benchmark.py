@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput and memory benchmark for the contig_set_hash implementations.
+
+Generates synthetic genomes (few large contigs and many tiny contigs, each
+plain and gzipped), hashes them with every implementation in a fresh
+process, and writes machine-readable JSON:
+
+    PYTHONPATH=lib python test/benchmarks/hash_benchmark.py --size-mb 50 \\
+        --output bench_before.json
+    PYTHONPATH=lib python test/benchmarks/hash_benchmark.py --size-mb 50 \\
+        --output bench_after.json --compare bench_before.json
+
+For each run it reports MB/s (uncompressed FASTA bytes per second, best of
+--repeats), peak RSS growth over the post-import baseline, and the peak of
+Python allocations traced by tracemalloc (measured in a separate pass so it
+does not slow the timed runs).
+"""
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from kb_cdm_genome_match.utils2.calculate_hash import (
+    contig_set_hash,
+    genome_digest,
+    read_fasta2,
+    stream_contig_set_hash,
+)
+from kb_cdm_genome_match.utils2.fasta_index import fasta_contig_set_hash
+
+
+LINE_WIDTH = 80
+
+# name -> (contig count, or None for fixed contig length, contig length)
+PROFILES = {
+    "few_large": (3, None),
+    "many_tiny": (None, 500),
+}
+
+IMPLEMENTATIONS = {
+    "read_fasta2+contig_set_hash": lambda path: contig_set_hash(read_fasta2(path)),
+    "stream_contig_set_hash": stream_contig_set_hash,
+    "fasta_contig_set_hash": lambda path: fasta_contig_set_hash(path),
+    "fasta_contig_set_hash_parallel": lambda path: fasta_contig_set_hash(path, parallel=True),
+    "genome_digest": lambda path: genome_digest(path)["contig_set_hash"],
+}
+
+
+def write_synthetic_genome(path, size_bytes, contig_count=None, contig_length=None, seed=0):
+    """
+    Writes a deterministic random genome of about size_bytes bases, either as
+    contig_count equal contigs or as contigs of contig_length bases.
+    """
+    rng = random.Random(seed)
+    if contig_count is None:
+        contig_count = max(1, size_bytes // contig_length)
+    contig_length = max(1, size_bytes // contig_count)
+    # Reuse one random block so generation is not the slow part
+    block = "".join(rng.choice("ACGTacgt") for _ in range(1 << 16))
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "wt") as fh:
+        for i in range(contig_count):
+            fh.write(f">contig_{i} synthetic\n")
+            start = rng.randrange(len(block))
+            remaining = contig_length
+            while remaining > 0:
+                n = min(LINE_WIDTH, remaining)
+                if start + n > len(block):
+                    line = (block[start:] + block)[:n]
+                else:
+                    line = block[start:start + n]
+                fh.write(line + "\n")
+                start = (start + n) % len(block)
+                remaining -= n
+    return path
+
+
+def _max_rss_bytes():
+    # ru_maxrss is reported in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _run_one(impl_name, path, repeats, queue):
+    func = IMPLEMENTATIONS[impl_name]
+    baseline_rss = _max_rss_bytes()
+    times = []
+    digest = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        digest = func(path)
+        times.append(time.perf_counter() - start)
+    peak_rss = _max_rss_bytes()
+
+    tracemalloc.start()
+    func(path)
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    queue.put({"seconds": min(times), "peak_rss_bytes": peak_rss - baseline_rss,
+               "tracemalloc_peak_bytes": traced_peak, "digest": digest})
+
+
+def measure(impl_name, path, repeats):
+    """
+    Runs one implementation on one file in a fresh process so peak RSS is
+    not polluted by earlier runs.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run_one, args=(impl_name, path, repeats, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmarks(size_mb, repeats, implementations, workdir):
+    size_bytes = int(size_mb * (1 << 20))
+    results = []
+    for profile, (contig_count, contig_length) in PROFILES.items():
+        plain_path = os.path.join(workdir, f"{profile}.fa")
+        write_synthetic_genome(plain_path, size_bytes, contig_count, contig_length)
+        fasta_bytes = os.path.getsize(plain_path)
+        gz_path = plain_path + ".gz"
+        with open(plain_path, "rb") as src, gzip.open(gz_path, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+
+        for path in (plain_path, gz_path):
+            digests = set()
+            for impl_name in implementations:
+                result = measure(impl_name, path, repeats)
+                digests.add(result.pop("digest"))
+                result.update({
+                    "genome": os.path.basename(path),
+                    "profile": profile,
+                    "compressed": path.endswith(".gz"),
+                    "implementation": impl_name,
+                    "fasta_bytes": fasta_bytes,
+                    "mb_per_s": fasta_bytes / (1 << 20) / result["seconds"],
+                })
+                results.append(result)
+                print(f"{result['genome']:<16} {impl_name:<32} {result['mb_per_s']:8.1f} MB/s "
+                      f"rss +{result['peak_rss_bytes'] / (1 << 20):8.1f} MB "
+                      f"alloc peak {result['tracemalloc_peak_bytes'] / (1 << 20):8.1f} MB")
+            if len(digests) != 1:
+                raise RuntimeError(f"Implementations disagree on {path}: {digests}")
+    return results
+
+
+def compare(current, previous):
+    """
+    Prints the throughput ratio of each (genome, implementation) pair
+    against an earlier benchmark file.
+    """
+    before = {(r["genome"], r["implementation"]): r for r in previous["results"]}
+    print(f"\nComparison against commit {previous.get('commit')}:")
+    for r in current["results"]:
+        old = before.get((r["genome"], r["implementation"]))
+        if old is None:
+            continue
+        print(f"{r['genome']:<16} {r['implementation']:<32} "
+              f"speed x{r['mb_per_s'] / old['mb_per_s']:5.2f}  "
+              f"rss x{(r['peak_rss_bytes'] + 1) / (old['peak_rss_bytes'] + 1):5.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark contig_set_hash implementations.")
+    parser.add_argument("--size-mb", type=float, default=20,
+                        help="Bases per synthetic genome, in MB")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="Timed runs per measurement (best is kept)")
+    parser.add_argument("--implementations", nargs="+", default=list(IMPLEMENTATIONS),
+                        choices=list(IMPLEMENTATIONS))
+    parser.add_argument("--output", default="hash_benchmark.json", help="JSON results file")
+    parser.add_argument("--compare", default=None, help="Earlier JSON results to compare against")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="hash_benchmark_")
+    try:
+        results = run_benchmarks(args.size_mb, args.repeats, args.implementations, workdir)
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "size_mb": args.size_mb,
+        "repeats": args.repeats,
+        "results": results,
+    }
+    with open(args.output, "w") as fh:
+        json.dump(report, fh, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as fh:
+            compare(report, json.load(fh))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Recall and latency benchmark for the Mash candidate search modes.
+
+Every query is searched exhaustively against the combined sketch database
+with run_mash_search, which is the ground truth, and with each faster
+search mode. For each mode the benchmark reports recall@top_n (the share of
+exhaustive top_n hits that the mode also returns) and the seconds per query,
+and writes machine-readable JSON:
+
+    PYTHONPATH=lib python test/benchmarks/search_benchmark.py \\
+        --mash-db /data/.../combined_gtdb_sketch_410303_genome.msh \\
+        --taxonomy /data/.../cdm_genomes_paths_taxonomy.tsv --sample 200 \\
+        --species-index /data/.../species/combined_gtdb_sketch_410303_genome.species.tsv \\
+        --lsh-index /data/.../combined_gtdb_sketch_410303_genome.msh.minhash/lsh_b64_r2 \\
+        --modes two_tier lsh --output search_benchmark.json
+
+Queries are either given with --queries or sampled from the taxonomy TSV;
+sampled CDM genomes are searched like any other query, so their own
+sketch is the first hit of every mode.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+
+import pandas as pd
+
+from kb_cdm_genome_match.utils2.lsh_index import LSHIndex
+from kb_cdm_genome_match.utils2.mash_skani_multiple import (
+    load_species_index,
+    run_mash_search,
+    run_two_tier_mash_search,
+)
+
+
+def _two_tier(query, args, state):
+    if "species_index" not in state:
+        state["species_index"] = load_species_index(args.species_index)
+    return run_two_tier_mash_search(query, state["species_index"], args.top_n, args.max_mash_dist,
+                                    args.max_species, args.species_radius)
+
+
+def _lsh(query, args, state):
+    if "lsh_index" not in state:
+        state["lsh_index"] = LSHIndex(args.lsh_index, args.min_band_hits, args.max_candidates)
+    return run_mash_search(query, args.mash_db, args.top_n, args.max_mash_dist,
+                           lsh_index=state["lsh_index"])
+
+
+# name -> search function(query fasta, parsed arguments, per-mode state)
+MODES = {
+    "two_tier": _two_tier,
+    "lsh": _lsh,
+}
+
+
+def sample_queries(taxonomy_file, sample, seed=0):
+    filepaths = pd.read_csv(taxonomy_file, sep="\t", usecols=["filepath"])["filepath"].tolist()
+    return random.Random(seed).sample(filepaths, min(sample, len(filepaths)))
+
+
+def _timed(func, *func_args):
+    start = time.perf_counter()
+    result = func(*func_args)
+    return result, time.perf_counter() - start
+
+
+def run_benchmarks(queries, args):
+    results = []
+    for n, query in enumerate(queries, 1):
+        truth, truth_seconds = _timed(run_mash_search, query, args.mash_db, args.top_n,
+                                      args.max_mash_dist)
+        truth_set = {genome for genome, _ in truth}
+        result = {"query": query, "exhaustive_seconds": truth_seconds,
+                  "exhaustive_hits": len(truth)}
+        for mode in args.modes:
+            matches, seconds = _timed(MODES[mode], query, args, args.state.setdefault(mode, {}))
+            found = {genome for genome, _ in matches}
+            result[mode] = {
+                "seconds": seconds,
+                "hits": len(matches),
+                "recall": len(found & truth_set) / len(truth_set) if truth_set else 1.0,
+            }
+        results.append(result)
+        modes = " ".join(f"{mode} {result[mode]['seconds']:7.2f}s "
+                         f"recall {result[mode]['recall']:.3f}" for mode in args.modes)
+        print(f"{n:>5}/{len(queries)} {os.path.basename(query):<40} "
+              f"exhaustive {truth_seconds:7.2f}s {modes}")
+    return results
+
+
+def summarize(results, modes, top_n):
+    exhaustive = sum(r["exhaustive_seconds"] for r in results) / len(results)
+    summary = {"queries": len(results), "exhaustive_seconds_per_query": exhaustive}
+    print(f"{'exhaustive':<12} {exhaustive:7.2f}s/query")
+    for mode in modes:
+        seconds = sum(r[mode]["seconds"] for r in results) / len(results)
+        summary[mode] = {
+            "seconds_per_query": seconds,
+            "speedup": exhaustive / seconds if seconds else None,
+            "mean_recall": sum(r[mode]["recall"] for r in results) / len(results),
+            "min_recall": min(r[mode]["recall"] for r in results),
+        }
+        print(f"{mode:<12} {seconds:7.2f}s/query  x{summary[mode]['speedup']:6.1f}  "
+              f"recall@{top_n} mean {summary[mode]['mean_recall']:.4f} "
+              f"min {summary[mode]['min_recall']:.4f}")
+    return summary
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark recall and latency of the Mash search modes.")
+    parser.add_argument("--mash-db", required=True,
+                        help="Combined .msh database (exhaustive ground truth)")
+    parser.add_argument("--queries", nargs="+", default=None, help="Query FASTA files")
+    parser.add_argument("--taxonomy", default=None, help="Taxonomy TSV to sample CDM genomes from")
+    parser.add_argument("--sample", type=int, default=100, help="Number of sampled queries")
+    parser.add_argument("--seed", type=int, default=0, help="Sampling seed")
+    parser.add_argument("--top-n", type=int, default=10)
+    parser.add_argument("--max-mash-dist", type=float, default=0.05)
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    parser.add_argument("--species-index", default=None, help="Species index for the two_tier mode")
+    parser.add_argument("--max-species", type=int, default=5,
+                        help="Species clusters expanded by two_tier")
+    parser.add_argument("--species-radius", type=float, default=0.05,
+                        help="Extra Mash distance allowed for species representatives")
+    parser.add_argument("--lsh-index", default=None, help="LSH index directory for the lsh mode")
+    parser.add_argument("--min-band-hits", type=int, default=1,
+                        help="Band keys an lsh candidate must share")
+    parser.add_argument("--max-candidates", type=int, default=None,
+                        help="Candidates scored per lsh query")
+    parser.add_argument("--output", default="search_benchmark.json", help="JSON results file")
+    args = parser.parse_args(argv)
+    if args.queries is None and args.taxonomy is None:
+        parser.error("either --queries or --taxonomy is required")
+    args.state = {}
+
+    queries = args.queries or sample_queries(args.taxonomy, args.sample, args.seed)
+    results = run_benchmarks(queries, args)
+    summary = summarize(results, args.modes, args.top_n)
+
+    report = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "mash_db": args.mash_db,
+        "top_n": args.top_n,
+        "max_mash_dist": args.max_mash_dist,
+        "summary": summary,
+        "results": results,
+    }
+    with open(args.output, "w") as fh:
+        json.dump(report, fh, indent=2)
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
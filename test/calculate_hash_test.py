@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from kb_cdm_genome_match.utils2 import calculate_hash
+from kb_cdm_genome_match.utils2.calculate_hash import (
+    choose_hash_strategy,
+    contig_set_hash,
+    genome_digest,
+    read_fasta2,
+    stream_contig_set_hash,
+)
+
+
+DATA_DIR = Path(__file__).parent / 'data'
+
+
+class calculate_hashTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def write_fasta(self, name, text, gz=False):
+        path = os.path.join(self.tmpdir, name + ('.gz' if gz else ''))
+        if gz:
+            with gzip.open(path, 'wb') as fh:
+                fh.write(text.encode('utf-8'))
+        else:
+            with open(path, 'w', newline='') as fh:
+                fh.write(text)
+        return path
+
+    def assert_same_hash(self, path):
+        expected = contig_set_hash(read_fasta2(path))
+        for chunk_size in (1, 2, 3, 7, 64, 1 << 20):
+            self.assertEqual(stream_contig_set_hash(path, chunk_size), expected,
+                             f'{path} chunk_size={chunk_size}')
+
+    def test_stream_hash_matches_test_data(self):
+        for name in ['Bin.001.fa.gz', 'Bin.046.fa.gz', 'GCF_000007345.1_assembly.fa.gz',
+                     'Rhodo_contigs.fa.gz']:
+            path = str(DATA_DIR / name)
+            expected = contig_set_hash(read_fasta2(path))
+            self.assertEqual(stream_contig_set_hash(path), expected, name)
+            self.assertEqual(stream_contig_set_hash(path, 997), expected, name)
+
+    def test_stream_hash_matches_edge_cases(self):
+        cases = {
+            'wrapped': '>a desc\nacgt\nACGT\n>b\nNNNN\n',
+            'no_trailing_newline': '>a\nACGT\n>b\nTTTT',
+            'empty_contig': '>a\n>b\nACGT\n',
+            'trailing_header': '>a\nACGT\n>b',
+            'trailing_header_newline': '>a\nACGT\n>b\n',
+            'whitespace': '>a\n  ac gt \t\n\n  \nTT  \n>b\n\t\n',
+            'crlf': '>a\r\nACGT\r\nacgt\r\n>b\r\nGG\r\n',
+            'pre_header_lines': 'NNNN\n>a\nACGT\n',
+            'pre_header_lines_trailing_header': 'NNNN\n>a',
+            'indented_header': '>a\n >b\nACGT\n',
+        }
+        for name, text in cases.items():
+            for gz in (False, True):
+                with self.subTest(case=name, gz=gz):
+                    self.assert_same_hash(self.write_fasta(name + '.fa', text, gz))
+
+    def test_stream_hash_requires_header(self):
+        path = self.write_fasta('no_header.fa', 'ACGT\n')
+        with self.assertRaises(ValueError):
+            stream_contig_set_hash(path)
+
+    def test_choose_hash_strategy(self):
+        self.assertEqual(choose_hash_strategy([10] * 5, workers=8), 'serial')
+        self.assertEqual(choose_hash_strategy([50 << 20], workers=8), 'serial')
+        self.assertEqual(choose_hash_strategy([5 << 20] * 10, workers=8), 'thread')
+        self.assertEqual(choose_hash_strategy([1000] * 100000, workers=8), 'process')
+        self.assertEqual(choose_hash_strategy([5 << 20] * 10, workers=1), 'serial')
+
+    def test_parallel_hash_matches_serial(self):
+        features = read_fasta2(str(DATA_DIR / 'Bin.046.fa.gz'))
+        expected = contig_set_hash(features)
+        for mean_length in (0, 1 << 40):
+            with mock.patch.object(calculate_hash, 'PARALLEL_MIN_TOTAL_LENGTH', 0), \
+                    mock.patch.object(calculate_hash, 'THREAD_MIN_MEAN_LENGTH', mean_length):
+                self.assertEqual(contig_set_hash(features, parallel=True, workers=2), expected)
+
+    def test_genome_digest_single_pass(self):
+        for name in ['Bin.047.fa.gz', 'GCF_000008665.1_assembly.fa.gz']:
+            path = str(DATA_DIR / name)
+            features = read_fasta2(path)
+            seqs = [f.seq.upper() for f in features]
+            digest = genome_digest(path, chunk_size=4096)
+            with open(path, 'rb') as fh:
+                self.assertEqual(digest['file_md5'], hashlib.md5(fh.read()).hexdigest())
+            self.assertEqual(digest['contig_set_hash'], contig_set_hash(features))
+            self.assertEqual(digest['contig_hashes'],
+                             [hashlib.sha256(s.encode()).hexdigest() for s in seqs])
+            self.assertEqual(digest['contig_lengths'], [len(s) for s in seqs])
+            self.assertEqual(digest['total_length'], sum(len(s) for s in seqs))
+            self.assertEqual(digest['contig_count'], len(seqs))
+            gc = sum(s.count('G') + s.count('C') for s in seqs)
+            self.assertAlmostEqual(digest['gc_content'], gc / digest['total_length'])
+
+    def test_genome_digest_plain_file(self):
+        path = self.write_fasta('digest.fa', '>a\r\nacgg\r\nTT\r\n>b\nGGCC\n')
+        digest = genome_digest(path)
+        self.assertEqual(digest['contig_set_hash'], contig_set_hash(read_fasta2(path)))
+        self.assertEqual(digest['contig_lengths'], [6, 4])
+        self.assertEqual(digest['n50'], 6)
+        self.assertAlmostEqual(digest['gc_content'], 7 / 10)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import gzip
+import hashlib
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest import mock
+
+from kb_cdm_genome_match.utils2 import calculate_hash
+from kb_cdm_genome_match.utils2.calculate_hash import contig_set_hash, read_fasta2
+from kb_cdm_genome_match.utils2.fasta_index import IndexedFasta, fasta_contig_set_hash
+
+
+DATA_DIR = Path(__file__).parent / 'data'
+
+
+class fasta_indexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_fasta(self, name, text):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w', newline='') as fh:
+            fh.write(text)
+        return path
+
+    def test_hash_matches_contig_set_hash(self):
+        cases = {
+            'wrapped': '>a desc\nacgt\nACGT\n>b\nNNNN\n',
+            'no_trailing_newline': '>a\nACGT\n>b\nTTTT',
+            'empty_contig': '>a\n>b\nACGT\n',
+            'trailing_header': '>a\nACGT\n>b',
+            'whitespace': '>a\n  ac gt \t\n\n  \nTT  \n>b\n\t\n',
+            'crlf': '>a\r\nACGT\r\nacgt\r\n>b\r\nGG\r\n',
+            'lone_cr': '>h\nA \rA\n',
+            'cr_line_breaks': '>a\rACGT\r>b\rGG\r',
+            'pre_header_lines': 'NNNN\n>a\nACGT\n',
+            'separator_bytes': '>a\nACG\x1c\n>b\n\x1fTT\n',
+            'non_ascii': '>a\nacg\u00e9\n>b\nac\u00a0\n',
+        }
+        for name, text in cases.items():
+            with self.subTest(case=name):
+                path = self.write_fasta(name + '.fa', text)
+                expected = contig_set_hash(read_fasta2(path))
+                self.assertEqual(fasta_contig_set_hash(path), expected)
+                # second call is served from the cached .cdmfai index
+                self.assertTrue(os.path.exists(path + '.cdmfai'))
+                self.assertEqual(fasta_contig_set_hash(path), expected)
+
+    def test_random_files_match_contig_set_hash(self):
+        rng = random.Random(5)
+        alphabet = ['>', 'a', 'C', ' ', '\r', '\n', '\t', '>h ', '\r\n', '\x1c', '\x1f', '\u00e9',
+                    '\u00a0']
+        for n in range(300):
+            text = ''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 30)))
+            path = self.write_fasta(f'random{n}.fa', text)
+            try:
+                expected = contig_set_hash(read_fasta2(path))
+            except Exception:
+                continue
+            with self.subTest(text=text):
+                self.assertEqual(fasta_contig_set_hash(path), expected)
+                self.assertEqual(calculate_hash.stream_contig_set_hash(path), expected)
+
+    def test_small_blocks_match_features(self):
+        path = self.write_fasta('blocks.fa', '>a\nac gt\nAC\n  GT  \n>b\n' + 'acgtn\n' * 50)
+        features = read_fasta2(path)
+        with IndexedFasta(path, cache_index=False) as fasta:
+            for record, feature in zip(fasta, features):
+                for block_size in (1, 3, 8, 1 << 20):
+                    data = b''.join(record.iter_blocks(block_size))
+                    self.assertEqual(data.decode(), feature.seq.upper())
+                self.assertEqual(record.hash_value,
+                                 hashlib.sha256(feature.seq.upper().encode()).hexdigest())
+
+    def unpack_test_genome(self, name):
+        path = str(Path(self.tmpdir) / name)
+        with gzip.open(DATA_DIR / (name + '.gz'), 'rb') as src, open(path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        return path
+
+    def test_parallel_hash_matches_serial(self):
+        path = self.unpack_test_genome('Bin.046.fa')
+        expected = contig_set_hash(read_fasta2(path))
+        for mean_length in (0, 1 << 40):
+            with mock.patch.object(calculate_hash, 'PARALLEL_MIN_TOTAL_LENGTH', 0), \
+                    mock.patch.object(calculate_hash, 'THREAD_MIN_MEAN_LENGTH', mean_length):
+                self.assertEqual(fasta_contig_set_hash(path, parallel=True, workers=2), expected)
+
+    def test_process_hashing_from_threads(self):
+        path = self.unpack_test_genome('Bin.046.fa')
+        expected = contig_set_hash(read_fasta2(path))
+        with mock.patch.object(calculate_hash, 'PARALLEL_MIN_TOTAL_LENGTH', 0), \
+                mock.patch.object(calculate_hash, 'THREAD_MIN_MEAN_LENGTH', 1 << 40), \
+                mock.patch.object(calculate_hash, '_shared_pools', {}) as pools, \
+                mock.patch.object(calculate_hash.os, 'cpu_count', return_value=2), \
+                ThreadPoolExecutor(max_workers=3) as executor:
+            hashes = list(executor.map(lambda _: fasta_contig_set_hash(path, parallel=True),
+                                       range(3)))
+            # All threads hash on one shared process pool
+            self.assertEqual(list(pools), ['process'])
+            # A file written again under the same path is not hashed from the old mapping
+            shutil.copyfile(self.unpack_test_genome('Bin.047.fa'), path)
+            os.remove(path + '.cdmfai')
+            changed = fasta_contig_set_hash(path, parallel=True)
+            pools['process'].shutdown()
+        self.assertEqual(hashes, [expected] * 3)
+        self.assertEqual(changed, contig_set_hash(read_fasta2(path)))
+
+    def test_stats_and_subset(self):
+        path = self.unpack_test_genome('Bin.001.fa')
+        features = {f.id: f.seq for f in read_fasta2(path)}
+        lengths = sorted((len(s) for s in features.values()), reverse=True)
+        with IndexedFasta(path) as fasta:
+            stats = fasta.size_stats()
+            self.assertEqual(stats['contig_count'], len(features))
+            self.assertEqual(stats['total_length'], sum(lengths))
+            self.assertIn(stats['n50'], lengths)
+            names = [fasta.records[3].name, fasta.records[0].name]
+            subset_path = fasta.write_subset(names, os.path.join(self.tmpdir, 'subset.fa'))
+        subset = read_fasta2(subset_path)
+        self.assertEqual([f.id for f in subset], names)
+        for f in subset:
+            self.assertEqual(f.seq, features[f.id])
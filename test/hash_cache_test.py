@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from kb_cdm_genome_match.utils2.calculate_hash import stream_contig_set_hash
+from kb_cdm_genome_match.utils2.hash_cache import CdmHashCache
+
+
+class hash_cacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_fasta(self, name, seq):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as fh:
+            fh.write(f'>{name}\n{seq}\n')
+        return path
+
+    def counting_hash(self, path):
+        self.calls.append(path)
+        return stream_contig_set_hash(path)
+
+    def test_get_or_compute_hashes_once(self):
+        cache = CdmHashCache(os.path.join(self.tmpdir, 'cache.sqlite'))
+        path = self.write_fasta('a.fa', 'ACGT')
+        first = cache.get_or_compute(path, self.counting_hash)
+        second = CdmHashCache(cache.db_path).get_or_compute(path, self.counting_hash)
+        self.assertEqual(first, stream_contig_set_hash(path))
+        self.assertEqual(second, first)
+        self.assertEqual(self.calls, [path])
+
+    def test_changed_file_is_rehashed(self):
+        cache = CdmHashCache(os.path.join(self.tmpdir, 'cache.sqlite'))
+        path = self.write_fasta('a.fa', 'ACGT')
+        cache.get_or_compute(path, self.counting_hash)
+        self.write_fasta('a.fa', 'ACGTACGT')
+        self.assertEqual(cache.get_or_compute(path, self.counting_hash),
+                         stream_contig_set_hash(path))
+        self.assertEqual(len(self.calls), 2)
+
+    def test_eviction_keeps_recently_used(self):
+        cache = CdmHashCache(os.path.join(self.tmpdir, 'cache.sqlite'), max_entries=2,
+                             evict_interval=1)
+        paths = [self.write_fasta(f'{n}.fa', 'ACGT' * (i + 1)) for i, n in enumerate('abc')]
+        cache.put(paths[0], 'h0')
+        cache.put(paths[1], 'h1')
+        cache.get(paths[0])
+        cache.put(paths[2], 'h2')
+        self.assertEqual(cache.get(paths[0]), 'h0')
+        self.assertIsNone(cache.get(paths[1]))
+        self.assertEqual(cache.get(paths[2]), 'h2')
+
+    def test_eviction_checked_every_interval(self):
+        cache = CdmHashCache(os.path.join(self.tmpdir, 'cache.sqlite'), max_entries=1,
+                             evict_interval=3)
+        paths = [self.write_fasta(f'{n}.fa', 'ACGT' * (i + 1)) for i, n in enumerate('abcd')]
+        for n, path in enumerate(paths):
+            cache.put(path, f'h{n}')
+        # Only puts 1 and 4 check the size, so the fourth put evicts a, b and c at once
+        self.assertEqual([cache.get(path) for path in paths], [None, None, None, 'h3'])
+        cache.put(paths[0], 'h0')
+        self.assertEqual([cache.get(path) for path in paths], ['h0', None, None, 'h3'])
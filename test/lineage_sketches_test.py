@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from kb_cdm_genome_match.utils2 import lineage_sketches, sketch_shards
+from kb_cdm_genome_match.utils2.lineage_sketches import build_lineage_sketches
+
+
+class lineage_sketchesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.tmpdir, 'lineages')
+        self.taxonomy_file = os.path.join(self.tmpdir, 'taxonomy.tsv')
+        self.sketched = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_taxonomy(self, rows):
+        with open(self.taxonomy_file, 'w') as fh:
+            fh.write('filepath\tdomain\tphylum\tclass\torder\tfamily\tgenus\n')
+            fh.writelines(f'{path}\td__B\tp__P\tc__C\to__O\tf__F\t{genus}\n'
+                          for path, genus in rows)
+
+    def fake_sketch(self, filepaths, output_prefix, *args):
+        self.sketched.append(filepaths)
+        with open(output_prefix + '.msh', 'w') as fh:
+            fh.write('\n'.join(filepaths))
+        open(output_prefix + '_queries.txt', 'w').close()
+        return output_prefix + '.msh'
+
+    def build(self):
+        with mock.patch.object(lineage_sketches, 'get_sketch_params',
+                               return_value={'kmer_size': 21, 'sketch_size': 1000}), \
+                mock.patch.object(sketch_shards, 'sketch_queries', side_effect=self.fake_sketch):
+            return build_lineage_sketches(self.taxonomy_file, '/db/db.msh', self.output_dir)
+
+    def test_changed_taxonomy_rebuilds_genus_files(self):
+        self.write_taxonomy([('/g/a.fa', 'g__A'), ('/g/b.fa', 'g__B')])
+        self.build()
+        self.assertEqual(self.sketched, [['/g/a.fa'], ['/g/b.fa']])
+        # An unchanged taxonomy resumes over the existing files
+        self.build()
+        self.assertEqual(len(self.sketched), 2)
+
+        self.write_taxonomy([('/g/c.fa', 'g__C'), ('/g/a.fa', 'g__A')])
+        self.build()
+        self.assertEqual(self.sketched[2:], [['/g/c.fa'], ['/g/a.fa']])
+        sketches = [name for name in os.listdir(self.output_dir) if name.endswith('.msh')]
+        self.assertEqual(sorted(sketches),
+                         ['000001_g__C.msh', '000002_g__A.msh'])
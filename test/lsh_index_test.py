@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from kb_cdm_genome_match.utils2.lsh_index import EMPTY, LSHIndex, build_lsh_index, slot_minima
+from kb_cdm_genome_match.utils2.minhash_engine import MinHashSketchDB, write_native_sketches
+from minhash_engine_test import mash_info_dump
+
+
+class lsh_indexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.rng = np.random.default_rng(5)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def bottom_sketch(self, kmers, sketch_size):
+        return sorted(int(h) for h in np.sort(kmers)[:sketch_size])
+
+    def test_slot_minima(self):
+        hashes = np.array([3, 4, 9, 2, 8], dtype=np.uint64)
+        minima = slot_minima(hashes, np.array([0, 3, 3, 5]), 3)
+        empty = int(EMPTY)
+        self.assertEqual(minima.tolist(), [[3, 4, empty], [empty] * 3, [empty, empty, 2]])
+
+    def test_search_finds_near_neighbours(self):
+        sketch_size = 256
+        genomes = [self.rng.integers(0, 2 ** 63, 5000, dtype=np.uint64) for _ in range(60)]
+        # Genome 60 is a close relative of genome 7
+        relative = genomes[7].copy()
+        relative[:250] = self.rng.integers(0, 2 ** 63, 250, dtype=np.uint64)
+        genomes.append(relative)
+        sketches = [(f'/refs/genome_{n}.fa', self.bottom_sketch(g, sketch_size))
+                    for n, g in enumerate(genomes)]
+        native_dir = os.path.join(self.tmpdir, 'db.msh.minhash')
+        write_native_sketches(mash_info_dump(sketches, 21, sketch_size), native_dir)
+        sketch_db = MinHashSketchDB(native_dir)
+        index_dir = build_lsh_index(sketch_db, bands=16, rows=2)
+
+        lsh = LSHIndex(index_dir)
+        query = sketch_db.sketch(7)
+        self.assertEqual(lsh.candidates(query).tolist(), [7, 60])
+        exhaustive = sketch_db.chunk_distances(query, 0, len(sketch_db))
+        hits = lsh.search(query, top_n=5, max_mash_distance=0.1)
+        self.assertEqual([name for name, _ in hits], ['/refs/genome_7.fa', '/refs/genome_60.fa'])
+        np.testing.assert_allclose([d for _, d in hits], exhaustive[[7, 60]])
+
+        self.assertEqual(LSHIndex(index_dir, max_candidates=1).candidates(query).tolist(), [7])
+        self.assertEqual(LSHIndex(index_dir, min_band_hits=17).candidates(query).tolist(), [])
@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from kb_cdm_genome_match.utils2 import mash_skani_multiple
+from kb_cdm_genome_match.utils2.mash_skani_multiple import (
+    SearchOptions,
+    TopMatches,
+    _input_order,
+    best_hit_rows,
+    load_skani_sketches,
+    mash_skani_pipeline,
+    ordered_outputs,
+    parse_lineage,
+    pipeline_fingerprint,
+    reference_db_version,
+    run_lineage_mash_search,
+    run_skani,
+    run_skani_batch,
+    skipped_query_results,
+    stored_query_results,
+)
+from kb_cdm_genome_match.utils2.result_memo import QueryResultMemo
+
+SKANI_HEADER = ("Ref_file\tQuery_file\tANI\tAlign_fraction_ref\tAlign_fraction_query\t"
+                "Ref_name\tQuery_name\n")
+
+
+def skani_output(rows):
+    return subprocess.CompletedProcess([], 0, SKANI_HEADER + "".join(
+        f"{ref}\t/q/query.fa\t{skani}\t{ani}\t{shared}\tr\tq\n"
+        for ref, skani, ani, shared in rows), "")
+
+
+class mash_skani_multipleTest(unittest.TestCase):
+
+    def test_top_matches_equals_stable_sort(self):
+        rng = random.Random(7)
+        for _ in range(200):
+            hits = [(f"g{i}.fa", rng.choice([0.01, 0.02, 0.03, 0.04]))
+                    for i in range(rng.randint(0, 40))]
+            top_n = rng.randint(0, 12)
+            top_matches = TopMatches(top_n)
+            for genome, distance in hits:
+                top_matches.add(genome, distance)
+            self.assertEqual(top_matches.matches(), sorted(hits, key=lambda x: x[1])[:top_n])
+
+    def test_parse_lineage(self):
+        self.assertEqual(parse_lineage('d__Bacteria;p__Bacillota;c__Bacilli;o__Bacillales;'
+                                       'f__Bacillaceae;g__Bacillus;s__Bacillus subtilis'),
+                         ('d__Bacteria', 'p__Bacillota', 'c__Bacilli', 'o__Bacillales',
+                          'f__Bacillaceae', 'g__Bacillus'))
+        self.assertEqual(parse_lineage('d__Bacteria; p__Bacillota;c__;o__;f__;g__;s__'),
+                         ('d__Bacteria', 'p__Bacillota', '', '', '', ''))
+        self.assertEqual(parse_lineage(None), ('',) * 6)
+
+    def test_lineage_search_falls_back_above_order(self):
+        lineage_index = [(parse_lineage('d__B;p__P1;c__C1;o__O1;f__F1;g__G1'), '/l/1.msh'),
+                         (parse_lineage('d__B;p__P1;c__C1;o__O1;f__F2;g__G2'), '/l/2.msh'),
+                         (parse_lineage('d__B;p__P1;c__C1;o__O2;f__F3;g__G3'), '/l/3.msh'),
+                         (parse_lineage('d__B;p__P2;c__C2;o__O3;f__F4;g__G4'), '/l/4.msh')]
+        searched = []
+
+        def fake_search(sketch_files, query, top_n, max_mash_distance, processes, top_matches):
+            searched.append(sorted(sketch_files))
+            return top_matches
+
+        with mock.patch.object(mash_skani_multiple, 'sketch_queries',
+                               return_value='/tmp/query.msh'), \
+                mock.patch.object(mash_skani_multiple, 'search_sketch_files',
+                                  side_effect=fake_search), \
+                mock.patch.object(mash_skani_multiple, 'search_mash_db',
+                                  return_value={'/q/query.fa': [('g.fa', 0.01)]}) as search_db:
+            params = {'kmer_size': 21, 'sketch_size': 1000}
+            lineage = 'd__B;p__P1;c__C1;o__O1;f__F1;g__G1'
+            matches = run_lineage_mash_search('/q/query.fa', lineage + ';s__S', lineage_index,
+                                              sketch_params=params, mash_db='/db/db.msh')
+            self.assertEqual(matches, [('g.fa', 0.01)])
+            self.assertEqual(searched, [['/l/1.msh'], ['/l/2.msh']])
+            search_db.assert_called_once_with('/db/db.msh', '/tmp/query.msh', 10, 0.05, None)
+
+            # Without the combined database, the search widens up to the domain
+            searched.clear()
+            self.assertEqual(run_lineage_mash_search('/q/query.fa', lineage, lineage_index,
+                                                     sketch_params=params), [])
+            self.assertEqual(searched, [['/l/1.msh'], ['/l/2.msh'], ['/l/3.msh'], ['/l/4.msh']])
+
+    @mock.patch.object(mash_skani_multiple, 'reference_cdm_hash',
+                       side_effect=lambda path, *args: path[-4])
+    def test_batched_skani_matches_per_pair_records(self, _):
+        rows = [('/r/b.fa', 97.0, 96.5, 80.1), ('/r/a.fa', 99.0, 98.0, 91.2),
+                ('/r/c.fa', 90.0, 94.0, 70.0)]
+        with mock.patch.object(mash_skani_multiple.subprocess, 'run',
+                               return_value=skani_output(rows)) as run:
+            records = run_skani_batch('1/2/3', '/q/query.fa', ['/r/a.fa', '/r/b.fa', '/r/c.fa'],
+                                      95.0)
+        self.assertEqual(run.call_count, 1)
+        self.assertEqual(sorted(records), ['/r/a.fa', '/r/b.fa'])
+        for ref, skani, ani, shared in rows[:2]:
+            with mock.patch.object(mash_skani_multiple.subprocess, 'run',
+                                   return_value=skani_output([(ref, skani, ani, shared)])):
+                self.assertEqual(records[ref], run_skani('1/2/3', '/q/query.fa', ref, 95.0))
+
+        with mock.patch.object(mash_skani_multiple.subprocess, 'run',
+                               return_value=subprocess.CompletedProcess([], 1, "", "error")):
+            self.assertIsNone(run_skani_batch('1/2/3', '/q/query.fa', ['/r/a.fa'], 95.0))
+
+    @mock.patch.object(mash_skani_multiple, 'reference_cdm_hash', return_value='h' * 64)
+    def test_skani_uses_prebuilt_sketches(self, _):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        manifest = os.path.join(tmpdir, 'db.skani.tsv')
+        with open(manifest, 'w') as fh:
+            fh.write('filepath\tsketch\n')
+            fh.write('/r/a.fa\tpart_0001/a.fa.sketch\n/r/b.fa\tpart_0001/b.fa.sketch\n')
+        with open(os.path.join(tmpdir, 'db.skani.json'), 'w') as fh:
+            json.dump({'skani_version': 'skani 0.2.2'}, fh)
+        os.makedirs(os.path.join(tmpdir, 'part_0001'))
+        a_sketch = os.path.join(tmpdir, 'part_0001', 'a.fa.sketch')
+        open(a_sketch, 'w').close()
+
+        with mock.patch.object(mash_skani_multiple, 'get_skani_version',
+                               return_value='skani 0.2.3'):
+            self.assertEqual(load_skani_sketches(manifest), {})
+        with mock.patch.object(mash_skani_multiple, 'get_skani_version',
+                               return_value='skani 0.2.2'):
+            sketches = load_skani_sketches(manifest)
+
+        # b.fa has a manifest entry but its sketch file is missing, so its FASTA is used
+        rows = [(a_sketch, 97.0, 96.5, 80.1), ('/r/b.fa', 99.0, 98.0, 91.2)]
+        written = []
+
+        def fake_run(cmd, **kwargs):
+            with open(cmd[cmd.index('--rl') + 1]) as fh:
+                written.extend(fh.read().split())
+            return skani_output(rows)
+
+        with mock.patch.object(mash_skani_multiple.subprocess, 'run', side_effect=fake_run):
+            records = run_skani_batch('1/2/3', '/q/query.fa', ['/r/a.fa', '/r/b.fa'], 95.0,
+                                      skani_sketches=sketches)
+        self.assertEqual(written, [a_sketch, '/r/b.fa'])
+        self.assertEqual(sorted(records), ['/r/a.fa', '/r/b.fa'])
+        self.assertEqual(records['/r/a.fa']['reference'], 'a.fa')
+
+    def test_concurrent_queries_keep_input_order(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        queries = {f'1/{n}/1': f'/q/query{n}.fa' for n in range(6)}
+        taxonomy = {f'ref{n}.fa': (f'/r/ref{n}.fa', f'd__{n}') for n in range(6)}
+
+        def fake_mash(query_fasta, *args, **kwargs):
+            # Earlier queries finish last
+            time.sleep(0.01 * (6 - int(query_fasta[-4])))
+            return [(f'ref{query_fasta[-4]}.fa', 0.01)]
+
+        def fake_skani(ref, query_fasta, ref_path, *args):
+            return {'input_ref': ref, 'query': query_fasta, 'cdm_hash': 'h', 'reference': ref_path,
+                    'skani': 99.0, 'ani': 99.0, 'shared_kmers': 90.0}
+
+        outputs = []
+        for query_workers in (1, 4):
+            output_csv = os.path.join(tmpdir, f'results{query_workers}.csv')
+            with mock.patch.object(mash_skani_multiple, 'load_taxonomy_data',
+                                   return_value=taxonomy), \
+                    mock.patch.object(mash_skani_multiple, 'run_mash_search',
+                                      side_effect=fake_mash), \
+                    mock.patch.object(mash_skani_multiple, 'run_skani', side_effect=fake_skani), \
+                    mock.patch.object(mash_skani_multiple, 'append_metadata_to_object') as append:
+                mash_skani_pipeline(queries, '/db/db.msh', '/db/taxonomy.tsv', 'ws', 'wsname', [],
+                                    output_csv=output_csv,
+                                    options=SearchOptions(query_workers=query_workers))
+            self.assertEqual([call[0][0] for call in append.call_args_list], list(queries))
+            with open(output_csv) as fh:
+                outputs.append(fh.read())
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_query_hashed_once(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        queries = {'1/2/3': '/q/query2.fa', '1/3/3': '/q/query3.fa'}
+        taxonomy = {'ref.fa': ('/r/ref.fa', 'd__B')}
+        hash_index_file = os.path.join(tmpdir, 'hash_index.tsv')
+        open(hash_index_file, 'w').close()
+        mash_hashes = []
+
+        def fake_mash(query_fasta, *args, query_hash=None, **kwargs):
+            mash_hashes.append(query_hash)
+            return [('ref.fa', 0.01)]
+
+        def fake_hash(path, **kwargs):
+            return 'h' + path[-4]
+
+        with mock.patch.object(mash_skani_multiple, 'load_taxonomy_data', return_value=taxonomy), \
+                mock.patch.object(mash_skani_multiple, 'load_hash_index',
+                                  return_value={'/r/other.fa': 'x'}), \
+                mock.patch.object(mash_skani_multiple, 'get_sketch_params', return_value={}), \
+                mock.patch.object(mash_skani_multiple, 'skani_ani_cache',
+                                  return_value=mock.Mock()), \
+                mock.patch.object(mash_skani_multiple, 'fasta_contig_set_hash',
+                                  side_effect=fake_hash) as hash_fasta, \
+                mock.patch.object(mash_skani_multiple, 'run_mash_search', side_effect=fake_mash), \
+                mock.patch.object(mash_skani_multiple, 'run_skani', return_value=None) as skani, \
+                mock.patch.object(mash_skani_multiple, 'append_metadata_to_object'):
+            mash_skani_pipeline(queries, '/db/db.msh', '/db/taxonomy.tsv', 'ws', 'wsname', [],
+                                output_csv=os.path.join(tmpdir, 'results.csv'),
+                                options=SearchOptions(hash_index_file=hash_index_file),
+                                sketch_cache=mock.Mock(), ani_cache=mock.Mock(),
+                                result_memo=QueryResultMemo(os.path.join(tmpdir, 'memo.sqlite')))
+        # The memo, exact-match lookup, sketch cache and Skani ANI cache share one hash per query
+        self.assertEqual(sorted(call[0][0] for call in hash_fasta.call_args_list),
+                         sorted(queries.values()))
+        self.assertEqual(mash_hashes, ['h2', 'h3'])
+        self.assertEqual([call[0][8] for call in skani.call_args_list], ['h2', 'h3'])
+
+    @mock.patch.object(mash_skani_multiple, 'reference_cdm_hash', return_value='h')
+    def test_skani_errors_are_not_memoized(self, _):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        memo = QueryResultMemo(os.path.join(tmpdir, 'memo.sqlite'))
+        fingerprint = pipeline_fingerprint(10, 0.05, 95.0)
+        db_version = reference_db_version('/db/db.msh', '/db/taxonomy.tsv')
+
+        def run(skani_result):
+            with mock.patch.object(mash_skani_multiple, 'load_taxonomy_data',
+                                   return_value={'ref.fa': ('/r/ref.fa', 'd__B')}), \
+                    mock.patch.object(mash_skani_multiple, 'fasta_contig_set_hash',
+                                      return_value='qa'), \
+                    mock.patch.object(mash_skani_multiple, 'run_mash_search',
+                                      return_value=[('ref.fa', 0.01)]), \
+                    mock.patch.object(mash_skani_multiple.subprocess, 'run',
+                                      return_value=skani_result), \
+                    mock.patch.object(mash_skani_multiple, 'append_metadata_to_object') as append:
+                mash_skani_pipeline({'1/2/3': '/q/query.fa'}, '/db/db.msh', '/db/taxonomy.tsv',
+                                    'ws', 'wsname', [], result_memo=memo,
+                                    output_csv=os.path.join(tmpdir, 'results.csv'))
+            return append.call_args[0][5:7]
+
+        # A failed Skani run is not stored as "no hit", nor stamped as current in the object
+        # metadata
+        self.assertEqual(run(subprocess.CompletedProcess([], 1, "", "error")), (None, None))
+        self.assertIsNone(memo.get('qa', fingerprint, db_version, '1/2/3', 'query.fa'))
+        self.assertEqual(run(skani_output([('/r/ref.fa', 99.0, 98.0, 91.2)])),
+                         (db_version, fingerprint))
+        rows, hits = memo.get('qa', fingerprint, db_version, '1/2/3', 'query.fa')
+        self.assertEqual([hit['name'] for hit in hits], ['ref.fa'])
+
+    def test_skipped_genomes_keep_rows_and_order(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        taxonomy = {'ref.fa': ('/r/ref.fa', 'd__B')}
+        best_hit = {'cdm_hash': 'h', 'skani': 99.0, 'ani': 98.5, 'shared_kmers': 90.0,
+                    'name': 'ref.fa'}
+        memo = QueryResultMemo(os.path.join(tmpdir, 'memo.sqlite'))
+        memo.put('qa', pipeline_fingerprint(10, 0.05, 95.0),
+                 reference_db_version('/db/db.msh', '/db/taxonomy.tsv'),
+                 [{'input_ref': '9/9/9', 'query': 'old.fa', 'cdm_hash': 'h', 'reference': 'ref.fa',
+                   'skani': 99.0, 'ani': 98.5, 'shared_kmers': 90.0, 'mash_distance': 0.02,
+                   'taxonomy': 'd__B'}],
+                 [best_hit])
+        # 1/1/1 is rebuilt from the memo, 1/3/1 (not in the memo) from its best hit
+        current_hits = {'1/1/1': ('a.fa', 'qa', best_hit),
+                        '1/3/1': ('c.fa', 'qc', best_hit)}
+
+        def fake_skani(ref, query_fasta, ref_path, *args):
+            return {'input_ref': ref, 'query': query_fasta, 'cdm_hash': 'h', 'reference': 'ref.fa',
+                    'skani': 99.0, 'ani': 99.0, 'shared_kmers': 90.0}
+
+        with mock.patch.object(mash_skani_multiple, 'load_taxonomy_data', return_value=taxonomy), \
+                mock.patch.object(mash_skani_multiple.pd, 'DataFrame') as data_frame, \
+                mock.patch.object(mash_skani_multiple, 'fasta_contig_set_hash',
+                                  return_value='qb'), \
+                mock.patch.object(mash_skani_multiple, 'run_mash_search',
+                                  return_value=[('ref.fa', 0.01)]), \
+                mock.patch.object(mash_skani_multiple, 'run_skani', side_effect=fake_skani), \
+                mock.patch.object(mash_skani_multiple, 'append_metadata_to_object') as append:
+            mash_skani_pipeline({'1/2/1': '/q/b.fa'}, '/db/db.msh', '/db/taxonomy.tsv',
+                                'ws', 'wsname', [],
+                                output_csv=os.path.join(tmpdir, 'results.csv'), result_memo=memo,
+                                current_hits=current_hits,
+                                ref_list=['1/1/1', '1/2/1', '1/3/1'])
+        # Only the searched genome is annotated, with its query file name and hash
+        self.assertEqual([call[0][0] for call in append.call_args_list], ['1/2/1'])
+        self.assertEqual(append.call_args[0][-2:], ('b.fa', 'qb'))
+        rows = data_frame.call_args[0][0]
+        self.assertEqual([(row['input_ref'], row['query'], row.get('mash_distance'),
+                           row['taxonomy']) for row in rows],
+                         [('1/1/1', 'a.fa', 0.02, 'd__B'), ('1/2/1', 'b.fa', 0.01, 'd__B'),
+                          ('1/3/1', 'c.fa', None, 'd__B')])
+
+    def test_input_order_places_set_genomes(self):
+        self.assertEqual(_input_order(['set', '1/1/1', '1/5/1'], {'1/1/1'},
+                                      ['1/2/1', '1/3/1', '1/5/1']),
+                         ['1/2/1', '1/3/1', '1/1/1', '1/5/1'])
+        self.assertEqual(_input_order(['1/5/1', '1/1/1'], {'1/1/1': None}, ['1/5/1']),
+                         ['1/5/1', '1/1/1'])
+
+    def test_ordered_outputs(self):
+        def slow_square(n):
+            time.sleep(random.random() / 100)
+            return n * n
+
+        for workers in (1, 4):
+            self.assertEqual(list(ordered_outputs(slow_square, range(20), workers)),
+                             [n * n for n in range(20)])
+
+    def test_stored_and_skipped_query_results(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        memo = QueryResultMemo(os.path.join(tmpdir, 'memo.sqlite'))
+        best_hit = {'cdm_hash': 'h', 'skani': 99.0, 'ani': 98.5, 'shared_kmers': 90.0,
+                    'name': 'ref.fa'}
+        rows = [{'input_ref': '9/9/9', 'query': 'old.fa', 'reference': 'ref.fa'}]
+        memo.put('qa', 'fp', 'db', rows, [best_hit])
+
+        # Stored rows are handed to the ref and query they are looked up for
+        self.assertEqual(stored_query_results(memo, {'1/1/1': 'qa', '1/2/1': 'qb'},
+                                              {'1/1/1': 'a.fa', '1/2/1': 'b.fa'}, 'fp', 'db'),
+                         {'1/1/1': ([{'input_ref': '1/1/1', 'query': 'a.fa',
+                                      'reference': 'ref.fa'}], [best_hit])})
+        self.assertEqual(stored_query_results(memo, {'1/1/1': 'qa'}, {'1/1/1': 'a.fa'},
+                                              'fp', 'db2'), {})
+
+        # Skipped genomes fall back to their best hit when the memo does not have them
+        current_hits = {'1/1/1': ('a.fa', 'qa', best_hit),
+                        '1/3/1': ('c.fa', 'qc', best_hit)}
+        taxonomy = {'ref.fa': ('/r/ref.fa', 'd__B')}
+        skipped = skipped_query_results(current_hits, taxonomy, memo, 'fp', 'db')
+        self.assertEqual(skipped['1/1/1'][0][0]['query'], 'a.fa')
+        self.assertEqual(skipped['1/3/1'], ([{'input_ref': '1/3/1', 'query': 'c.fa',
+                                              'cdm_hash': 'h', 'reference': 'ref.fa',
+                                              'skani': 99.0, 'ani': 98.5, 'shared_kmers': 90.0,
+                                              'taxonomy': 'd__B'}], []))
+        self.assertEqual(skipped_query_results(current_hits, {}), {
+            ref: (best_hit_rows({ref: hit}, {}), []) for ref, hit in current_hits.items()})
+
+    def test_search_options_fingerprint_and_indexes(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        species_index = os.path.join(tmpdir, 'db.species.tsv')
+        open(species_index, 'w').close()
+        missing = os.path.join(tmpdir, 'missing.lineages.tsv')
+        options = SearchOptions(max_hits=1, species_index=species_index,
+                                lineage_index=missing).guided('/db/db.msh')
+        # Missing indexes are dropped
+        self.assertEqual((options.lineage_index, options.species_index), (None, species_index))
+        self.assertEqual(options.fingerprint(10, 0.05, 95.0),
+                         pipeline_fingerprint(10, 0.05, 95.0, max_hits=1,
+                                              species_index=species_index))
+        self.assertEqual(options.db_version('/db/db.msh', '/db/taxonomy.tsv'),
+                         reference_db_version('/db/db.msh', '/db/taxonomy.tsv',
+                                              species_index=species_index))
+
+    def test_early_stop_and_deepening(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        taxonomy = {f'ref{n}.fa': (f'/r/ref{n}.fa', f'd__{n}') for n in range(8)}
+        distances = [0.01, 0.02, 0.03, 0.04, 0.06, 0.07, 0.08, 0.09]
+        passing = {'/r/ref1.fa', '/r/ref2.fa', '/r/ref6.fa'}
+
+        def fake_mash(query_fasta, mash_db, top_n, max_distance, *args, **kwargs):
+            return [(f'ref{n}.fa', d) for n, d in enumerate(distances) if d <= max_distance][:top_n]
+
+        def fake_skani(ref, query_fasta, ref_path, *args):
+            if ref_path in passing:
+                return {'input_ref': ref, 'query': query_fasta, 'cdm_hash': 'h',
+                        'reference': ref_path, 'skani': 99.0, 'ani': 99.0, 'shared_kmers': 90.0}
+            return None
+
+        def run(**kwargs):
+            with mock.patch.object(mash_skani_multiple, 'load_taxonomy_data',
+                                   return_value=taxonomy), \
+                    mock.patch.object(mash_skani_multiple, 'run_mash_search',
+                                      side_effect=fake_mash) as mash, \
+                    mock.patch.object(mash_skani_multiple, 'run_skani',
+                                      side_effect=fake_skani) as skani, \
+                    mock.patch.object(mash_skani_multiple, 'append_metadata_to_object') as append:
+                mash_skani_pipeline({'1/2/3': '/q/query.fa'}, '/db/db.msh', '/db/taxonomy.tsv',
+                                    'ws', 'wsname', [], top_n=3, max_mash_distance=0.05,
+                                    output_csv=os.path.join(tmpdir, 'results.csv'),
+                                    options=SearchOptions(**kwargs))
+            return ([hit['name'] for hit in append.call_args[0][3]], mash.call_count,
+                    [call[0][2] for call in skani.call_args_list])
+
+        self.assertEqual(run(),
+                         (['ref1.fa', 'ref2.fa'], 1, ['/r/ref0.fa', '/r/ref1.fa', '/r/ref2.fa']))
+        # Best hit: Skani stops at the first confirmed hit
+        self.assertEqual(run(max_hits=1), (['ref1.fa'], 1, ['/r/ref0.fa', '/r/ref1.fa']))
+        # Deepening verifies more candidates of the one Mash search until three hits are confirmed
+        self.assertEqual(run(max_hits=3, deepen_max_distance=0.1, deepen_step=2),
+                         (['ref1.fa', 'ref2.fa', 'ref6.fa'], 1,
+                          ['/r/ref0.fa', '/r/ref1.fa', '/r/ref2.fa', '/r/ref3.fa', '/r/ref4.fa',
+                           '/r/ref5.fa', '/r/ref6.fa']))
+        # and stops at the distance ceiling
+        self.assertEqual(run(max_hits=4, deepen_max_distance=0.065, deepen_step=2),
+                         (['ref1.fa', 'ref2.fa'], 1,
+                          ['/r/ref0.fa', '/r/ref1.fa', '/r/ref2.fa', '/r/ref3.fa', '/r/ref4.fa']))
+
+    def test_deepening_searches_mash_once(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        taxonomy = {f'ref{n}.fa': (f'/r/ref{n}.fa', 'd__B') for n in range(200)}
+
+        def fake_mash(query_fasta, mash_db, top_n, max_distance, *args, **kwargs):
+            matches = [(f'ref{n}.fa', 0.0005 * n) for n in range(200)]
+            return [match for match in matches if match[1] <= max_distance][:top_n]
+
+        with mock.patch.object(mash_skani_multiple, 'load_taxonomy_data', return_value=taxonomy), \
+                mock.patch.object(mash_skani_multiple, 'run_mash_search',
+                                  side_effect=fake_mash) as mash, \
+                mock.patch.object(mash_skani_multiple, 'run_skani', return_value=None) as skani, \
+                mock.patch.object(mash_skani_multiple, 'append_metadata_to_object'):
+            mash_skani_pipeline({'1/2/3': '/q/query.fa'}, '/db/db.msh', '/db/taxonomy.tsv', 'ws',
+                                'wsname', [], output_csv=os.path.join(tmpdir, 'results.csv'),
+                                options=SearchOptions(deepen_max_distance=0.1))
+        self.assertEqual(mash.call_count, 1)
+        self.assertEqual([call[0][2] for call in skani.call_args_list],
+                         [f'/r/ref{n}.fa' for n in range(200)])
+
+    def test_fingerprint_records_indexes_in_use(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with mock.patch.object(mash_skani_multiple, 'load_taxonomy_data', return_value={}), \
+                mock.patch.object(mash_skani_multiple, 'run_mash_search', return_value=[]), \
+                mock.patch.object(mash_skani_multiple, 'append_metadata_to_object') as append:
+            mash_skani_pipeline({'1/2/3': '/q/query.fa'}, '/db/db.msh', '/db/taxonomy.tsv',
+                                'ws', 'wsname', [],
+                                output_csv=os.path.join(tmpdir, 'results.csv'),
+                                options=SearchOptions(lineage_index='/i/missing.lineages.tsv',
+                                                      species_index='/i/missing.species.tsv'),
+                                query_lineages={'1/2/3': 'd__B'})
+        # Missing indexes are searched without, and the fingerprint says so
+        self.assertEqual(append.call_args[0][6], pipeline_fingerprint(10, 0.05, 95.0))
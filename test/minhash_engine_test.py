@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import json
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from kb_cdm_genome_match.utils2.minhash_engine import (
+    MinHashSketchDB,
+    sketch_distances,
+    write_native_sketches,
+)
+
+
+def mash_dist(ref, qry, sketch_size, kmer_size):
+    """
+    Port of the sketch comparison loop in Mash's CommandDistance.cpp.
+    """
+    i = j = common = denom = 0
+    while denom < sketch_size and i < len(ref) and j < len(qry):
+        if ref[i] < qry[j]:
+            i += 1
+        elif qry[j] < ref[i]:
+            j += 1
+        else:
+            i += 1
+            j += 1
+            common += 1
+        denom += 1
+    if denom < sketch_size:
+        denom = min(sketch_size, denom + len(ref) - i + len(qry) - j)
+    if common == denom:
+        return 0.0
+    if common == 0:
+        return 1.0
+    jaccard = common / denom
+    return -math.log(2 * jaccard / (1 + jaccard)) / kmer_size
+
+
+def mash_info_dump(sketches, kmer_size, sketch_size):
+    """
+    Writes sketches in the line layout of `mash info -d`.
+    """
+    lines = ['{', f'\t"kmer" : {kmer_size},', '\t"alphabet" : "ACGT",',
+             f'\t"sketchSize" : {sketch_size},', '\t"hashBits" : 64,', '\t"sketches" :', '\t[']
+    for n, (name, hashes) in enumerate(sketches):
+        lines += ['\t\t{', f'\t\t\t"name" : {json.dumps(name)},', f'\t\t\t"length" : {1000 + n},',
+                  '\t\t\t"comment" : "[1 seqs] x",', '\t\t\t"hashes" :', '\t\t\t[']
+        lines += [f'\t\t\t\t{h}' + (',' if k < len(hashes) - 1 else '')
+                  for k, h in enumerate(hashes)]
+        lines += ['\t\t\t]', '\t\t}' + (',' if n < len(sketches) - 1 else '')]
+    lines += ['\t]', '}']
+    return [line + '\n' for line in lines]
+
+
+class minhash_engineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.rng = np.random.default_rng(11)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def random_sketches(self, count, sketch_size, pool):
+        sketches = []
+        for n in range(count):
+            size = int(self.rng.integers(0, sketch_size + 1))
+            hashes = sorted(int(h) for h in self.rng.choice(pool, size, replace=False))
+            sketches.append((f'/refs/genome_{n}.fa', hashes))
+        return sketches
+
+    def build_db(self, name, sketches, kmer_size=21, sketch_size=20):
+        out_dir = os.path.join(self.tmpdir, name)
+        write_native_sketches(mash_info_dump(sketches, kmer_size, sketch_size), out_dir)
+        return MinHashSketchDB(out_dir)
+
+    def test_kernel_matches_mash_loop(self):
+        pool = np.array([2 ** 64 - 1 - k for k in range(40)] + list(range(40)), dtype=np.uint64)
+        refs = self.random_sketches(60, 20, pool)
+        hashes = np.array([h for _, s in refs for h in s], dtype=np.uint64)
+        offsets = np.cumsum([0] + [len(s) for _, s in refs])
+        for query in self.random_sketches(20, 20, pool):
+            query = np.array(query[1], dtype=np.uint64)
+            distances, _, _ = sketch_distances(query, hashes, offsets, 20, 21)
+            expected = [mash_dist(s, query.tolist(), 20, 21) for _, s in refs]
+            np.testing.assert_allclose(distances, expected, rtol=1e-12)
+
+    def test_dump_round_trip(self):
+        sketches = [('/refs/a "x".fa', [5, 3, 9]), ('/refs/b.fa', []),
+                    ('/refs/c.fa', [2 ** 64 - 1])]
+        db = self.build_db('db', sketches, kmer_size=17, sketch_size=1000)
+        self.assertEqual((db.kmer_size, db.sketch_size, len(db)), (17, 1000, 3))
+        self.assertEqual(db.names, [name for name, _ in sketches])
+        self.assertEqual(db.sketch(0).tolist(), [3, 5, 9])
+        self.assertEqual(db.sketch(1).tolist(), [])
+        self.assertEqual(db.sketch(2).tolist(), [2 ** 64 - 1])
+        self.assertEqual(db.lengths.tolist(), [1000, 1001, 1002])
+
+    def test_search_matches_stable_sort(self):
+        pool = np.arange(60, dtype=np.uint64)
+        db = self.build_db('db', self.random_sketches(300, 20, pool))
+        queries = self.build_db('queries', self.random_sketches(3, 20, pool))
+        for processes, chunk in ((1, 2048), (1, 7), (2, 50)):
+            hits = db.search(queries, top_n=5, max_mash_distance=0.2, processes=processes,
+                             chunk_sketches=chunk)
+            for q, name in enumerate(queries.names):
+                query = queries.sketch(q).tolist()
+                expected = [(ref, mash_dist(db.sketch(i).tolist(), query, 20, 21))
+                            for i, ref in enumerate(db.names)]
+                expected = sorted([e for e in expected if e[1] <= 0.2], key=lambda e: e[1])[:5]
+                self.assertEqual([ref for ref, _ in hits[name]], [ref for ref, _ in expected])
+                np.testing.assert_allclose([d for _, d in hits[name]], [d for _, d in expected])
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from kb_cdm_genome_match.utils2.mash_skani_multiple import (
+    pipeline_fingerprint,
+    reference_db_version,
+)
+from kb_cdm_genome_match.utils2.result_memo import QueryResultMemo
+
+
+class result_memoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_stored_results_are_addressed_to_the_new_object(self):
+        memo = QueryResultMemo(os.path.join(self.tmpdir, 'memo.sqlite'))
+        rows = [{'input_ref': '1/2/3', 'query': 'a.fa', 'cdm_hash': 'h', 'reference': 'r.fa',
+                 'skani': 99.0, 'ani': 98.5, 'shared_kmers': '90.1', 'mash_distance': 0.01,
+                 'taxonomy': 'd__B'}]
+        hits = [{'cdm_hash': 'h', 'skani': 99.0, 'ani': 98.5, 'shared_kmers': '90.1',
+                 'name': 'r.fa'}]
+        memo.put('q', 'params', 'db1', rows, hits)
+
+        self.assertEqual(QueryResultMemo(memo.db_path).get('q', 'params', 'db1', '1/2/3', 'a.fa'),
+                         (rows, hits))
+        stored_rows, _ = memo.get('q', 'params', 'db1', '4/5/6', 'b.fa')
+        self.assertEqual(list(stored_rows[0].items())[:3],
+                         [('input_ref', '4/5/6'), ('query', 'b.fa'), ('cdm_hash', 'h')])
+        self.assertIsNone(memo.get('q', 'params', 'db2', '1/2/3', 'a.fa'))
+        self.assertIsNone(memo.get('q', 'other', 'db1', '1/2/3', 'a.fa'))
+
+    def test_puts_from_threads(self):
+        memo = QueryResultMemo(os.path.join(self.tmpdir, 'memo.sqlite'), max_entries=50,
+                               evict_interval=10)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(lambda n: memo.put(f'q{n}', 'params', 'db1', [], []), range(200)))
+        # Every put is counted, so the size is checked every evict_interval puts and can only run
+        # over by that many entries plus the puts still in flight on other threads
+        self.assertEqual(memo._puts, 200)
+        with memo._connect() as conn:
+            (count,) = conn.execute('SELECT COUNT(*) FROM query_results').fetchone()
+        self.assertLessEqual(count, 50 + 10 + 4)
+        self.assertEqual(memo.get('q199', 'params', 'db1', '1/2/3', 'a.fa'), ([], []))
+
+    def test_fingerprints(self):
+        fingerprint = pipeline_fingerprint(10, 0.05, 95.0)
+        self.assertEqual(fingerprint, pipeline_fingerprint('10', '0.05', '95'))
+        self.assertNotEqual(fingerprint, pipeline_fingerprint(10, 0.05, 96.0))
+        self.assertNotEqual(fingerprint, pipeline_fingerprint(10, 0.05, 95.0, max_hits=1))
+        # The LSH settings only apply without a species index
+        self.assertEqual(pipeline_fingerprint(10, 0.05, 95.0, species_index='s', lsh_index='l'),
+                         pipeline_fingerprint(10, 0.05, 95.0, species_index='s'))
+
+        mash_db = os.path.join(self.tmpdir, 'db.msh')
+        taxonomy_file = os.path.join(self.tmpdir, 'taxonomy.tsv')
+        for path in (mash_db, taxonomy_file):
+            with open(path, 'w') as fh:
+                fh.write('x')
+        version = reference_db_version(mash_db, taxonomy_file)
+        with open(taxonomy_file, 'a') as fh:
+            fh.write('y')
+        self.assertNotEqual(reference_db_version(mash_db, taxonomy_file), version)
+
+    def test_db_version_covers_indexes(self):
+        paths = {}
+        for name in ('db.msh', 'taxonomy.tsv', 'hash_index.tsv', 'lineages.tsv', 'species.tsv',
+                     'lsh/meta.json'):
+            paths[name] = os.path.join(self.tmpdir, name)
+            os.makedirs(os.path.dirname(paths[name]), exist_ok=True)
+            with open(paths[name], 'w') as fh:
+                fh.write('x')
+        args = [paths['db.msh'], paths['taxonomy.tsv'], paths['hash_index.tsv'],
+                paths['lineages.tsv'], None, os.path.join(self.tmpdir, 'lsh')]
+        version = reference_db_version(*args)
+        for name in ('hash_index.tsv', 'lineages.tsv', 'lsh/meta.json'):
+            with open(paths[name], 'a') as fh:
+                fh.write('y')
+            self.assertNotEqual(reference_db_version(*args), version)
+            version = reference_db_version(*args)
+        # The LSH index is not used with a species index
+        args[4] = paths['species.tsv']
+        version = reference_db_version(*args)
+        with open(paths['lsh/meta.json'], 'a') as fh:
+            fh.write('y')
+        self.assertEqual(reference_db_version(*args), version)
+
+    def test_db_version_covers_segment_files(self):
+        manifest = os.path.join(self.tmpdir, 'cdm.segments.tsv')
+        with open(manifest, 'w') as fh:
+            fh.write('segment\tpath\ttaxonomy\thash_index\tgenomes\n'
+                     'base\tbase.msh\tbase.tsv\t\t1\n'
+                     'delta_1\tdelta_1.msh\tdelta_1.tsv\tdelta_1.hash.tsv\t1\n')
+        for name in ('base.msh', 'base.tsv', 'delta_1.msh', 'delta_1.tsv', 'delta_1.hash.tsv'):
+            with open(os.path.join(self.tmpdir, name), 'w') as fh:
+                fh.write('x')
+        taxonomy_file = os.path.join(self.tmpdir, 'taxonomy.tsv')
+        version = reference_db_version(manifest, taxonomy_file)
+        for name in ('delta_1.msh', 'delta_1.hash.tsv'):
+            with open(os.path.join(self.tmpdir, name), 'a') as fh:
+                fh.write('y')
+            self.assertNotEqual(reference_db_version(manifest, taxonomy_file), version)
+            version = reference_db_version(manifest, taxonomy_file)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from kb_cdm_genome_match.utils2 import sketch_cache
+from kb_cdm_genome_match.utils2.sketch_cache import QuerySketchCache
+
+
+def fake_sketch_genome(fasta_path, output_prefix, kmer_size, sketch_size, name):
+    with open(output_prefix + '.msh', 'w') as fh:
+        fh.write(name.ljust(100))
+    return output_prefix + '.msh'
+
+
+class sketch_cacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = QuerySketchCache(os.path.join(self.tmpdir, 'cache'), max_bytes=250)
+        patcher = mock.patch.object(sketch_cache, 'sketch_genome', side_effect=fake_sketch_genome)
+        self.sketch_genome = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_hit_reuses_sketch(self):
+        cdm_hash, path = self.cache.get_or_sketch('/x/a.fa', 21, 1000, cdm_hash='a' * 64)
+        self.assertEqual(os.path.basename(path), 'a' * 64 + '_k21_s1000.msh')
+        self.assertEqual(self.cache.get_or_sketch('/y/copy_of_a.fa', 21, 1000, cdm_hash='a' * 64),
+                         (cdm_hash, path))
+        self.assertEqual(self.sketch_genome.call_count, 1)
+        # different sketch parameters are a separate entry
+        self.cache.get_or_sketch('/x/a.fa', 21, 5000, cdm_hash='a' * 64)
+        self.assertEqual(self.sketch_genome.call_count, 2)
+
+    def test_lru_eviction_by_bytes(self):
+        for name in 'abc':
+            self.cache.get_or_sketch(f'/x/{name}.fa', 21, 1000, cdm_hash=name)
+            time.sleep(0.01)
+        # 'b' and 'c' fit in 250 bytes; 'a' was least recently used
+        self.assertIsNone(self.cache.get('a', 21, 1000))
+        self.assertIsNotNone(self.cache.get('b', 21, 1000))
+        time.sleep(0.01)
+        self.cache.get_or_sketch('/x/d.fa', 21, 1000, cdm_hash='d')
+        self.assertIsNotNone(self.cache.get('b', 21, 1000))
+        self.assertIsNone(self.cache.get('c', 21, 1000))
+        self.assertEqual(sorted(os.listdir(self.cache.cache_dir)),
+                         ['b_k21_s1000.msh', 'd_k21_s1000.msh'])
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+from kb_cdm_genome_match.utils2 import sketch_segments
+from kb_cdm_genome_match.utils2.hash_index import default_hash_index_path, load_hash_index
+from kb_cdm_genome_match.utils2.mash_skani_multiple import (
+    guided_search_indexes,
+    load_segment_manifest,
+    load_shard_manifest,
+)
+from kb_cdm_genome_match.utils2.sketch_segments import (
+    append_segment,
+    compact_segments,
+    init_segments,
+)
+
+
+def fake_sketch_shard(filepaths, shard_path, kmer_size, sketch_size, threads=1):
+    with open(shard_path, 'w') as fh:
+        fh.write('\n'.join(filepaths) + '\n')
+    return shard_path
+
+
+def fake_paste_sketches(sketch_paths, output_prefix):
+    with open(output_prefix + '.msh', 'w') as fh:
+        for path in sketch_paths:
+            with open(path) as sketch:
+                fh.write(sketch.read())
+    return output_prefix + '.msh'
+
+
+def fake_build_hash_index(taxonomy_file, index_file=None, processes=None):
+    index_file = default_hash_index_path(taxonomy_file)
+    filepaths = pd.read_csv(taxonomy_file, sep='\t')['filepath']
+    with open(index_file, 'w') as fh:
+        fh.write('filepath\tcdm_hash\n')
+        fh.writelines(f'{path}\t{os.path.basename(path)[0] * 64}\n' for path in filepaths)
+    return index_file, 0
+
+
+class sketch_segmentsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.base_dir = os.path.join(self.tmpdir, 'base')
+        os.makedirs(self.base_dir)
+        self.mash_db = fake_sketch_shard(['/g/a.fa', '/g/b.fa'],
+                                         os.path.join(self.base_dir, 'db.msh'), 21, 1000)
+        self.taxonomy_file = os.path.join(self.base_dir, 'taxonomy.tsv')
+        with open(self.taxonomy_file, 'w') as fh:
+            fh.write('filepath\ttaxonomy\n/g/a.fa\td__A\n/g/b.fa\td__B\n')
+        fake_build_hash_index(self.taxonomy_file)
+        for name, fake in (('sketch_shard', fake_sketch_shard),
+                           ('paste_sketches', fake_paste_sketches),
+                           ('build_hash_index', fake_build_hash_index)):
+            patcher = mock.patch.object(sketch_segments, name, side_effect=fake)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(sketch_segments, 'get_sketch_params',
+                                    return_value={'kmer_size': 21, 'sketch_size': 1000})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def new_genomes(self, name, rows):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as fh:
+            fh.write('filepath\ttaxonomy\n')
+            fh.writelines(f'{filepath}\t{taxonomy}\n' for filepath, taxonomy in rows)
+        return path
+
+    def test_append_and_compact(self):
+        manifest = init_segments(self.mash_db, self.taxonomy_file,
+                                 os.path.join(self.tmpdir, 'segments'))
+        new_genomes = self.new_genomes('new1.tsv', [('/g/b.fa', 'd__B'), ('/g/c.fa', 'd__C')])
+        self.assertEqual(append_segment(manifest, new_genomes), 'delta_0001')
+        self.assertIsNone(append_segment(manifest,
+                                         self.new_genomes('new2.tsv', [('/g/c.fa', 'd__C')])))
+        self.assertEqual(append_segment(manifest,
+                                        self.new_genomes('new3.tsv', [('/g/d.fa', 'd__D')])),
+                         'delta_0002')
+
+        segments = load_segment_manifest(manifest)
+        self.assertEqual(segments['segment'].tolist(), ['base', 'delta_0001', 'delta_0002'])
+        self.assertEqual(segments['genomes'].tolist(), ['2', '1', '1'])
+        self.assertEqual(load_shard_manifest(manifest)[0], self.mash_db)
+        self.assertEqual(list(load_hash_index(segments['hash_index'][1])), ['/g/c.fa'])
+
+        self.assertEqual(compact_segments(manifest), 'base_0001')
+        segments = load_segment_manifest(manifest)
+        self.assertEqual(segments['segment'].tolist(), ['base_0001'])
+        with open(segments['path'][0]) as fh:
+            self.assertEqual(fh.read().split(), ['/g/a.fa', '/g/b.fa', '/g/c.fa', '/g/d.fa'])
+        taxonomy = pd.read_csv(segments['taxonomy'][0], sep='\t')
+        self.assertEqual(taxonomy['taxonomy'].tolist(), ['d__A', 'd__B', 'd__C', 'd__D'])
+        self.assertEqual(list(load_hash_index(segments['hash_index'][0])),
+                         ['/g/a.fa', '/g/b.fa', '/g/c.fa', '/g/d.fa'])
+        # Merged deltas are removed, the original base is kept
+        self.assertEqual(sorted(os.listdir(os.path.dirname(manifest))),
+                         ['db.base_0001.cdm_hash.tsv', 'db.base_0001.msh', 'db.base_0001.tsv',
+                          'db.segments.tsv'])
+        self.assertTrue(os.path.exists(self.mash_db))
+        self.assertIsNone(compact_segments(manifest))
+
+    def test_guided_indexes_only_without_deltas(self):
+        manifest = init_segments(self.mash_db, self.taxonomy_file,
+                                 os.path.join(self.tmpdir, 'segments'))
+        lineage_index = os.path.join(self.tmpdir, 'db.lineages.tsv')
+        lsh_index = os.path.join(self.tmpdir, 'lsh')
+        os.makedirs(lsh_index)
+        for path in (lineage_index, os.path.join(lsh_index, 'meta.json')):
+            open(path, 'w').close()
+        indexes = (lineage_index, None, lsh_index)
+        self.assertEqual(guided_search_indexes(manifest, *indexes), indexes)
+        # Configured indexes that do not exist are not used
+        self.assertEqual(guided_search_indexes(manifest, lineage_index, '/i/missing.species.tsv',
+                                               '/i/lsh'),
+                         (lineage_index, None, None))
+        append_segment(manifest, self.new_genomes('new.tsv', [('/g/c.fa', 'd__C')]))
+        self.assertEqual(guided_search_indexes(manifest, *indexes), (None, None, None))
+        self.assertEqual(guided_search_indexes(self.mash_db, *indexes), indexes)
+        compact_segments(manifest)
+        self.assertEqual(guided_search_indexes(manifest, *indexes), indexes)
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from kb_cdm_genome_match.utils2.sketch_shards import group_genomes
+
+
+class sketch_shardsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.taxonomy_file = os.path.join(self.tmpdir, 'taxonomy.tsv')
+        rows = [('/g/a.fa', 'p__Bacillota'), ('/g/b.fa', 'p__Pseudomonadota'),
+                ('/g/c.fa', 'p__Bacillota'), ('/g/d.fa', ''), ('/g/e.fa', 'p__Bacillota A')]
+        with open(self.taxonomy_file, 'w') as fh:
+            fh.write('filepath\ttaxonomy\tphylum\n')
+            fh.writelines(f'{path}\tx\t{phylum}\n' for path, phylum in rows)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_group_by_phylum(self):
+        self.assertEqual(group_genomes(self.taxonomy_file, 'phylum'), {
+            'p__Bacillota': ['/g/a.fa', '/g/c.fa'],
+            'p__Pseudomonadota': ['/g/b.fa'],
+            'unclassified': ['/g/d.fa'],
+            'p__Bacillota_A': ['/g/e.fa'],
+        })
+
+    def test_group_by_size(self):
+        shards = group_genomes(self.taxonomy_file, 'size', 2)
+        self.assertEqual(shards, {'shard_0000': ['/g/a.fa', '/g/b.fa', '/g/c.fa'],
+                                  'shard_0001': ['/g/d.fa', '/g/e.fa']})
+        self.assertEqual(len(group_genomes(self.taxonomy_file, 'size', 10)), 5)
+        with self.assertRaises(ValueError):
+            group_genomes(self.taxonomy_file, 'size')
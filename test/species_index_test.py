@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from kb_cdm_genome_match.utils2.species_index import group_genomes_by_species
+
+
+class species_indexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.taxonomy_file = os.path.join(self.tmpdir, 'taxonomy.tsv')
+        rows = [('/g/a.fa', 's__Escherichia coli'), ('/g/b.fa', 's__Bacillus subtilis'),
+                ('/g/c.fa', 's__Escherichia coli'), ('/g/d.fa', ''), ('/g/e.fa', 's__')]
+        with open(self.taxonomy_file, 'w') as fh:
+            fh.write('filepath\ttaxonomy\tspecies\n')
+            fh.writelines(f'{path}\tx\t{species}\n' for path, species in rows)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_group_by_species(self):
+        self.assertEqual(group_genomes_by_species(self.taxonomy_file), {
+            's__Escherichia coli': ['/g/a.fa', '/g/c.fa'],
+            's__Bacillus subtilis': ['/g/b.fa'],
+            'unclassified_d.fa': ['/g/d.fa'],
+            'unclassified_e.fa': ['/g/e.fa'],
+        })
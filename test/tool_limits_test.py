@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from kb_cdm_genome_match.utils2.tool_limits import set_tool_limits, tool_slot
+
+
+class tool_limitsTest(unittest.TestCase):
+
+    def tearDown(self):
+        set_tool_limits(None)
+
+    def max_concurrent(self, tool, tasks=8):
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def task(_):
+            with tool_slot(tool):
+                with lock:
+                    running[0] += 1
+                    running[1] = max(running)
+                time.sleep(0.02)
+                with lock:
+                    running[0] -= 1
+
+        with ThreadPoolExecutor(max_workers=tasks) as executor:
+            list(executor.map(task, range(tasks)))
+        return running[1]
+
+    def test_tool_slots_bound_concurrency(self):
+        set_tool_limits({"mash": 2, "skani": 0})
+        self.assertEqual(self.max_concurrent("mash"), 2)
+        self.assertGreater(self.max_concurrent("skani"), 2)
+        set_tool_limits(None)
+        self.assertGreater(self.max_concurrent("mash"), 2)